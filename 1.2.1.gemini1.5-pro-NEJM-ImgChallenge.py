@@ -10,6 +10,12 @@ from langchain_core.messages import HumanMessage, SystemMessage
 import pandas as pd
 import time
 from time import sleep
+from nejm_vlm import cache
+from nejm_vlm import providers
+from nejm_vlm import retry
+from nejm_vlm import shutdown
+from nejm_vlm import structured
+from nejm_vlm import uploads
 
 time_file_name = "Gemini_execution_times.xlsx"
 
@@ -60,58 +66,50 @@ def process_and_encode_image(image, resize_factor=0.9):
 
     raise ValueError("Unable to reduce image size within 5 attempts")
 
-def analyze_images_with_gemini_vision(prompt_text, encoded_images, temperature=0):
+def resize_encoded_images(encoded_images, resize_factor):
+    """
+    Resize already encoded images by the given factor and re-encode them.
+    """
+    resized_encoded_images = []
+    for encoded_image in encoded_images:
+        image = Image.open(io.BytesIO(base64.b64decode(encoded_image)))
+        resized_encoded_images.append(process_and_encode_image(image, resize_factor))
+    return resized_encoded_images
+
+def analyze_images_with_gemini_vision(prompt_text, encoded_images, temperature=0, try_number=1):
     """
     Analyze images with Gemini Vision and return the result.
     """
     model = "models/gemini-1.5-pro-latest"
-    llm = ChatGoogleGenerativeAI(model=model, temperature=temperature)
+    llm = providers.gemini_chat(model, temperature)
 
-    max_attempts = 10
-    for attempt in range(max_attempts):
-        try:
+    def send(encoded_images):
+        def invoke():
+            # Images are uploaded (or inlined) only when the cache misses.
             content = [{"type": "text", "text": prompt_text}]
             for encoded_image in encoded_images:
-                content.append({
-                    "type": "image_url",
-                    "image_url": f"data:image/jpeg;base64,{encoded_image}"
-                })
-
-            message = HumanMessage(content=content)
-            start_time = time.time()
-            result = llm.invoke([message])
-            end_time = time.time()
-            execution_time = end_time - start_time
-
-            if isinstance(result.content, str) and len(result.content) < 10:
-                print(f"Result error retry {attempt + 1}/{max_attempts}")
-                resized_encoded_images = []
-                for encoded_image in encoded_images:
-                    image = Image.open(io.BytesIO(base64.b64decode(encoded_image)))
-                    resized_image = process_and_encode_image(image, 0.9)
-                    resized_encoded_images.append(resized_image)
-                print(
-                    f"Resizing images and retrying. Attempt {attempt + 1}/"
-                    f"{max_attempts}"
-                )
-                encoded_images = resized_encoded_images
-                continue
-
-            return [result.content, execution_time]
-        except Exception as e:
-            print(f"BadRequestError: {e}")
-            if "SAFETY" in str(e).lower() and attempt < max_attempts - 1:
-                resized_encoded_images = []
-                for encoded_image in encoded_images:
-                    image = Image.open(io.BytesIO(base64.b64decode(encoded_image)))
-                    resized_image = process_and_encode_image(image, 0.7)
-                    resized_encoded_images.append(resized_image)
-                print(
-                    f"Resizing images and retrying. Attempt {attempt + 1}/"
-                    f"{max_attempts}"
-                )
-                encoded_images = resized_encoded_images
-    return None
+                content.append(uploads.image_part(encoded_image))
+            return llm.invoke([HumanMessage(content=content)])
+
+        return cache.cached_call(
+            "gemini", model, prompt_text, encoded_images, temperature, None, try_number,
+            invoke,
+        )
+
+    start_time = time.time()
+    try:
+        response = retry.call_with_retry(
+            send, "gemini", model, encoded_images,
+            downscale=resize_encoded_images, hedge=temperature == 0,
+        )
+    except retry.RequestFailed as e:
+        print(f"Request failed: {e}")
+        return [None, time.time() - start_time]
+
+    end_time = time.time()
+    execution_time = end_time - start_time
+
+    return [response.content, execution_time]
 
 def find_image_paths(directory):
     """
@@ -159,21 +157,21 @@ def extract_json_data(text):
     Extract JSON data from a given text.
     """
     try:
-        start = text.index('{')
-        end = text.rindex('}') + 1
-        json_data = text[start:end]
-        return json.loads(json_data)
-    except (ValueError, json.JSONDecodeError) as e:
+        return structured.load_json(text)
+    except json.JSONDecodeError as e:
         print(f"Error extracting JSON: {e}")
         return None
 
 def main():
     global df_execution_times
+    shutdown.install()
     temperatures = [1]
     base_result_folder = "gemini_result/gemini_result"
 
     for temperature in temperatures:
         for try_number in range(1, 2):
+            if shutdown.requested():
+                break
             result_folder = create_result_folder(
                 base_result_folder, temperature, try_number)
             results_df = pd.DataFrame(
@@ -182,6 +180,8 @@ def main():
             df = pd.read_excel('NEJM_list.xlsx')
 
             for index, row in df.iterrows():
+                if shutdown.requested():
+                    break
                 sleep(15)
                 case_number = row['PPT No.']
                 case_folder = "pptimages"
@@ -223,7 +223,7 @@ def main():
                 encoded_images = encode_images_from_paths(image_paths)
 
                 [result, execution_time] = analyze_images_with_gemini_vision(
-                    prompt_text, encoded_images, temperature)
+                    prompt_text, encoded_images, temperature, try_number)
 
                 if ((df_execution_times['number'] == case_number) &
                     (df_execution_times['temperature'] == temperature) &
@@ -269,6 +269,7 @@ def main():
                         sleep(2)
                         continue
                 else:
+                    retry.record_timeout(result_file_path, case_number, temperature, try_number)
                     print(
                         f"Gemini Case {case_number} (Temperature: {temperature}, "
                         f"Try: {try_number}): No result found."
@@ -282,3 +283,4 @@ def main():
 
 if __name__ == "__main__":
     main()
+    retry.report()
@@ -1,13 +1,21 @@
 import json
-import openai
 import io
 import base64
 from PIL import Image
 import os
+import sys
 import time
 import statistics
 import pandas as pd
 
+# Make the shared nejm_vlm package importable from the task folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nejm_vlm import cache
+from nejm_vlm import providers
+from nejm_vlm import retry
+from nejm_vlm import shutdown
+from nejm_vlm import structured
+
 execution_times = []
 time_file_name = "OpenAI_execution_times.xlsx"
 
@@ -67,24 +75,34 @@ def process_and_encode_image(image, resize_factor=0.9):
 
     raise ValueError("Unable to reduce image size within 5 attempts")
 
-def analyze_images_with_gpt4_vision(prompt_text, encoded_images, temperature=0):
+def resize_encoded_images(encoded_images, resize_factor):
+    """
+    Resize already encoded images by the given factor and re-encode them.
+    """
+    resized_encoded_images = []
+    for encoded_image in encoded_images:
+        image = Image.open(io.BytesIO(base64.b64decode(encoded_image)))
+        resized_encoded_images.append(process_and_encode_image(image, resize_factor))
+    return resized_encoded_images
+
+def analyze_images_with_gpt4_vision(prompt_text, encoded_images, temperature=0, try_number=1):
     """
     Analyze images with GPT-4 Vision and return the result.
     """
-    client = openai.OpenAI()
-    max_attempts = 10
-
-    for attempt in range(max_attempts):
-        try:
-            image_contents = [
-                {
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}
-                }
-                for encoded_image in encoded_images
-            ]
-            start_time = time.time()
-            response = client.chat.completions.create(
+    client = providers.openai_client()
+
+    def send(encoded_images):
+        image_contents = [
+            {
+                "type": "image_url",
+                "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}
+            }
+            for encoded_image in encoded_images
+        ]
+        return cache.cached_call(
+            "openai", "gpt-4-turbo", prompt_text, encoded_images, temperature, 1024,
+            try_number,
+            lambda: client.chat.completions.create(
                 model="gpt-4-turbo",
                 response_format={"type": "json_object"},
                 messages=[
@@ -98,49 +116,40 @@ def analyze_images_with_gpt4_vision(prompt_text, encoded_images, temperature=0):
                 ],
                 max_tokens=1024,
                 temperature=temperature,
-            )
-            response_result = response.choices[0]
-
-            if response_result.message.content.startswith("I'm sorry, but"):
-                print(
-                    f"I'm sorry, retrying. Attempt {attempt + 1}/{max_attempts}"
-                )
-                continue
-
-            end_time = time.time()
-            execution_time = end_time - start_time
-            execution_times.append(execution_time)
-
-            average_time = sum(execution_times) / len(execution_times)
-            max_time = max(execution_times)
-            min_time = min(execution_times)
-            std_dev = statistics.stdev(
-                execution_times
-            ) if len(execution_times) > 1 else 0
-
-            total_data_points = len(execution_times)
-
-            print(f"Total data points: {total_data_points}")
-            print(f"Average execution time: {average_time:.2f} seconds")
-            print(f"Max execution time: {max_time:.2f} seconds")
-            print(f"Min execution time: {min_time:.2f} seconds")
-            print(f"Standard deviation: {std_dev:.2f} seconds")
-
-            return response_result
-        except Exception as e:
-            print(f"BadRequestError: {e}")
-            if "image_parse_error" in str(e).lower() and attempt < max_attempts - 1:
-                resized_encoded_images = []
-                for encoded_image in encoded_images:
-                    image = Image.open(io.BytesIO(base64.b64decode(encoded_image)))
-                    resized_image = process_and_encode_image(image, 0.9)
-                    resized_encoded_images.append(resized_image)
-                print(
-                    f"Resizing images and retrying. Attempt {attempt + 1}/{max_attempts}"
-                )
-                encoded_images = resized_encoded_images
-
-    return None
+            ),
+        )
+
+    start_time = time.time()
+    try:
+        response = retry.call_with_retry(
+            send, "openai", "gpt-4-turbo", encoded_images,
+            downscale=resize_encoded_images, hedge=temperature == 0,
+        )
+    except retry.RequestFailed as e:
+        print(f"Request failed: {e}")
+        return None
+    response_result = response.choices[0]
+
+    end_time = time.time()
+    execution_time = end_time - start_time
+    execution_times.append(execution_time)
+
+    average_time = sum(execution_times) / len(execution_times)
+    max_time = max(execution_times)
+    min_time = min(execution_times)
+    std_dev = statistics.stdev(
+        execution_times
+    ) if len(execution_times) > 1 else 0
+
+    total_data_points = len(execution_times)
+
+    print(f"Total data points: {total_data_points}")
+    print(f"Average execution time: {average_time:.2f} seconds")
+    print(f"Max execution time: {max_time:.2f} seconds")
+    print(f"Min execution time: {min_time:.2f} seconds")
+    print(f"Standard deviation: {std_dev:.2f} seconds")
+
+    return response_result
 
 def find_image_paths(directory):
     """
@@ -185,11 +194,14 @@ def create_result_folder(base_folder, temperature, try_number):
 
 def main():
     global df_execution_times  
+    shutdown.install()
     temperatures = [1]
     base_result_folder = "gpt4v_result/gpt4v_result"
 
     for temperature in temperatures:
         for try_number in range(1, 2):
+            if shutdown.requested():
+                break
             result_folder = create_result_folder(
                 base_result_folder, temperature, try_number
             )
@@ -205,6 +217,8 @@ def main():
             df = pd.read_excel('NEJM_list.xlsx')
 
             for index, row in df.iterrows():
+                if shutdown.requested():
+                    break
                 case_number = row['PPT No.']
                 case_folder = "pptimages"
                 image_file_name = f"img_page{case_number}_0.png"
@@ -250,7 +264,7 @@ def main():
                 encoded_images = encode_images_from_paths(image_paths)
 
                 start_time = time.time()
-                result = analyze_images_with_gpt4_vision(prompt_text, encoded_images, temperature)
+                result = analyze_images_with_gpt4_vision(prompt_text, encoded_images, temperature, try_number)
                 end_time = time.time()
                 execution_time = end_time - start_time
 
@@ -286,7 +300,7 @@ def main():
                         f"Case {case_number} (Temperature: {temperature}, "
                         f"Try: {try_number}): Result saved."
                     )
-                    result_content = json.loads(result.message.content)
+                    result_content = structured.load_json(result.message.content)
 
                     type_of_medical_imaging = result_content['1_TypeOfMedicalImaging']
                     specific_imaging_sequence = result_content['2_SpecificImagingSequence']
@@ -305,6 +319,7 @@ def main():
 
                     results_df = pd.concat([results_df, new_row], ignore_index=True)
                 else:
+                    retry.record_timeout(result_file_path, case_number, temperature, try_number)
                     print(
                         f"Case {case_number} (Temperature: {temperature}, "
                         f"Try: {try_number}): No result found."
@@ -322,3 +337,4 @@ def main():
 
 if __name__ == "__main__":
     main()
+    retry.report()
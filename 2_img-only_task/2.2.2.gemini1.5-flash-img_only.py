@@ -2,6 +2,7 @@ import io
 import base64
 from PIL import Image
 import os
+import sys
 import json
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema.runnable import RunnableMap
@@ -11,6 +12,14 @@ import pandas as pd
 import time
 from time import sleep
 
+# Make the shared nejm_vlm package importable from the task folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nejm_vlm import cache
+from nejm_vlm import providers
+from nejm_vlm import retry
+from nejm_vlm import shutdown
+from nejm_vlm import structured
+
 time_file_name = "Gemini_flash_execution_times.xlsx"
 
 def load_or_initialize_execution_times(time_file_name):
@@ -60,58 +69,51 @@ def process_and_encode_image(image, resize_factor=0.9):
 
     raise ValueError("Unable to reduce image size within 5 attempts")
 
-def analyze_images_with_gemini_vision(prompt_text, encoded_images, temperature=0):
+def resize_encoded_images(encoded_images, resize_factor):
+    """
+    Resize already encoded images by the given factor and re-encode them.
+    """
+    resized_encoded_images = []
+    for encoded_image in encoded_images:
+        image = Image.open(io.BytesIO(base64.b64decode(encoded_image)))
+        resized_encoded_images.append(process_and_encode_image(image, resize_factor))
+    return resized_encoded_images
+
+def analyze_images_with_gemini_vision(prompt_text, encoded_images, temperature=0, try_number=1):
     """
     Analyze images with Gemini Vision and return the result.
     """
     model = "models/gemini-1.5-flash-latest"
-    llm = ChatGoogleGenerativeAI(model=model, temperature=temperature)
-
-    max_attempts = 10
-    for attempt in range(max_attempts):
-        try:
-            content = [{"type": "text", "text": prompt_text}]
-            for encoded_image in encoded_images:
-                content.append({
-                    "type": "image_url",
-                    "image_url": f"data:image/jpeg;base64,{encoded_image}"
-                })
-
-            message = HumanMessage(content=content)
-            start_time = time.time()
-            result = llm.invoke([message])
-            end_time = time.time()
-            execution_time = end_time - start_time
-
-            if isinstance(result.content, str) and len(result.content) < 10:
-                print(f"Result error retry {attempt + 1}/{max_attempts}")
-                resized_encoded_images = []
-                for encoded_image in encoded_images:
-                    image = Image.open(io.BytesIO(base64.b64decode(encoded_image)))
-                    resized_image = process_and_encode_image(image, 0.9)
-                    resized_encoded_images.append(resized_image)
-                print(
-                    f"Resizing images and retrying. Attempt {attempt + 1}/"
-                    f"{max_attempts}"
-                )
-                encoded_images = resized_encoded_images
-                continue
-
-            return [result.content, execution_time]
-        except Exception as e:
-            print(f"BadRequestError: {e}")
-            if "SAFETY" in str(e).lower() and attempt < max_attempts - 1:
-                resized_encoded_images = []
-                for encoded_image in encoded_images:
-                    image = Image.open(io.BytesIO(base64.b64decode(encoded_image)))
-                    resized_image = process_and_encode_image(image, 0.7)
-                    resized_encoded_images.append(resized_image)
-                print(
-                    f"Resizing images and retrying. Attempt {attempt + 1}/"
-                    f"{max_attempts}"
-                )
-                encoded_images = resized_encoded_images
-    return None
+    llm = providers.gemini_chat(model, temperature)
+
+    def send(encoded_images):
+        content = [{"type": "text", "text": prompt_text}]
+        for encoded_image in encoded_images:
+            content.append({
+                "type": "image_url",
+                "image_url": f"data:image/jpeg;base64,{encoded_image}"
+            })
+
+        message = HumanMessage(content=content)
+        return cache.cached_call(
+            "gemini", model, prompt_text, encoded_images, temperature, None, try_number,
+            lambda: llm.invoke([message]),
+        )
+
+    start_time = time.time()
+    try:
+        response = retry.call_with_retry(
+            send, "gemini", model, encoded_images,
+            downscale=resize_encoded_images, hedge=temperature == 0,
+        )
+    except retry.RequestFailed as e:
+        print(f"Request failed: {e}")
+        return [None, time.time() - start_time]
+
+    end_time = time.time()
+    execution_time = end_time - start_time
+
+    return [response.content, execution_time]
 
 def find_image_paths(directory):
     """
@@ -159,21 +161,21 @@ def extract_json_data(text):
     Extract JSON data from a given text.
     """
     try:
-        start = text.index('{')
-        end = text.rindex('}') + 1
-        json_data = text[start:end]
-        return json.loads(json_data)
-    except (ValueError, json.JSONDecodeError) as e:
+        return structured.load_json(text)
+    except json.JSONDecodeError as e:
         print(f"Error extracting JSON: {e}")
         return None
 
 def main():
     global df_execution_times
+    shutdown.install()
     temperatures = [1]
     base_result_folder = "gemini_flash_result/gemini_flash_result"
 
     for temperature in temperatures:
         for try_number in range(1, 2):
+            if shutdown.requested():
+                break
             result_folder = create_result_folder(
                 base_result_folder, temperature, try_number)
             results_df = pd.DataFrame(columns=[
@@ -187,6 +189,8 @@ def main():
             df = pd.read_excel('NEJM_list.xlsx')
 
             for index, row in df.iterrows():
+                if shutdown.requested():
+                    break
                 sleep(15)
                 case_number = row['PPT No.']
                 case_folder = "pptimages"
@@ -232,7 +236,7 @@ def main():
                 encoded_images = encode_images_from_paths(image_paths)
 
                 [result, execution_time] = analyze_images_with_gemini_vision(
-                    prompt_text, encoded_images, temperature)
+                    prompt_text, encoded_images, temperature, try_number)
 
                 if ((df_execution_times['number'] == case_number) &
                     (df_execution_times['temperature'] == temperature) &
@@ -285,6 +289,7 @@ def main():
                         sleep(2)
                         continue
                 else:
+                    retry.record_timeout(result_file_path, case_number, temperature, try_number)
                     print(
                         f"Gemini Case {case_number} (Temperature: {temperature}, "
                         f"Try: {try_number}): No result found."
@@ -298,3 +303,4 @@ def main():
 
 if __name__ == "__main__":
     main()
+    retry.report()
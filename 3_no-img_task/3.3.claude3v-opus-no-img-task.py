@@ -7,10 +7,17 @@ import sys
 import time
 import statistics
 import pandas as pd
-import anthropic
 from time import sleep
 
-client = anthropic.Anthropic()
+# Make the shared nejm_vlm package importable from the task folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nejm_vlm import cache
+from nejm_vlm import providers
+from nejm_vlm import retry
+from nejm_vlm import shutdown
+from nejm_vlm import structured
+
+client = providers.anthropic_client()
 
 # List to record execution times
 execution_times = []
@@ -71,27 +78,27 @@ def process_and_encode_image(image, resize_factor=0.9):
 
     raise ValueError("Unable to reduce image size within 5 attempts")
 
-def analyze_images_with_claude_vision(prompt_text, encoded_images, temperature=0):
+def analyze_images_with_claude_vision(prompt_text, encoded_images, temperature=0, try_number=1):
     """
     Analyze images with Claude Vision and return the result.
     """
-    client = anthropic.Client(
-        api_key=os.getenv("ANTHROPIC_API_KEY"))
-    max_attempts = 10
-    for attempt in range(max_attempts):
-        try:
-            image_contents = [
-                {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": encoded_image
-                    }
-                } for encoded_image in encoded_images
-            ]
-            start_time = time.time()
-            response = client.messages.create(
+    client = providers.anthropic_client()
+
+    def send(encoded_images):
+        image_contents = [
+            {
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": "image/jpeg",
+                    "data": encoded_image
+                }
+            } for encoded_image in encoded_images
+        ]
+        return cache.cached_call(
+            "anthropic", "claude-3-opus-20240229", prompt_text, [], temperature, 1024,
+            try_number,
+            lambda: client.messages.create(
                 model="claude-3-opus-20240229",
                 messages=[
                     {
@@ -104,46 +111,36 @@ def analyze_images_with_claude_vision(prompt_text, encoded_images, temperature=0
                 ],
                 max_tokens=1024,
                 temperature=temperature,
-            )
-            response_result = response
-
-            if response_result.content[0].text.startswith("I'm sorry, but"):
-                print(f"I'm sorry retry {attempt + 1}/{max_attempts}")
-                continue
-
-            end_time = time.time()
-            execution_time = end_time - start_time
-            execution_times.append(execution_time)
-
-            average_time = sum(execution_times) / len(execution_times)
-            max_time = max(execution_times)
-            min_time = min(execution_times)
-            std_dev = statistics.stdev(execution_times) if len(execution_times) > 1 else 0
-
-            total_data_points = len(execution_times)
-
-            print(f"Total data points: {total_data_points}")
-            print(f"Average execution time: {average_time:.2f} seconds")
-            print(f"Max execution time: {max_time:.2f} seconds")
-            print(f"Min execution time: {min_time:.2f} seconds")
-            print(f"Standard deviation: {std_dev:.2f} seconds")
-
-            return response_result.content[0].text
-        except Exception as e:
-            print(f"BadRequestError: {e}")
-            if "exceeded" in str(e).lower():
-                save_execution_times_to_excel(df_execution_times, time_file_name)
-                sys.exit()
-            if "image_parse_error" in str(e).lower() and attempt < max_attempts - 1:
-                resized_encoded_images = []
-                for encoded_image in encoded_images:
-                    image = Image.open(io.BytesIO(base64.b64decode(encoded_image)))
-                    resized_image = process_and_encode_image(image, 0.9)
-                    resized_encoded_images.append(resized_image)
-                print(f"Resizing images and retrying. Attempt {attempt + 1}/{max_attempts}")
-                encoded_images = resized_encoded_images
-            
-    return None
+            ),
+        )
+
+    start_time = time.time()
+    try:
+        response = retry.call_with_retry(
+            send, "anthropic", "claude-3-opus-20240229", hedge=temperature == 0
+        )
+    except retry.RequestFailed as e:
+        print(f"Request failed: {e}")
+        return None
+
+    end_time = time.time()
+    execution_time = end_time - start_time
+    execution_times.append(execution_time)
+
+    average_time = sum(execution_times) / len(execution_times)
+    max_time = max(execution_times)
+    min_time = min(execution_times)
+    std_dev = statistics.stdev(execution_times) if len(execution_times) > 1 else 0
+
+    total_data_points = len(execution_times)
+
+    print(f"Total data points: {total_data_points}")
+    print(f"Average execution time: {average_time:.2f} seconds")
+    print(f"Max execution time: {max_time:.2f} seconds")
+    print(f"Min execution time: {min_time:.2f} seconds")
+    print(f"Standard deviation: {std_dev:.2f} seconds")
+
+    return response.content[0].text
 
 def find_image_paths(directory):
     """
@@ -182,17 +179,22 @@ def create_result_folder(base_folder, temperature, try_number):
 
 def main():
     global df_execution_times
+    shutdown.install()
     temperatures = [1]
     base_result_folder = "Claude_result/Claude_result"
 
     for temperature in temperatures:
         for try_number in range(1, 2):
+            if shutdown.requested():
+                break
             result_folder = create_result_folder(base_result_folder, temperature, try_number)
             results_df = pd.DataFrame(columns=['case_number', 'answer', 'reason'])
 
             df = pd.read_excel('NEJM_list.xlsx')
 
             for index, row in df.iterrows():
+                if shutdown.requested():
+                    break
                 case_number = row['PPT No.']
                 case_folder = "pptimages"
                 image_file_name = f"img_page{case_number}_0.png"
@@ -229,7 +231,7 @@ def main():
                 encoded_images = encode_images_from_paths(image_paths)
                 
                 start_time = time.time()
-                result = analyze_images_with_claude_vision(prompt_text, encoded_images, temperature)
+                result = analyze_images_with_claude_vision(prompt_text, encoded_images, temperature, try_number)
                 end_time = time.time()
                 execution_time = end_time - start_time
 
@@ -249,7 +251,7 @@ def main():
                         result_file.write(result)
                     print(f"Case {case_number} (Temperature: {temperature}, Try: {try_number}): Result saved.")
                     try:
-                        result_content = json.loads(result)
+                        result_content = structured.load_json(result)
                         answer = result_content['answer']
                         reason = result_content['reason']
                         new_row = pd.DataFrame(
@@ -265,6 +267,7 @@ def main():
                         sleep(2)
                         continue
                 else:
+                    retry.record_timeout(result_file_path, case_number, temperature, try_number)
                     print(f"Case {case_number} (Temperature: {temperature}, Try: {try_number}): No result found.")
                     log_message(f"Case {case_number} (Temperature: {temperature}, Try: {try_number}): No result found.")
 
@@ -276,3 +279,4 @@ def main():
 
 if __name__ == "__main__":
     main()
+    retry.report()
@@ -0,0 +1,16 @@
+"""
+Shared helpers for the NEJM Image Challenge VLM scripts.
+
+Model answers are collected by the numbered scripts in the repository root
+and task folders, or by the collection modules of this package, which send
+the same requests and write the same `*_result` folders:
+
+    runner      every model and task from one command, with static sharding
+    workqueue   a shared SQLite queue of cases leased by any number of workers
+    batches     the OpenAI and Anthropic batch APIs, at the batch discount
+
+Their requests go through providers, retry, cache and the modules these use
+(pacing, circuit, keys, hedging, deadlines, shutdown). The other modules
+analyze the `*_result` folders: results, scoring, significance, search,
+ensemble, categories and logprobs.
+"""
@@ -0,0 +1,493 @@
+"""
+Batch mode of the unified runner: pending cases are sent through the OpenAI
+Batch API (GPT models) or Anthropic Message Batches (Claude) instead of one
+synchronous request at a time.
+
+Usage (from the repository root):
+
+    python -m nejm_vlm.batches run --models gpt4o Claude --tasks full --temperatures 0 0.5 1 --tries 3
+    python -m nejm_vlm.batches submit --models gpt4o --tasks full    # submit and exit
+    python -m nejm_vlm.batches collect                               # poll and ingest later
+
+Every pending (case, temperature, try), i.e. one without a result file and
+not in a batch still running, becomes one batch request with the request
+body of the synchronous runner. Its custom_id encodes the model, task, case,
+temperature and try, e.g. Claude__full__case12__temp0_5__try1. The requests
+of a model go into one batch, split into several batches to stay within the
+provider's limits. The request files (JSONL) and the ledger of submitted
+batches are kept in BATCH_DIR, so `collect` can run later or elsewhere.
+
+Finished batches are ingested into the standard result folders, the results
+sheets and the execution-time store. A batch has no per-request latency, so
+the time stored for each case is the turnaround of its batch (submission to
+completion). Failed requests and refusals get no result file; the next
+submission (or a synchronous run) picks them up again.
+
+    VLM_BATCH_POLL   seconds between status checks (default 60)
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+import pandas as pd
+
+from nejm_vlm import cache
+from nejm_vlm import providers
+from nejm_vlm import results
+from nejm_vlm import runner
+from nejm_vlm import shutdown
+from nejm_vlm import usage
+
+BATCH_DIR = 'vlm_batches'
+LEDGER_FILE = 'ledger.json'
+DEFAULT_POLL = 60.0
+
+OPENAI_ENDPOINT = '/v1/chat/completions'
+COMPLETION_WINDOW = '24h'
+# Requests and bytes per batch, with some headroom on the size.
+BATCH_LIMITS = {
+    'openai': (50000, 190 * 1024 * 1024),
+    'anthropic': (100000, 240 * 1024 * 1024),
+}
+
+# OpenAI statuses after which a batch changes no more.
+FINISHED_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+CUSTOM_ID_PATTERN = re.compile(
+    r'^(?P<model>.+?)__(?P<task>.+?)__case(?P<case>\d+)__temp(?P<temperature>[0-9_]+)'
+    r'__try(?P<try>\d+)$'
+)
+
+
+def poll_seconds():
+    return float(os.getenv('VLM_BATCH_POLL', DEFAULT_POLL))
+
+
+def custom_id(model_key, task, case_number, temperature, try_number):
+    """
+    Encodes a job as a custom_id (letters, digits, '_' and '-' only).
+    """
+    temperature = str(temperature).replace('.', '_')
+    return f"{model_key}__{task}__case{case_number}__temp{temperature}__try{try_number}"
+
+
+def parse_custom_id(value):
+    """
+    Decodes a custom_id.
+
+    Returns:
+    tuple: (model_key, task, case_number, temperature, try_number)
+    """
+    match = CUSTOM_ID_PATTERN.match(value)
+    if not match:
+        raise ValueError(f"Not a batch custom_id: {value}")
+    return (
+        match.group('model'),
+        match.group('task'),
+        int(match.group('case')),
+        runner.parse_temperature(results.parse_temperature(match.group('temperature'))),
+        int(match.group('try')),
+    )
+
+
+def load_ledger():
+    """
+    Returns the submitted batches: a list of dicts with the batch id,
+    provider, model, input file, submission time and state.
+    """
+    path = os.path.join(BATCH_DIR, LEDGER_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_ledger(ledger):
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    path = os.path.join(BATCH_DIR, LEDGER_FILE)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(ledger, file, indent=2)
+    os.replace(temporary_path, path)
+
+
+def read_custom_ids(path):
+    """
+    Returns the custom_ids of a JSONL request file.
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        return {json.loads(line)['custom_id'] for line in file if line.strip()}
+
+
+def in_flight(ledger):
+    """
+    Returns the custom_ids of the batches that have not been ingested yet.
+    """
+    custom_ids = set()
+    for entry in ledger:
+        if entry['state'] != 'ingested' and os.path.exists(entry['input_file']):
+            custom_ids |= read_custom_ids(entry['input_file'])
+    return custom_ids
+
+
+def pending_requests(model_key, tasks, temperatures, tries, skip_ids):
+    """
+    Yields the pending jobs of a model.
+
+    Yields:
+    tuple: (custom_id, prompt_text, encoded_images, temperature)
+    """
+    for task in tasks:
+        case_list = results.load_case_list(results.TASK_FOLDERS[task])
+        if case_list is None:
+            print(f"No {results.CASE_LIST_FILE} in {results.TASK_FOLDERS[task]}, skipping {task}")
+            continue
+        for temperature in temperatures:
+            for try_number in range(1, tries + 1):
+                result_folder = runner.create_result_folder(
+                    model_key, task, temperature, try_number
+                )
+                for index, row in case_list.iterrows():
+                    case_number = row[results.CASE_COLUMN]
+                    job_id = custom_id(model_key, task, case_number, temperature, try_number)
+                    if job_id in skip_ids or \
+                            os.path.exists(results.result_file_path(result_folder, case_number)):
+                        continue
+                    prompt_text, encoded_images = runner.case_inputs(task, row)
+                    yield job_id, prompt_text, encoded_images, temperature
+
+
+def openai_line(model, job_id, prompt_text, encoded_images, temperature):
+    """
+    Returns one Batch API request line.
+    """
+    return {
+        'custom_id': job_id,
+        'method': 'POST',
+        'url': OPENAI_ENDPOINT,
+        'body': runner.openai_request(model, prompt_text, encoded_images, temperature),
+    }
+
+
+def anthropic_line(model, job_id, prompt_text, encoded_images, temperature):
+    """
+    Returns one Message Batches request.
+    """
+    return {
+        'custom_id': job_id,
+        'params': runner.anthropic_request(model, prompt_text, encoded_images, temperature),
+    }
+
+
+def write_request_files(lines, prefix, max_requests, max_bytes):
+    """
+    Writes request lines to JSONL files of at most max_requests lines and
+    max_bytes bytes each, one file per batch.
+
+    Returns:
+    list: Paths of the files written.
+    """
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    paths = []
+    file = None
+    count = size = 0
+    for line in lines:
+        encoded = (json.dumps(line, ensure_ascii=False) + '\n').encode('utf-8')
+        if file is None or count >= max_requests or size + len(encoded) > max_bytes:
+            if file is not None:
+                file.close()
+            paths.append(os.path.join(BATCH_DIR, f"{prefix}_part{len(paths) + 1}.jsonl"))
+            file = open(paths[-1], 'wb')
+            count = size = 0
+        file.write(encoded)
+        count += 1
+        size += len(encoded)
+    if file is not None:
+        file.close()
+    return paths
+
+
+def submit_openai(model_key, input_file):
+    """
+    Uploads a request file and creates its batch.
+
+    Returns:
+    dict: The ledger entry of the batch.
+    """
+    client = providers.openai_client()
+    with open(input_file, 'rb') as file:
+        uploaded = client.files.create(file=file, purpose='batch')
+    batch = client.batches.create(
+        input_file_id=uploaded.id, endpoint=OPENAI_ENDPOINT,
+        completion_window=COMPLETION_WINDOW, metadata={'model': model_key},
+    )
+    print(f"Submitted {model_key} batch {batch.id} ({input_file})")
+    return {
+        'id': batch.id,
+        'provider': 'openai',
+        'model': model_key,
+        'input_file': input_file,
+        'submitted_at': time.time(),
+        'state': 'submitted',
+    }
+
+
+def submit_anthropic(model_key, input_file):
+    """
+    Creates a Message Batch from a request file.
+
+    Returns:
+    dict: The ledger entry of the batch.
+    """
+    client = providers.anthropic_client()
+    with open(input_file, 'r', encoding='utf-8') as file:
+        requests = [json.loads(line) for line in file if line.strip()]
+    batch = client.messages.batches.create(requests=requests)
+    print(f"Submitted {model_key} batch {batch.id} ({input_file})")
+    return {
+        'id': batch.id,
+        'provider': 'anthropic',
+        'model': model_key,
+        'input_file': input_file,
+        'submitted_at': time.time(),
+        'state': 'submitted',
+    }
+
+
+# Provider -> (request line builder, submit function)
+BATCH_PROVIDERS = {
+    'openai': (openai_line, submit_openai),
+    'anthropic': (anthropic_line, submit_anthropic),
+}
+
+
+def submit(models, tasks, temperatures, tries):
+    """
+    Compiles the pending jobs of every model into batches and submits them.
+
+    Returns:
+    list: The ledger entries of the new batches.
+    """
+    ledger = load_ledger()
+    skip_ids = in_flight(ledger)
+    submitted = []
+    for model_key in models:
+        model = runner.MODELS[model_key]
+        if model.provider not in BATCH_PROVIDERS:
+            print(f"{model_key}: batch mode is not available for {model.provider}, skipping")
+            continue
+        build_line, submit_file = BATCH_PROVIDERS[model.provider]
+        lines = (
+            build_line(model, *request)
+            for request in pending_requests(model_key, tasks, temperatures, tries, skip_ids)
+        )
+        prefix = f"{model.provider}_{model_key}_{time.strftime('%Y%m%d_%H%M%S')}"
+        input_files = write_request_files(lines, prefix, *BATCH_LIMITS[model.provider])
+        if not input_files:
+            print(f"{model_key}: no pending cases")
+            continue
+        for input_file in input_files:
+            entry = submit_file(model_key, input_file)
+            ledger.append(entry)
+            submitted.append(entry)
+            save_ledger(ledger)
+    return submitted
+
+
+def ingest_lines(lines, turnaround):
+    """
+    Writes the result files of successful batch lines as they are read.
+
+    Parameters:
+    lines (iterable): (custom_id, response_text or None) pairs.
+    turnaround (float): Seconds from submission to completion of the batch.
+
+    Returns:
+    tuple: (saved, failed) counts.
+    """
+    new_times = {}
+    runs = set()
+    saved = failed = 0
+    for job_id, text in lines:
+        model_key, task, case_number, temperature, try_number = parse_custom_id(job_id)
+        if not text:
+            failed += 1
+            continue
+        result_folder = runner.create_result_folder(model_key, task, temperature, try_number)
+        with open(results.result_file_path(result_folder, case_number), 'w',
+                  encoding='utf-8') as result_file:
+            result_file.write(text)
+        saved += 1
+        runs.add((model_key, task, result_folder))
+        new_times.setdefault((model_key, task), []).append({
+            'number': case_number, 'temperature': temperature, 'try': try_number,
+            'time': turnaround,
+        })
+
+    for (model_key, task), rows in new_times.items():
+        time_file = os.path.join(results.TASK_FOLDERS[task], runner.MODELS[model_key].time_file)
+        df_execution_times = runner.upsert_execution_times(
+            runner.load_execution_times(time_file), pd.DataFrame(rows, columns=runner.TIME_COLUMNS)
+        )
+        df_execution_times.to_excel(time_file, index=False, engine='openpyxl')
+        print(f"Execution times saved to {time_file}")
+    for model_key, task, result_folder in sorted(runs):
+        runner.write_results_sheet(
+            task, runner.MODELS[model_key], result_folder,
+            results.load_case_list(results.TASK_FOLDERS[task]),
+        )
+    return saved, failed
+
+
+def openai_output_lines(client, batch):
+    """
+    Reads the output and error files of a finished OpenAI batch.
+
+    Yields:
+    tuple: (custom_id, response_text or None); refusals and errors have no
+    text.
+    """
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        content = client.files.content(file_id).text
+        with open(os.path.join(BATCH_DIR, f"{batch.id}_{file_id}.jsonl"), 'w',
+                  encoding='utf-8') as file:
+            file.write(content)
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get('response') or {}
+            text = None
+            if response.get('status_code') == 200:
+                completion = cache.decode_response('openai', response['body'])
+                usage.record('openai', completion.model, completion)
+                if providers.response_problem('openai', completion) is None:
+                    text = providers.response_text('openai', completion)
+            yield record['custom_id'], text
+
+
+def poll_openai(entry):
+    """
+    Checks an OpenAI batch.
+
+    Returns:
+    tuple: (status, finished, progress, turnaround, lines); lines yields the
+    results of a finished batch.
+    """
+    client = providers.openai_client()
+    batch = client.batches.retrieve(entry['id'])
+    counts = batch.request_counts
+    progress = f"{counts.completed + counts.failed}/{counts.total} done" if counts else ''
+    if batch.status not in FINISHED_STATUSES:
+        return batch.status, False, progress, None, None
+    turnaround = (batch.completed_at or batch.expired_at or time.time()) - batch.created_at
+    return batch.status, True, progress, turnaround, openai_output_lines(client, batch)
+
+
+def anthropic_result_lines(client, batch):
+    """
+    Streams the results of an ended Message Batch, keeping a copy of every
+    line in BATCH_DIR.
+
+    Yields:
+    tuple: (custom_id, response_text or None); errored, canceled and expired
+    requests and refusals have no text.
+    """
+    with open(os.path.join(BATCH_DIR, f"{batch.id}_results.jsonl"), 'w',
+              encoding='utf-8') as file:
+        for result in client.messages.batches.results(batch.id):
+            file.write(result.to_json(indent=None) + '\n')
+            text = None
+            if result.result.type == 'succeeded':
+                message = result.result.message
+                usage.record('anthropic', message.model, message)
+                if providers.response_problem('anthropic', message) is None:
+                    text = providers.response_text('anthropic', message)
+            yield result.custom_id, text
+
+
+def poll_anthropic(entry):
+    """
+    Checks a Message Batch; see poll_openai().
+    """
+    client = providers.anthropic_client()
+    batch = client.messages.batches.retrieve(entry['id'])
+    counts = batch.request_counts
+    total = counts.processing + counts.succeeded + counts.errored + counts.canceled + counts.expired
+    progress = f"{total - counts.processing}/{total} done"
+    if batch.processing_status != 'ended':
+        return batch.processing_status, False, progress, None, None
+    turnaround = (batch.ended_at - batch.created_at).total_seconds()
+    return batch.processing_status, True, progress, turnaround, anthropic_result_lines(client, batch)
+
+
+POLLERS = {
+    'openai': poll_openai,
+    'anthropic': poll_anthropic,
+}
+
+
+def collect(wait=True):
+    """
+    Polls the submitted batches and ingests the finished ones.
+
+    Parameters:
+    wait (bool): Keep polling until every batch is ingested.
+
+    Returns:
+    int: Number of batches still running.
+    """
+    ledger = load_ledger()
+    while True:
+        running = 0
+        for entry in ledger:
+            if entry['state'] == 'ingested':
+                continue
+            status, finished, progress, turnaround, lines = POLLERS[entry['provider']](entry)
+            if not finished:
+                running += 1
+                print(f"Batch {entry['id']} ({entry['model']}): {status}, {progress}")
+                continue
+            saved, failed = ingest_lines(lines, turnaround)
+            print(f"Batch {entry['id']} ({entry['model']}): {status}, {saved} results saved, "
+                  f"{failed} failed or refused")
+            entry.update(state='ingested', status=status, saved=saved, failed=failed)
+            save_ledger(ledger)
+        if not running or not wait or shutdown.wait(poll_seconds()):
+            return running
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, help_text in (('run', 'Submit the pending cases and wait for the results'),
+                               ('submit', 'Submit the pending cases and exit')):
+        command_parser = subparsers.add_parser(command, help=help_text)
+        command_parser.add_argument('--models', nargs='*', default=['gpt4v', 'gpt4o', 'Claude'],
+                                    choices=list(runner.MODELS))
+        command_parser.add_argument('--tasks', nargs='*', default=list(results.TASK_FOLDERS),
+                                    choices=list(results.TASK_FOLDERS))
+        command_parser.add_argument('--temperatures', nargs='*', type=runner.parse_temperature,
+                                    default=[1])
+        command_parser.add_argument('--tries', type=int, default=1, help='Tries per temperature')
+    collect_parser = subparsers.add_parser('collect', help='Ingest the finished batches')
+    collect_parser.add_argument('--no-wait', action='store_true',
+                                help='Check once instead of waiting for every batch')
+    args = parser.parse_args()
+
+    shutdown.install()
+    if args.command in ('run', 'submit'):
+        submit(args.models, args.tasks, args.temperatures, args.tries)
+    if args.command in ('run', 'collect'):
+        running = collect(wait=not getattr(args, 'no_wait', False))
+        if running:
+            print(f"{running} batches still running; run 'python -m nejm_vlm.batches collect' later")
+        usage.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Request-level record/replay cache of raw provider responses.
+
+Responses are keyed by provider, model, normalized prompt, image contents,
+temperature, max_tokens, try number and, when set, the number of OpenAI
+top_logprobs and the request options of the runner that change the response
+(the structured-output mode and the prompt layout, see
+nejm_vlm.runner.request_sender()), and stored as JSON under
+VLM_CACHE_DIR (default `.vlm_cache`). VLM_CACHE_MODE selects the mode:
+
+    off             always call the API, never store (default)
+    record          always call the API and store the response
+    replay          only answer from the cache; a miss raises CacheMiss
+    record-missing  answer from the cache, call the API on a miss and store
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import time
+
+from nejm_vlm import providers
+from nejm_vlm import usage
+
+MODES = ('off', 'record', 'replay', 'record-missing')
+DEFAULT_CACHE_DIR = '.vlm_cache'
+
+
+class CacheMiss(Exception):
+    """
+    Raised in replay mode when a request has no recorded response.
+    """
+
+
+def cache_mode():
+    """
+    Returns the cache mode selected by VLM_CACHE_MODE.
+    """
+    mode = os.getenv('VLM_CACHE_MODE', 'off').strip().lower() or 'off'
+    if mode not in MODES:
+        raise ValueError(f"VLM_CACHE_MODE must be one of {', '.join(MODES)}, not '{mode}'")
+    return mode
+
+
+def cache_dir():
+    return os.getenv('VLM_CACHE_DIR', DEFAULT_CACHE_DIR)
+
+
+def prompt_hash(prompt_text):
+    """
+    Hashes a prompt after collapsing whitespace, so re-indenting the prompt
+    in the source does not invalidate the cache.
+    """
+    normalized = re.sub(r'\s+', ' ', prompt_text).strip()
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def image_hashes(encoded_images):
+    """
+    Hashes the decoded content of base64-encoded images.
+    """
+    return [
+        hashlib.sha256(base64.b64decode(encoded_image)).hexdigest()
+        for encoded_image in encoded_images
+    ]
+
+
+def request_key(provider, model, prompt_text, encoded_images, temperature,
+                max_tokens, try_number, top_logprobs=0, options=None):
+    """
+    Builds the cache key of a request.
+
+    options (dict) holds further fields of the request that change the
+    response; only requests that set them carry them in their key.
+
+    Returns:
+    tuple: (key, fields) where key is a hex digest and fields the values it
+    was computed from.
+    """
+    fields = {
+        'provider': provider,
+        'model': model,
+        'prompt': prompt_hash(prompt_text),
+        'images': image_hashes(encoded_images),
+        'temperature': float(temperature),
+        'max_tokens': max_tokens,
+        'try': int(try_number),
+    }
+    if top_logprobs:
+        # Only requests with logprobs carry the field, so the other keys stay.
+        fields['top_logprobs'] = int(top_logprobs)
+    fields.update(options or {})
+    key = hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+    return key, fields
+
+
+def entry_path(provider, key):
+    return os.path.join(cache_dir(), provider, key[:2], f'{key}.json')
+
+
+def load_entry(provider, key):
+    """
+    Loads a recorded entry, or returns None if there is none.
+    """
+    try:
+        with open(entry_path(provider, key), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def store_entry(provider, key, fields, raw, latency):
+    """
+    Writes an entry atomically, so concurrent runners never see partial files.
+    """
+    path = entry_path(provider, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    entry = {
+        'request': fields,
+        'response': raw,
+        'latency': latency,
+        'recorded_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(entry, file, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def _model_to_dict(response):
+    if hasattr(response, 'model_dump'):
+        return response.model_dump()
+    return response.dict()
+
+
+def encode_response(provider, response):
+    """
+    Converts a provider response object into JSON-serializable data.
+    """
+    if provider == 'gemini':
+        return {'content': response.content}
+    return _model_to_dict(response)
+
+
+def decode_response(provider, raw):
+    """
+    Rebuilds the response object that the provider SDK would have returned.
+    """
+    if provider == 'openai':
+        from openai.types.chat import ChatCompletion
+        return ChatCompletion.construct(**raw)
+    if provider == 'anthropic':
+        from anthropic.types import Message
+        return Message.construct(**raw)
+    from langchain_core.messages import AIMessage
+    return AIMessage(content=raw['content'])
+
+
+def cached_call(provider, model, prompt_text, encoded_images, temperature, max_tokens,
+                try_number, call, top_logprobs=0, options=None):
+    """
+    Answers a request from the cache or by calling the API, per the mode.
+
+    Parameters:
+    provider (str): 'openai', 'anthropic' or 'gemini'.
+    model (str): Model name.
+    prompt_text (str): Prompt sent with the request.
+    encoded_images (list): Base64-encoded images sent with the request.
+    temperature (float): Sampling temperature.
+    max_tokens (int): Output token limit (None if not set).
+    try_number (int): Try index of the run.
+    call (function): Zero-argument function sending the request.
+    top_logprobs (int): Alternatives per token requested with logprobs (0 =
+    no logprobs).
+    options (dict): Further key fields, see request_key().
+
+    Returns:
+    object: The SDK response object (rebuilt from the cache on a hit).
+    """
+    mode = cache_mode()
+    if mode == 'off':
+        response = call()
+        usage.record(provider, model, response)
+        return response
+
+    key, fields = request_key(
+        provider, model, prompt_text, encoded_images, temperature, max_tokens, try_number,
+        top_logprobs, options,
+    )
+    if mode in ('replay', 'record-missing'):
+        entry = load_entry(provider, key)
+        if entry is not None:
+            return decode_response(provider, entry['response'])
+        if mode == 'replay':
+            raise CacheMiss(f"No recorded {provider} response for {model} (key {key[:12]})")
+
+    start_time = time.time()
+    response = call()
+    usage.record(provider, model, response)
+    # Refusals and truncated answers are retried, so they are never recorded;
+    # otherwise a replay would return them on every attempt.
+    if providers.response_problem(provider, response) is None:
+        store_entry(provider, key, fields, encode_response(provider, response),
+                    time.time() - start_time)
+    return response
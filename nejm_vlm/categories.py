@@ -0,0 +1,344 @@
+"""
+Normalizes the structured fields of the image-only task and scores them
+against the radiologists' labels.
+
+Usage (from the repository root):
+
+    python -m nejm_vlm.categories --task-dir 2_img-only_task
+"""
+import argparse
+import re
+from collections import deque, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from nejm_vlm import results
+
+CONFUSION_FILE = 'category_confusion.xlsx'
+OTHER = 'other'
+
+# Canonical labels of every field, each with the synonyms mapped onto it.
+# The position of a label in the vocabulary is its integer code.
+MODALITY_VOCABULARY = {
+    'MR': ['mr', 'mri', 'magnetic resonance', 't1wi', 't2wi', 't1', 't2', 'flair',
+           'dwi', 'swi', 'gre', 'tof'],
+    'CT': ['ct', 'computed tomography', 'cta', 'hrct', 'cect'],
+    'US': ['us', 'ultrasound', 'ultrasonography', 'sonography', 'sonogram',
+           'doppler', 'echocardiography', 'echocardiogram', 'gray scale'],
+    'X-ray': ['x-ray', 'x ray', 'xray', 'radiograph', 'radiography', 'plain film',
+              'chest film', 'mammography', 'mammogram', 'fluoroscopy'],
+    'Angiography': ['angiography', 'angiogram', 'dsa', 'venography', 'arteriography'],
+    'Nuclear Medicine': ['nuclear medicine', 'pet', 'spect', 'scintigraphy',
+                         'bone scan', 'radionuclide'],
+    OTHER: [],
+}
+
+PLANE_VOCABULARY = {
+    'axial': ['axial', 'transverse', 'transaxial', 'horizontal'],
+    'coronal': ['coronal', 'frontal', 'anteroposterior', 'posteroanterior', 'ap', 'pa'],
+    'sagittal': ['sagittal', 'lateral'],
+    'oblique': ['oblique'],
+    OTHER: [],
+}
+
+BODY_PART_VOCABULARY = {
+    'head': ['head', 'brain', 'skull', 'cranial', 'intracranial', 'cerebral',
+             'orbit', 'orbits', 'face', 'facial', 'sinus', 'sinuses'],
+    'neck': ['neck', 'cervical', 'thyroid', 'larynx', 'pharynx'],
+    'spine': ['spine', 'spinal', 'vertebra', 'vertebrae', 'lumbar', 'thoracic spine',
+              'cervical spine', 'sacrum'],
+    'chest': ['chest', 'thorax', 'thoracic', 'lung', 'lungs', 'pulmonary', 'heart',
+              'cardiac', 'mediastinum', 'breast', 'breasts'],
+    'abdomen': ['abdomen', 'abdominal', 'liver', 'hepatic', 'kidney', 'kidneys',
+                'renal', 'pancreas', 'spleen', 'bowel', 'colon', 'stomach',
+                'gallbladder', 'biliary'],
+    'pelvis': ['pelvis', 'pelvic', 'hip', 'hips', 'bladder', 'uterus', 'prostate',
+               'ovary', 'scrotum', 'testis'],
+    'upper extremity': ['upper extremity', 'upper limb', 'arm', 'shoulder', 'elbow',
+                        'forearm', 'wrist', 'hand', 'hands', 'finger', 'fingers'],
+    'lower extremity': ['lower extremity', 'lower limb', 'leg', 'legs', 'thigh',
+                        'knee', 'knees', 'ankle', 'foot', 'feet', 'toe', 'toes'],
+    'whole body': ['whole body', 'whole-body', 'total body'],
+    OTHER: [],
+}
+
+# Field name in the model response -> (label column in NEJM_list.xlsx, vocabulary).
+FIELDS = {
+    '1_TypeOfMedicalImaging': ('Modality', MODALITY_VOCABULARY),
+    '4_ImagePlane': ('Plane', PLANE_VOCABULARY),
+    '5_PartOfTheBodyImaged': ('Body part', BODY_PART_VOCABULARY),
+}
+
+IMG_ONLY_FIELD_PATTERN = re.compile(
+    r'\{[^{}]*"1_TypeOfMedicalImaging":\s*"([^"]*)"[^{}]*'
+    r'"2_SpecificImagingSequence":\s*"([^"]*)"[^{}]*'
+    r'"3_UseOfContrast":\s*"([^"]*)"[^{}]*'
+    r'"4_ImagePlane":\s*"([^"]*)"[^{}]*'
+    r'"5_PartOfTheBodyImaged":\s*"([^"]*)"[^{}]*\}'
+)
+IMG_ONLY_FIELDS = [
+    '1_TypeOfMedicalImaging',
+    '2_SpecificImagingSequence',
+    '3_UseOfContrast',
+    '4_ImagePlane',
+    '5_PartOfTheBodyImaged',
+]
+
+# Splits "a.MR b.CT" / "a) MR, b) CT" enumerations into their items.
+ENUMERATION_PATTERN = re.compile(r'(?:^|[\s,;/])[a-h]\s*[.)]\s*|[,;/]|\band\b')
+
+# Aho-Corasick automaton: goto transitions, failure links and, per state, the
+# (phrase length, code) pairs of the phrases ending there.
+Matcher = namedtuple('Matcher', ['goto', 'fail', 'output'])
+
+
+def build_matcher(vocabulary):
+    """
+    Compiles the synonyms of a vocabulary into an Aho-Corasick automaton.
+
+    Parameters:
+    vocabulary (dict): Canonical label -> list of synonyms.
+
+    Returns:
+    Matcher: Automaton matching every synonym in a single pass over a text.
+    """
+    goto, fail, output = [{}], [0], [[]]
+    for code, (label, synonyms) in enumerate(vocabulary.items()):
+        for phrase in [label.lower(), *synonyms]:
+            state = 0
+            for char in phrase:
+                if char not in goto[state]:
+                    goto.append({})
+                    fail.append(0)
+                    output.append([])
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            if (len(phrase), code) not in output[state]:
+                output[state].append((len(phrase), code))
+
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for char, next_state in goto[state].items():
+            queue.append(next_state)
+            fallback = fail[state]
+            while fallback and char not in goto[fallback]:
+                fallback = fail[fallback]
+            fail[next_state] = goto[fallback].get(char, 0)
+            output[next_state] = output[next_state] + output[fail[next_state]]
+    return Matcher(goto, fail, output)
+
+
+def match_codes(matcher, text):
+    """
+    Finds the codes of all synonyms that occur as whole words in a text.
+
+    A match inside a longer match is ignored, so 'cervical spine' maps onto
+    'spine' only.
+
+    Returns:
+    set: Integer codes of the matched labels.
+    """
+    text = text.lower()
+    matches = []
+    state = 0
+    for end, char in enumerate(text):
+        while state and char not in matcher.goto[state]:
+            state = matcher.fail[state]
+        state = matcher.goto[state].get(char, 0)
+        for length, code in matcher.output[state]:
+            start = end - length + 1
+            before = text[start - 1] if start > 0 else ' '
+            after = text[end + 1] if end + 1 < len(text) else ' '
+            if not before.isalnum() and not after.isalnum():
+                matches.append((start, end, code))
+    return {
+        code for start, end, code in matches
+        if not any(
+            other_start <= start and end <= other_end
+            and (other_start, other_end) != (start, end)
+            for other_start, other_end, _ in matches
+        )
+    }
+
+
+def split_enumeration(text):
+    """
+    Splits an answer such as "a.MR b.CT" into its items.
+    """
+    if text is None or (isinstance(text, float) and np.isnan(text)):
+        return []
+    items = ENUMERATION_PATTERN.split(str(text))
+    return [item.strip(' .') for item in items if item and item.strip(' .')]
+
+
+def normalize(text, matcher, vocabulary):
+    """
+    Maps a free-text answer onto the codes of a fixed vocabulary.
+
+    Items that match no synonym are mapped onto the 'other' label.
+
+    Returns:
+    int: Bitmask with bit k set when label k of the vocabulary is present.
+    """
+    other = list(vocabulary).index(OTHER)
+    mask = 0
+    for item in split_enumeration(text):
+        codes = match_codes(matcher, item) or {other}
+        for code in codes:
+            mask |= 1 << code
+    return mask
+
+
+def normalize_column(texts, matcher, vocabulary):
+    """
+    Normalizes the answers of all cases of one field.
+
+    Returns:
+    ndarray: uint32 bitmasks of shape (case,).
+    """
+    return np.array(
+        [normalize(text, matcher, vocabulary) for text in texts], dtype=np.uint32
+    )
+
+
+def bitmasks_to_matrix(masks, n_labels):
+    """
+    Expands label bitmasks into a boolean multi-label matrix.
+
+    Returns:
+    ndarray: Boolean array of shape (case, label).
+    """
+    return ((masks[:, None] >> np.arange(n_labels, dtype=np.uint32)) & 1).astype(bool)
+
+
+def confusion_matrix(true_masks, pred_masks, n_labels, case_mask=None):
+    """
+    Counts (true label, predicted label) pairs over all cases.
+
+    For cases with a single label on both sides this is the usual confusion
+    matrix; with several labels every pair is counted once per case.
+
+    Parameters:
+    true_masks (ndarray): Label bitmasks of the radiologists.
+    pred_masks (ndarray): Label bitmasks of the model.
+    n_labels (int): Size of the vocabulary.
+    case_mask (ndarray): Cases to include; defaults to every labeled case
+    that the model answered.
+
+    Returns:
+    ndarray: int array of shape (true label, predicted label).
+    """
+    if case_mask is None:
+        case_mask = (true_masks > 0) & (pred_masks > 0)
+    true_matrix = bitmasks_to_matrix(true_masks[case_mask], n_labels).astype(np.int64)
+    pred_matrix = bitmasks_to_matrix(pred_masks[case_mask], n_labels).astype(np.int64)
+    return true_matrix.T @ pred_matrix
+
+
+def label_scores(true_masks, pred_masks, n_labels):
+    """
+    Computes the per-label and micro-averaged multi-label scores.
+
+    Returns:
+    dict: exact set match rate, micro precision/recall/F1 and per-label
+    true positive, false positive and false negative counts.
+    """
+    scored = true_masks > 0
+    true_matrix = bitmasks_to_matrix(true_masks[scored], n_labels)
+    pred_matrix = bitmasks_to_matrix(pred_masks[scored], n_labels)
+    tp = (true_matrix & pred_matrix).sum(axis=0)
+    fp = (~true_matrix & pred_matrix).sum(axis=0)
+    fn = (true_matrix & ~pred_matrix).sum(axis=0)
+    precision = tp.sum() / max(tp.sum() + fp.sum(), 1)
+    recall = tp.sum() / max(tp.sum() + fn.sum(), 1)
+    return {
+        'n_cases': int(scored.sum()),
+        'exact_match': (true_masks[scored] == pred_masks[scored]).mean() if scored.any() else np.nan,
+        'precision': precision,
+        'recall': recall,
+        'f1': 2 * precision * recall / max(precision + recall, 1e-12),
+        'tp': tp,
+        'fp': fp,
+        'fn': fn,
+    }
+
+
+def extract_img_only_fields(text):
+    """
+    Extracts the five image-only fields from a raw model response.
+
+    Returns:
+    dict: Field name -> answer text ('' when missing).
+    """
+    data = results.extract_json_fields(text) if text else None
+    if data is not None:
+        return {field: str(data.get(field, '')) for field in IMG_ONLY_FIELDS}
+    match = IMG_ONLY_FIELD_PATTERN.search(text or '')
+    if match:
+        return dict(zip(IMG_ONLY_FIELDS, match.groups()))
+    return {field: '' for field in IMG_ONLY_FIELDS}
+
+
+# Matchers are compiled once, at import time.
+MATCHERS = {field: build_matcher(vocabulary) for field, (_, vocabulary) in FIELDS.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--task-dir', default=results.TASK_FOLDERS['img-only'])
+    parser.add_argument('--models', nargs='*', default=list(results.MODEL_FOLDERS))
+    for field, (column, _) in FIELDS.items():
+        parser.add_argument(f'--{field[2:].lower()}-column', default=column,
+                            help=f'Case list column with the labels of {field}')
+    parser.add_argument('--output', default=CONFUSION_FILE)
+    args = parser.parse_args()
+
+    case_list = results.load_case_list(args.task_dir)
+    cases = results.case_numbers(case_list)
+    labels = {}
+    for field, (_, vocabulary) in FIELDS.items():
+        column = getattr(args, f'{field[2:].lower()}_column')
+        values = results.load_strata(case_list, cases, [column]).get(column)
+        if values is not None:
+            labels[field] = normalize_column(values, MATCHERS[field], vocabulary)
+
+    summary_rows = []
+    confusion_rows = []
+    for model in args.models:
+        base_folder = f"{args.task_dir}/{results.MODEL_FOLDERS[model]}"
+        for temperature, try_number, folder_path in results.find_runs(base_folder):
+            answers = [
+                extract_img_only_fields(results.read_result_text(folder_path, case))
+                for case in cases
+            ]
+            for field, true_masks in labels.items():
+                _, vocabulary = FIELDS[field]
+                names = list(vocabulary)
+                pred_masks = normalize_column(
+                    [answer[field] for answer in answers], MATCHERS[field], vocabulary
+                )
+                scores = label_scores(true_masks, pred_masks, len(names))
+                summary_rows.append({
+                    'model': model, 'temperature': temperature, 'try': try_number,
+                    'field': field,
+                    **{key: scores[key] for key in
+                       ('n_cases', 'exact_match', 'precision', 'recall', 'f1')},
+                })
+                matrix = confusion_matrix(true_masks, pred_masks, len(names))
+                for i, j in zip(*np.nonzero(matrix)):
+                    confusion_rows.append({
+                        'model': model, 'temperature': temperature, 'try': try_number,
+                        'field': field, 'true_label': names[i],
+                        'predicted_label': names[j], 'count': int(matrix[i, j]),
+                    })
+
+    with pd.ExcelWriter(args.output) as writer:
+        pd.DataFrame(summary_rows).to_excel(writer, sheet_name='summary', index=False)
+        pd.DataFrame(confusion_rows).to_excel(writer, sheet_name='confusion', index=False)
+    print(f"Category scores saved: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+Circuit breakers for the provider calls, one per (provider, model), or per
+key of the model with a key pool (nejm_vlm.keys).
+
+    closed     requests flow; consecutive outage errors are counted
+    open       after VLM_CIRCUIT_THRESHOLD consecutive outage errors (default
+               5), dispatch to the model pauses for a cool-down
+    half-open  after the cool-down one probe request is let through; success
+               closes the circuit, failure reopens it with a doubled cool-down
+
+Outage errors are server errors, overloads and timeouts. Any other outcome
+(even a refusal or an invalid request) shows that the model is reachable and
+closes the circuit. While a circuit is open, requests to that model wait
+instead of using up their retries. The unified runner goes through its
+models one after another, so it waits for the circuit to close; the
+work-queue workers (nejm_vlm.workqueue) do not wait (set_waiting()): the job
+goes back to the queue and the worker leases jobs of the other models, which
+keep going.
+
+    VLM_CIRCUIT_THRESHOLD  consecutive outage errors that open the circuit
+    VLM_CIRCUIT_COOLDOWN   first cool-down in seconds (default 30)
+"""
+import os
+import threading
+import time
+from collections import Counter
+
+from nejm_vlm import deadlines
+from nejm_vlm import shutdown
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+OUTAGE_CLASSES = ('transient', 'overloaded', 'timeout')
+
+DEFAULT_THRESHOLD = 5
+DEFAULT_COOLDOWN = 30.0
+MAX_COOLDOWN = 15 * 60
+
+metrics = Counter()
+_breakers = {}
+_lock = threading.Lock()
+_waiting = threading.local()
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of waiting for an open circuit: when a stop is requested
+    while waiting, or when the thread does not wait (see set_waiting()).
+    """
+
+
+def set_waiting(wait):
+    """
+    Sets whether the requests of the current thread wait for an open circuit
+    (the default) or fail at once with CircuitOpen.
+    """
+    _waiting.enabled = wait
+
+
+def waits():
+    return getattr(_waiting, 'enabled', True)
+
+
+class CircuitBreaker:
+    """
+    Tracks the health of one model and gates the requests to it.
+    """
+
+    def __init__(self, name, threshold=DEFAULT_THRESHOLD, cooldown=DEFAULT_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.condition = threading.Condition()
+
+    def acquire(self, block=None):
+        """
+        Blocks until a request may be sent.
+
+        Parameters:
+        block (bool): Whether to wait while the circuit is open (default: as
+        set for the thread by set_waiting()).
+
+        Returns:
+        bool: Whether the request is the half-open probe.
+
+        Raises:
+        CircuitOpen: The circuit is open and block is False, or a stop was
+        requested while waiting.
+        RunDeadlineExceeded: The run deadline passed while waiting.
+        """
+        if block is None:
+            block = waits()
+        with self.condition:
+            while True:
+                if self.state == CLOSED:
+                    return False
+                now = time.time()
+                if self.state == OPEN and now >= self.open_until:
+                    self.state = HALF_OPEN
+                if self.state == HALF_OPEN and not self.probing:
+                    self.probing = True
+                    print(f"Circuit {self.name}: half-open, sending a probe")
+                    return True
+                if not block:
+                    raise CircuitOpen(f"Circuit {self.name} is {self.state}")
+                if shutdown.requested():
+                    raise CircuitOpen(f"Circuit {self.name} is open and a stop was requested")
+                left = deadlines.remaining()
+                if left is not None and left <= 0:
+                    raise deadlines.RunDeadlineExceeded("Run deadline exceeded")
+                # Wake up at least every second to notice stop requests.
+                wait_time = self.open_until - now if self.state == OPEN else 1.0
+                self.condition.wait(timeout=max(0.01, min(1.0, wait_time)))
+
+    def record(self, probe, error_class=None):
+        """
+        Records the outcome of a request.
+
+        Parameters:
+        probe (bool): Whether the request was the half-open probe.
+        error_class (str): Error class of the attempt, None on success.
+        """
+        outage = error_class in OUTAGE_CLASSES
+        with self.condition:
+            if probe:
+                self.probing = False
+            if not outage:
+                if self.state != CLOSED:
+                    print(f"Circuit {self.name}: closed, resuming")
+                self.state = CLOSED
+                self.failures = 0
+                self.cooldown = self.base_cooldown
+            elif probe:
+                self.failures += 1
+                self.cooldown = min(MAX_COOLDOWN, self.cooldown * 2)
+                self._open()
+            elif self.state == CLOSED:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self._open()
+            self.condition.notify_all()
+
+    def release(self, probe):
+        """
+        Gives back a request slot without an outcome (the request never
+        reached the provider).
+        """
+        if probe:
+            with self.condition:
+                self.probing = False
+                self.condition.notify_all()
+
+    def ready_at(self):
+        """
+        Returns the time at which a request may be sent: now for a closed
+        circuit, the end of the cool-down for an open one.
+        """
+        with self.condition:
+            if self.state == CLOSED:
+                return 0.0
+            if self.state == OPEN:
+                return self.open_until
+            return float('inf') if self.probing else 0.0
+
+    def _open(self):
+        self.state = OPEN
+        self.open_until = time.time() + self.cooldown
+        metrics[(self.name, 'opened')] += 1
+        print(f"Circuit {self.name}: open after {self.failures} consecutive outage "
+              f"errors, probing again in {self.cooldown:g} seconds")
+
+
+def get_breaker(provider, model):
+    """
+    Returns the shared circuit breaker of a model, creating it on first use.
+    """
+    with _lock:
+        breaker = _breakers.get((provider, model))
+        if breaker is None:
+            breaker = _breakers[(provider, model)] = CircuitBreaker(
+                f"{provider} {model}",
+                int(os.getenv('VLM_CIRCUIT_THRESHOLD', DEFAULT_THRESHOLD)),
+                float(os.getenv('VLM_CIRCUIT_COOLDOWN', DEFAULT_COOLDOWN)),
+            )
+        return breaker
+
+
+def report():
+    """
+    Prints how often each circuit opened.
+    """
+    for (name, event), count in sorted(metrics.items()):
+        print(f"Circuit {name}: {event} {count} times")
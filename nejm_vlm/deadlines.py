@@ -0,0 +1,100 @@
+"""
+Per-request and per-run deadlines of the provider calls.
+
+    VLM_REQUEST_TIMEOUT  seconds a single attempt may take (default 300)
+    VLM_RUN_DEADLINE     seconds the whole run may take, counted from the
+                         start of the runner (default: no limit)
+
+The SDK clients get the request timeout too (see providers.py), so a hung
+connection is closed even after its attempt has been given up.
+"""
+import os
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+DEFAULT_REQUEST_TIMEOUT = 300.0
+
+_run_started = time.time()
+
+
+class AttemptTimedOut(Exception):
+    """
+    Raised when a single attempt takes longer than its timeout.
+    """
+
+
+class RunDeadlineExceeded(Exception):
+    """
+    Raised when the run deadline has passed.
+    """
+
+
+def request_timeout():
+    return float(os.getenv('VLM_REQUEST_TIMEOUT', DEFAULT_REQUEST_TIMEOUT))
+
+
+def remaining():
+    """
+    Returns the seconds left until the run deadline, or None without one.
+    """
+    seconds = os.getenv('VLM_RUN_DEADLINE')
+    if not seconds:
+        return None
+    return _run_started + float(seconds) - time.time()
+
+
+def attempt_timeout():
+    """
+    Returns the timeout of the next attempt: the request timeout, cut short
+    by the run deadline.
+
+    Raises:
+    RunDeadlineExceeded: The run deadline has passed.
+    """
+    timeout = request_timeout()
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise RunDeadlineExceeded("Run deadline exceeded")
+    return min(timeout, left)
+
+
+def sleep(seconds):
+    """
+    Sleeps unless the run deadline would pass first.
+
+    Raises:
+    RunDeadlineExceeded: The sleep would end after the run deadline.
+    """
+    left = remaining()
+    if left is not None and seconds >= left:
+        raise RunDeadlineExceeded(f"Run deadline exceeded ({left:.0f} seconds left)")
+    time.sleep(seconds)
+
+
+def call_with_timeout(function, timeout):
+    """
+    Calls a function on a worker thread and gives up on it after a timeout.
+
+    A timed-out call is abandoned: its thread runs until the SDK timeout
+    closes the connection, and its result is dropped.
+
+    Raises:
+    AttemptTimedOut: The call did not return in time.
+    """
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(function())
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        raise AttemptTimedOut(f"Request timed out after {timeout:.0f} seconds") from None
@@ -0,0 +1,230 @@
+"""
+Combines the answers of several models, temperatures and tries by voting.
+
+Usage (from the repository root):
+
+    python -m nejm_vlm.ensemble --threshold 0.6
+    python -m nejm_vlm.ensemble --task-dir 3_no-img_task --weights accuracy
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from nejm_vlm import results
+from nejm_vlm import scoring
+
+ENSEMBLE_FILE = 'ensemble_summary.xlsx'
+RERUN_FILE = 'rerun_cases.xlsx'
+WEIGHTING_METHODS = ('uniform', 'accuracy')
+
+
+def voter_matrix(tensor, model_indices=None):
+    """
+    Flattens the executed runs of an AnswerTensor into voters.
+
+    Parameters:
+    tensor (AnswerTensor): Answers loaded with results.load_answer_tensor().
+    model_indices (list): Models taking part in the vote; defaults to all.
+
+    Returns:
+    tuple: (answers, voter_models) where answers has shape (voter, case) and
+    voter_models holds the model index of every voter.
+    """
+    present = tensor.present.copy()
+    if model_indices is not None:
+        keep = np.zeros(len(tensor.models), dtype=bool)
+        keep[list(model_indices)] = True
+        present &= keep[:, None, None]
+    voters = np.nonzero(present)
+    return tensor.answers[voters], voters[0]
+
+
+def vote_counts(answers, weights=None, n_options=None):
+    """
+    Counts the (weighted) votes for every option of every case.
+
+    Parameters:
+    answers (ndarray): Option numbers of shape (voter, case), 0 = no answer.
+    weights (ndarray): Weight of every voter; defaults to 1.
+    n_options (int): Highest option number; defaults to the highest answer.
+
+    Returns:
+    ndarray: Vote totals of shape (case, option); column k is option k + 1.
+    """
+    if n_options is None:
+        n_options = max(int(answers.max()) if answers.size else 0, 1)
+    if weights is None:
+        weights = np.ones(answers.shape[0])
+    one_hot = answers[..., None] == np.arange(1, n_options + 1)
+    return np.einsum('v,vck->ck', np.asarray(weights, dtype=float), one_hot)
+
+
+def majority_vote(counts):
+    """
+    Picks the option with the most votes for every case.
+
+    Ties go to the lowest option number and are reported.
+
+    Parameters:
+    counts (ndarray): Vote totals of shape (case, option).
+
+    Returns:
+    tuple: (answer, agreement, tied) arrays of shape (case,). `answer` is 0
+    for cases without any vote, and `agreement` is the share of the votes
+    that went to the chosen option.
+    """
+    total = counts.sum(axis=1)
+    top = counts.max(axis=1)
+    answer = np.where(total > 0, counts.argmax(axis=1) + 1, 0)
+    agreement = np.divide(top, total, out=np.zeros_like(top, dtype=float), where=total > 0)
+    tied = (counts == top[:, None]).sum(axis=1) > 1
+    return answer, agreement, tied & (total > 0)
+
+
+def gated_vote(counts, threshold=0.6):
+    """
+    Majority vote that abstains (answer 0) below the agreement threshold.
+
+    Returns:
+    tuple: (answer, agreement) arrays of shape (case,).
+    """
+    answer, agreement, tied = majority_vote(counts)
+    keep = (agreement >= threshold) & ~tied
+    return np.where(keep, answer, 0), agreement
+
+
+def accuracy_weights(answers, labels, n_options):
+    """
+    Weights every voter by the log-odds of its own accuracy.
+
+    A voter at chance level (1 / n_options) gets weight 0. The weights are
+    estimated on the same cases they are applied to, so the weighted
+    ensemble accuracy is optimistic.
+
+    Returns:
+    ndarray: Non-negative weights of shape (voter,).
+    """
+    acc = scoring.correctness(answers, labels).mean(axis=1)
+    acc = np.clip(acc, 1e-3, 1 - 1e-3)
+    weights = np.log(acc * (n_options - 1) / (1 - acc))
+    return np.maximum(weights, 0.0)
+
+
+def ensemble_results(tensor, labels, threshold=0.6, weighting='uniform'):
+    """
+    Builds the majority, weighted and agreement-gated ensembles of every
+    model across its temperatures and tries, and of all models together.
+
+    Parameters:
+    tensor (AnswerTensor): Answers loaded with results.load_answer_tensor().
+    labels (ndarray): Correct option numbers of shape (case,).
+    threshold (float): Minimum agreement of the gated vote.
+    weighting (str): 'uniform' or 'accuracy' weights of the weighted vote.
+
+    Returns:
+    tuple: (summary, per_case) DataFrames.
+    """
+    n_options = max(int(tensor.answers.max()), int(labels.max()), 1)
+    groups = [(model, [m]) for m, model in enumerate(tensor.models)]
+    groups.append(('all', None))
+
+    summary_rows = []
+    per_case = {'case_number': tensor.cases, 'label': labels}
+    for name, model_indices in groups:
+        answers, _ = voter_matrix(tensor, model_indices)
+        if answers.shape[0] == 0:
+            continue
+
+        counts = vote_counts(answers, None, n_options)
+        majority, agreement, tied = majority_vote(counts)
+
+        if weighting == 'accuracy':
+            weights = accuracy_weights(answers, labels, n_options)
+        else:
+            weights = np.ones(answers.shape[0])
+        weighted, _, _ = majority_vote(vote_counts(answers, weights, n_options))
+        gated, _ = gated_vote(counts, threshold)
+
+        answered = gated > 0
+        summary_rows.append({
+            'ensemble': name,
+            'voters': answers.shape[0],
+            'majority_accuracy': scoring.correctness(majority, labels).mean(),
+            'weighted_accuracy': scoring.correctness(weighted, labels).mean(),
+            'gated_coverage': answered.mean(),
+            'gated_accuracy': (
+                scoring.correctness(gated, labels)[answered].mean()
+                if answered.any() else np.nan
+            ),
+            'mean_agreement': agreement.mean(),
+            'ties': int(tied.sum()),
+            'low_agreement_cases': int((agreement < threshold).sum()),
+        })
+        per_case[f'{name}_majority'] = majority
+        per_case[f'{name}_weighted'] = weighted
+        per_case[f'{name}_agreement'] = agreement
+
+    return pd.DataFrame(summary_rows), pd.DataFrame(per_case)
+
+
+def low_agreement_cases(per_case, models, threshold=0.6):
+    """
+    Lists the cases whose per-model agreement is below the threshold.
+
+    Parameters:
+    per_case (DataFrame): Per-case table returned by ensemble_results().
+    models (list): Model names to check.
+    threshold (float): Minimum agreement.
+
+    Returns:
+    DataFrame: One row per (model, case) to rerun.
+    """
+    frames = []
+    for model in models:
+        column = f'{model}_agreement'
+        if column not in per_case:
+            continue
+        flagged = per_case[per_case[column] < threshold]
+        frames.append(pd.DataFrame({
+            'model': model,
+            'case_number': flagged['case_number'],
+            'agreement': flagged[column],
+        }))
+    if not frames:
+        return pd.DataFrame(columns=['model', 'case_number', 'agreement'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--task-dir', default='.')
+    parser.add_argument('--models', nargs='*', default=list(results.MODEL_FOLDERS))
+    parser.add_argument('--answer-column', default=results.ANSWER_COLUMN)
+    parser.add_argument('--threshold', type=float, default=0.6,
+                        help='Minimum agreement of the gated vote')
+    parser.add_argument('--weights', default='uniform', choices=WEIGHTING_METHODS)
+    parser.add_argument('--output', default=ENSEMBLE_FILE)
+    parser.add_argument('--rerun-output', default=RERUN_FILE)
+    args = parser.parse_args()
+
+    case_list = results.load_case_list(args.task_dir)
+    cases = results.case_numbers(case_list)
+    labels = results.load_labels(case_list, cases, args.answer_column)
+    tensor = results.load_answer_tensor(args.task_dir, args.models, cases)
+
+    summary, per_case = ensemble_results(tensor, labels, args.threshold, args.weights)
+    print(summary.to_string(index=False))
+
+    with pd.ExcelWriter(args.output) as writer:
+        summary.to_excel(writer, sheet_name='summary', index=False)
+        per_case.to_excel(writer, sheet_name='cases', index=False)
+    print(f"Ensemble results saved: {args.output}")
+
+    reruns = low_agreement_cases(per_case, tensor.models, args.threshold)
+    reruns.to_excel(args.rerun_output, index=False)
+    print(f"{len(reruns)} low-agreement (model, case) pairs saved: {args.rerun_output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Hedged requests and the live latency recorder of the provider calls.
+
+Every successful request records its latency per (provider, model). For
+idempotent requests (temperature 0, or answered from the cache) hedging can
+be turned on: when a request is still running after the model's observed p95
+latency, a duplicate is sent and the first usable answer wins.
+
+    VLM_HEDGE_BUDGET   largest share of requests that may be hedged, in
+                       percent (default 0: hedging off)
+
+Hedging starts once MIN_SAMPLES latencies have been recorded for the model.
+report() compares the latency tail of the first requests with the latency
+the callers actually saw.
+"""
+import os
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+MIN_SAMPLES = 20
+WINDOW = 500
+HEDGE_PERCENTILE = 95
+REPORT_PERCENTILES = (50, 95, 99)
+
+metrics = Counter()
+_recorders = {}
+_lock = threading.Lock()
+
+
+def percentile(values, q):
+    """
+    Returns the q-th percentile of a list of numbers (nearest rank).
+    """
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+class LatencyRecorder:
+    """
+    Keeps the latest latencies of one model.
+
+    Attributes:
+    samples (deque): Latencies of all successful requests (the live recorder).
+    primary (list): Latencies of the first request of every call.
+    observed (list): Latencies the callers saw, hedged or not.
+    """
+
+    def __init__(self, window=WINDOW):
+        self.samples = deque(maxlen=window)
+        self.primary = []
+        self.observed = []
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def record_call(self, primary_seconds=None, observed_seconds=None):
+        with self.lock:
+            if primary_seconds is not None:
+                self.primary.append(primary_seconds)
+            if observed_seconds is not None:
+                self.observed.append(observed_seconds)
+
+    def threshold(self):
+        """
+        Returns the hedging delay (the p95 latency), or None without enough samples.
+        """
+        with self.lock:
+            if len(self.samples) < MIN_SAMPLES:
+                return None
+            return percentile(self.samples, HEDGE_PERCENTILE)
+
+
+def get_recorder(provider, model):
+    with _lock:
+        recorder = _recorders.get((provider, model))
+        if recorder is None:
+            recorder = _recorders[(provider, model)] = LatencyRecorder()
+        return recorder
+
+
+def hedge_budget():
+    """
+    Returns the hedge budget as a fraction of the requests.
+    """
+    return float(os.getenv('VLM_HEDGE_BUDGET', '0')) / 100
+
+
+def _take_hedge(provider, model):
+    """
+    Reserves a hedge if the budget allows another one.
+    """
+    with _lock:
+        calls = metrics[(provider, model, 'calls')]
+        hedges = metrics[(provider, model, 'hedges')]
+        if hedges + 1 > hedge_budget() * calls:
+            return False
+        metrics[(provider, model, 'hedges')] += 1
+        return True
+
+
+def _start(send_once, recorder):
+    """
+    Runs send_once on a daemon thread and records its latency.
+
+    Returns:
+    tuple: (future, start_time)
+    """
+    future = Future()
+    start_time = time.time()
+
+    def run():
+        try:
+            result = send_once()
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            recorder.record(time.time() - start_time)
+            future.set_result(result)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future, start_time
+
+
+def call(send_once, provider, model, hedge=False):
+    """
+    Sends one request, hedging it if it is slow and the budget allows.
+
+    Parameters:
+    send_once (function): Zero-argument function sending the request; it
+    raises for an unusable response, so that the other request may still win.
+    provider (str): 'openai', 'anthropic' or 'gemini'.
+    model (str): Model name.
+    hedge (bool): Whether the request is idempotent and may be duplicated.
+
+    Returns:
+    object: The first usable response.
+    """
+    recorder = get_recorder(provider, model)
+    with _lock:
+        metrics[(provider, model, 'calls')] += 1
+    threshold = recorder.threshold() if hedge and hedge_budget() > 0 else None
+    if threshold is None:
+        start_time = time.time()
+        response = send_once()
+        elapsed = time.time() - start_time
+        recorder.record(elapsed)
+        recorder.record_call(elapsed, elapsed)
+        return response
+
+    primary, start_time = _start(send_once, recorder)
+    primary.add_done_callback(
+        lambda future: recorder.record_call(primary_seconds=time.time() - start_time)
+    )
+    done, _ = wait([primary], timeout=threshold)
+    pending = [primary]
+    if not done and _take_hedge(provider, model):
+        hedge_future, _ = _start(send_once, recorder)
+        pending.append(hedge_future)
+
+    error = None
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+            if future.exception() is None:
+                if future is not primary:
+                    metrics[(provider, model, 'hedge_wins')] += 1
+                recorder.record_call(observed_seconds=time.time() - start_time)
+                return future.result()
+            error = error or future.exception()
+    recorder.record_call(observed_seconds=time.time() - start_time)
+    raise error
+
+
+def report():
+    """
+    Prints the hedge counts and the tail latency with and without hedging.
+    """
+    with _lock:
+        recorders = sorted(_recorders.items())
+    for (provider, model), recorder in recorders:
+        hedges = metrics[(provider, model, 'hedges')]
+        if not hedges:
+            continue
+        with recorder.lock:
+            primary, observed = list(recorder.primary), list(recorder.observed)
+        calls = metrics[(provider, model, 'calls')]
+        print(f"Hedging {provider} {model}: {hedges}/{calls} requests hedged, "
+              f"{metrics[(provider, model, 'hedge_wins')]} hedges won")
+        for q in REPORT_PERCENTILES:
+            print(f"  p{q}: {percentile(primary, q):.2f} s unhedged, "
+                  f"{percentile(observed, q):.2f} s hedged")
@@ -0,0 +1,161 @@
+"""
+API key pools: spreading the requests of a provider over several keys.
+
+    OPENAI_API_KEYS      comma-separated OpenAI keys
+    ANTHROPIC_API_KEYS   comma-separated Anthropic keys
+    GOOGLE_API_KEYS      comma-separated Gemini keys
+
+Without a pool (fewer than two keys), the single-key variables of
+providers.py are used as before. With a pool, every key gets its own pacer
+(nejm_vlm.pacing), circuit breaker (nejm_vlm.circuit) and quota pause, and
+every attempt is scheduled on the least-loaded key: among the keys that can
+send now (not paused, circuit not open, not held back by pacing) the one with
+the fewest requests in flight, ties going to the key used least. Throughput
+then grows with the number of keys.
+
+The keys are never printed; they are called key1, key2, ... in the output.
+"""
+import os
+import threading
+import time
+from collections import Counter
+
+from nejm_vlm import circuit
+from nejm_vlm import pacing
+
+POOL_VARIABLES = {
+    'openai': 'OPENAI_API_KEYS',
+    'anthropic': 'ANTHROPIC_API_KEYS',
+    'gemini': 'GOOGLE_API_KEYS',
+}
+
+metrics = Counter()
+_pauses = {}
+_lock = threading.Lock()
+_current = threading.local()
+
+
+def pool(provider):
+    """
+    Returns the keys of a provider's pool, or an empty list without a pool.
+    """
+    keys = [key.strip() for key in os.getenv(POOL_VARIABLES[provider], '').split(',')]
+    keys = [key for key in keys if key]
+    return keys if len(keys) > 1 else []
+
+
+def labels(provider):
+    """
+    Returns the labels of a provider's keys: ['key1', 'key2', ...], or [None]
+    when the provider has a single key.
+    """
+    keys = pool(provider)
+    if not keys:
+        return [None]
+    return [f"key{index}" for index in range(1, len(keys) + 1)]
+
+
+def ready_at(provider, model):
+    """
+    Returns the earliest time at which the circuit breakers let a request to
+    a model through on one of the provider's keys (0 when one is closed).
+    """
+    return min(
+        circuit.get_breaker(provider, lane(model, label)).ready_at()
+        for label in labels(provider)
+    )
+
+
+def api_key(provider, label):
+    """
+    Returns the key behind a label (None for the single-key default).
+    """
+    if label is None:
+        return None
+    return pool(provider)[int(label[len('key'):]) - 1]
+
+
+def lane(model, label):
+    """
+    Returns the name under which a model is paced and circuit-broken on a key.
+    """
+    return model if label is None else f"{model} ({label})"
+
+
+def pause(provider, label, seconds):
+    """
+    Pauses every request on a key for the given time (quota errors).
+    """
+    with _lock:
+        _pauses[(provider, label)] = max(_pauses.get((provider, label), 0),
+                                         time.time() + seconds)
+
+
+def paused_until(provider, label):
+    with _lock:
+        return _pauses.get((provider, label), 0)
+
+
+def spare(provider, label):
+    """
+    Tells whether another key of the pool is not paused, so that a key with
+    an exhausted quota can be parked instead of stopping the run.
+    """
+    now = time.time()
+    return any(other != label and paused_until(provider, other) <= now
+               for other in labels(provider))
+
+
+def choose(provider, model):
+    """
+    Schedules an attempt on the least-loaded key of a provider.
+
+    Returns:
+    str: Label of the chosen key (None without a pool).
+    """
+    candidates = labels(provider)
+    if len(candidates) == 1:
+        return candidates[0]
+    now = time.time()
+
+    def load(label):
+        name = lane(model, label)
+        pacer = pacing.get_pacer(provider, name)
+        ready_at = max(now, _pauses.get((provider, label), 0),
+                       circuit.get_breaker(provider, name).ready_at(), pacer.next_send)
+        return ready_at, pacer.in_flight, metrics[(provider, model, label)]
+
+    with _lock:
+        label = min(candidates, key=load)
+        metrics[(provider, model, label)] += 1
+    return label
+
+
+def using(provider, label, function, *args):
+    """
+    Calls a function with the provider's pooled clients bound to a key on
+    this thread.
+    """
+    setattr(_current, provider, label)
+    try:
+        return function(*args)
+    finally:
+        setattr(_current, provider, None)
+
+
+def current(provider):
+    """
+    Returns the key label bound on this thread, or the first key.
+    """
+    return getattr(_current, provider, None) or labels(provider)[0]
+
+
+def report():
+    """
+    Prints how many attempts every pooled key was given.
+    """
+    if not metrics:
+        return
+    print("Key pools:")
+    for (provider, model, label), count in sorted(metrics.items()):
+        print(f"  {provider} {model} {label}: {count} attempts")
@@ -0,0 +1,231 @@
+"""
+Answer distributions from the log probabilities of OpenAI answer tokens.
+
+Estimating how stable an answer is used to take repeated tries at
+temperature 1. With `python -m nejm_vlm.runner --logprobs K`, the OpenAI
+requests ask for the K most likely alternatives of every output token
+(top_logprobs, at most 20), and one call gives the model's distribution
+over the option numbers. The answer token is the first token holding a
+number after the "answer" key that holds the option of the parsed answer
+(a free-text response may hold other numbers after an "answer" key). The alternatives of that token that are option numbers make
+up the distribution, which is saved next to the case's result file
+(img_page<n>_0.png.logprobs.json):
+
+    {"answer": 3, "distribution": {"3": 0.93, "1": 0.05, "4": 0.02}, "coverage": 0.998}
+
+coverage is the probability mass of the option-number alternatives, over
+which the distribution is normalized. Responses replayed from the request
+cache carry logprobs only if they were recorded with the same K.
+
+Usage (from the repository root):
+
+    python -m nejm_vlm.logprobs
+    python -m nejm_vlm.logprobs --task-dir 3_no-img_task --models gpt4o
+
+This writes a calibration summary per run: accuracy of the most likely
+option, mean confidence, Brier score, expected calibration error, and
+the expected agreement of two samples (the sum of the squared option
+probabilities), which stands in for the consensus of repeated tries.
+"""
+import argparse
+import json
+import math
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from nejm_vlm import results
+
+MAX_TOP_LOGPROBS = 20
+SUMMARY_FILE = 'logprob_summary.xlsx'
+CALIBRATION_BINS = 10
+# A token holding an option number, possibly with the quote or space before it.
+OPTION_TOKEN = re.compile(r'^\W*(\d+)\W*$')
+ANSWER_KEY = re.compile(r'"answer"\s*:\s*"?[^"\d]*$')
+# Result folder suffixes of the reason and answer-only runs (see nejm_vlm.runner).
+RUN_SUFFIXES = ('', '_answer_only')
+
+
+def distribution_file_path(folder_path, case_number):
+    """
+    Returns the path of the answer distribution of a case.
+    """
+    return os.path.join(folder_path, f'img_page{case_number}_0.png.logprobs.json')
+
+
+def field(item, name):
+    # Responses rebuilt from the request cache may hold plain dicts.
+    return item.get(name) if isinstance(item, dict) else getattr(item, name, None)
+
+
+def answer_distribution(response):
+    """
+    Extracts the distribution over the option numbers of the answer token of
+    an OpenAI response.
+
+    Returns:
+    dict: {"answer", "distribution", "coverage"} (see the module docstring),
+    or None when the response has no logprobs, or no answer token holding
+    the option of the parsed answer.
+    """
+    choices = field(response, 'choices') or []
+    logprobs = field(choices[0], 'logprobs') if choices else None
+    content = (field(logprobs, 'content') if logprobs else None) or []
+    answer = results.parse_option_number(results.extract_answer_and_reason(
+        ''.join(field(token, 'token') or '' for token in content)
+    )['answer'])
+    text = ''
+    for token in content:
+        token_text = field(token, 'token') or ''
+        match = OPTION_TOKEN.match(token_text)
+        if match and ANSWER_KEY.search(text) and int(match.group(1)) == answer:
+            probabilities = {}
+            for alternative in field(token, 'top_logprobs') or []:
+                option = OPTION_TOKEN.match(field(alternative, 'token') or '')
+                if option:
+                    number = int(option.group(1))
+                    probabilities[number] = probabilities.get(number, 0.0) + \
+                        math.exp(field(alternative, 'logprob'))
+            coverage = sum(probabilities.values())
+            if not coverage:
+                return None
+            return {
+                'answer': int(match.group(1)),
+                'distribution': {
+                    str(number): probability / coverage
+                    for number, probability in sorted(
+                        probabilities.items(), key=lambda item: -item[1]
+                    )
+                },
+                'coverage': coverage,
+            }
+        text += token_text
+    return None
+
+
+def save_distribution(folder_path, case_number, distribution):
+    with open(distribution_file_path(folder_path, case_number), 'w', encoding='utf-8') as file:
+        json.dump(distribution, file)
+
+
+def load_distributions(folder_path, cases, n_options):
+    """
+    Loads the answer distributions of a run.
+
+    Returns:
+    ndarray: Probabilities of shape (case, option), column k being option
+    k + 1; NaN rows for cases without a distribution.
+    """
+    probabilities = np.full((len(cases), n_options), np.nan)
+    for c, case_number in enumerate(cases):
+        try:
+            with open(distribution_file_path(folder_path, case_number), 'r',
+                      encoding='utf-8') as file:
+                distribution = json.load(file)['distribution']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            continue
+        probabilities[c] = 0.0
+        for number, probability in distribution.items():
+            if 1 <= int(number) <= n_options:
+                probabilities[c, int(number) - 1] = probability
+    return probabilities
+
+
+def expected_calibration_error(confidence, correct, n_bins=CALIBRATION_BINS):
+    """
+    Computes the expected calibration error of the most likely options.
+
+    Parameters:
+    confidence (ndarray): Probability of the most likely option per case.
+    correct (ndarray): Whether that option is the label, per case.
+    n_bins (int): Number of equal-width confidence bins.
+    """
+    bins = np.minimum((confidence * n_bins).astype(int), n_bins - 1)
+    error = 0.0
+    for b in range(n_bins):
+        in_bin = bins == b
+        if in_bin.any():
+            error += in_bin.mean() * abs(confidence[in_bin].mean() - correct[in_bin].mean())
+    return error
+
+
+def calibration_results(task_dir, models, cases, labels):
+    """
+    Scores the answer distributions of every run of the given models.
+
+    Returns:
+    tuple: (summary, per_case) DataFrames.
+    """
+    n_options = max(int(labels.max()) if labels.size else 0, 5)
+    summary_rows = []
+    per_case = []
+    for model in models:
+        base_folder = os.path.join(task_dir, results.MODEL_FOLDERS[model])
+        for suffix in RUN_SUFFIXES:
+            for temperature, try_number, folder_path in results.find_runs(base_folder + suffix):
+                probabilities = load_distributions(folder_path, cases, n_options)
+                scored = ~np.isnan(probabilities).any(axis=1)
+                if not scored.any():
+                    continue
+                probabilities, scored_labels = probabilities[scored], labels[scored]
+                predicted = probabilities.argmax(axis=1) + 1
+                confidence = probabilities.max(axis=1)
+                correct = predicted == scored_labels
+                one_hot = scored_labels[:, None] == np.arange(1, n_options + 1)
+                agreement = (probabilities ** 2).sum(axis=1)
+                run = os.path.basename(folder_path)
+                summary_rows.append({
+                    'model': model,
+                    'run': run,
+                    'temperature': temperature,
+                    'try': try_number,
+                    'cases': int(scored.sum()),
+                    'accuracy': correct.mean(),
+                    'mean_confidence': confidence.mean(),
+                    'brier': ((probabilities - one_hot) ** 2).sum(axis=1).mean(),
+                    'ece': expected_calibration_error(confidence, correct),
+                    'expected_agreement': agreement.mean(),
+                })
+                per_case.append(pd.DataFrame({
+                    'model': model,
+                    'run': run,
+                    'case_number': np.asarray(cases)[scored],
+                    'label': scored_labels,
+                    'predicted': predicted,
+                    'confidence': confidence,
+                    'expected_agreement': agreement,
+                    **{f'p{k + 1}': probabilities[:, k] for k in range(n_options)},
+                }))
+    per_case = pd.concat(per_case, ignore_index=True) if per_case else pd.DataFrame()
+    return pd.DataFrame(summary_rows), per_case
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--task-dir', default='.')
+    parser.add_argument('--models', nargs='*', default=['gpt4v', 'gpt4o'],
+                        choices=list(results.MODEL_FOLDERS))
+    parser.add_argument('--answer-column', default=results.ANSWER_COLUMN)
+    parser.add_argument('--output', default=SUMMARY_FILE)
+    args = parser.parse_args()
+
+    case_list = results.load_case_list(args.task_dir)
+    cases = results.case_numbers(case_list)
+    labels = results.load_labels(case_list, cases, args.answer_column)
+
+    summary, per_case = calibration_results(args.task_dir, args.models, cases, labels)
+    if summary.empty:
+        print("No answer distributions found; run the OpenAI models with --logprobs first.")
+        return
+    print(summary.to_string(index=False))
+
+    with pd.ExcelWriter(args.output) as writer:
+        summary.to_excel(writer, sheet_name='summary', index=False)
+        per_case.to_excel(writer, sheet_name='cases', index=False)
+    print(f"Calibration results saved: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,903 @@
+"""
+Local stand-in for the OpenAI, Anthropic and Gemini APIs.
+
+Answers the chat-completions, messages and generateContent requests sent by
+the runners with canned JSON answers, after a configurable latency and with
+configurable fault injection. Point the runners at it with
+
+    VLM_BASE_URL=http://127.0.0.1:8089
+
+Usage:
+
+    python -m nejm_vlm.mock_server --latency lognormal:1.5,0.6 --rate-limit 0.05
+    python -m nejm_vlm.mock_server --rpm 60 --server-error 0.02 --refusal 0.01
+
+The OpenAI Files and Batch endpoints and the Anthropic Message Batches
+endpoints are served too: a batch answers every one of its requests (with the
+same fault injection, minus the rpm limit) and reports itself completed or
+ended after --batch-delay seconds.
+
+Gemini File API uploads (POST /upload/v1beta/files) are kept for --file-ttl
+seconds; a generateContent request referencing a missing or expired file is
+answered with 400, as by the live API.
+
+Prompt caching is simulated for OpenAI (the leading text block, from
+--min-cache-tokens tokens on) and Anthropic (the prefix up to a block with
+cache_control): a prefix seen before is reported as cached tokens in the
+usage of the response.
+
+Schema-constrained requests (OpenAI json_schema response_format, a forced
+Anthropic tool, a Gemini responseSchema) are answered in the requested form,
+a tool_use block for Anthropic. The other answers come out as malformed
+free-text JSON (code fences, trailing commas, raw line breaks, truncation)
+with probability --malformed.
+
+Answer-only prompts get the option number alone, cut at the request's stop
+sequences, and --token-latency adds a delay per output token, so that the
+latency of short answers can be compared with that of answers with reasons.
+
+OpenAI requests with logprobs get token logprobs: the tokens of the option
+numbers have the other options as alternatives, every other token is certain.
+
+GET /stats returns the request and fault counters as JSON.
+"""
+import argparse
+import base64
+import email.parser
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 8089
+REFUSAL_TEXT = "I'm sorry, but I can't help with that request."
+IMG_ONLY_MARKER = '1_TypeOfMedicalImaging'
+PACKED_MARKER = '"answers": ['
+PACKED_CASE = re.compile(r'^Case (\d+):', re.MULTILINE)
+
+GEMINI_PATH = re.compile(r'^/v1(?:beta)?/models/(?P<model>[^:/]+):generateContent$')
+OPENAI_BATCH_PATH = re.compile(r'^/v1/batches/(?P<batch_id>[^/]+)$')
+OPENAI_FILE_PATH = re.compile(r'^/v1/files/(?P<file_id>[^/]+)(?P<content>/content)?$')
+GEMINI_FILE_PATH = re.compile(r'^/v1(?:beta)?/(?P<name>files/[^/:]+)$')
+ANTHROPIC_BATCH_PATH = re.compile(
+    r'^/v1/messages/batches/(?P<batch_id>[^/]+)(?P<results>/results)?$'
+)
+
+# Fault name -> (HTTP status, OpenAI error, Anthropic error type, Gemini status, message)
+FAULTS = {
+    'rate_limit': (429, 'rate_limit_exceeded', 'rate_limit_error', 'RESOURCE_EXHAUSTED',
+                   'Rate limit reached for requests. Please try again in 1s.'),
+    'quota': (429, 'insufficient_quota', 'rate_limit_error', 'RESOURCE_EXHAUSTED',
+              'You exceeded your current quota, please check your plan and billing details.'),
+    'server_error': (500, 'server_error', 'api_error', 'INTERNAL',
+                     'The server had an error while processing your request.'),
+    'overloaded': (529, 'server_error', 'overloaded_error', 'UNAVAILABLE',
+                   'The service is temporarily overloaded.'),
+    'image_parse_error': (400, 'image_parse_error', 'invalid_request_error', 'INVALID_ARGUMENT',
+                          'image_parse_error: The image could not be processed.'),
+}
+
+
+def parse_latency(spec):
+    """
+    Parses a latency distribution such as 'fixed:0.5', 'uniform:0.2,2',
+    'lognormal:1.5,0.6' (median, sigma) or 'exponential:1.0' (mean).
+
+    Returns:
+    function: Zero-argument function drawing a latency in seconds.
+    """
+    name, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(',') if value]
+    if name == 'fixed':
+        return lambda: values[0] if values else 0.0
+    if name == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if name == 'lognormal':
+        median, sigma = values
+        return lambda: median * random.lognormvariate(0.0, sigma)
+    if name == 'exponential':
+        return lambda: random.expovariate(1.0 / values[0])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def request_text(provider, body):
+    """
+    Concatenates the text parts of a request body.
+    """
+    parts = []
+    if provider == 'gemini':
+        for content in body.get('contents', []):
+            parts.extend(part.get('text', '') for part in content.get('parts', []))
+        return '\n'.join(parts)
+    for message in body.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(part.get('text', '') for part in content or [] if isinstance(part, dict))
+    system = body.get('system')
+    if isinstance(system, str):
+        parts.insert(0, system)
+    elif isinstance(system, list):
+        parts[:0] = [part.get('text', '') for part in system]
+    return '\n'.join(parts)
+
+
+def canned_answer(prompt, temperature, pack_drop=0.0):
+    """
+    Builds a model-like JSON answer for a prompt.
+
+    At temperature 0 the answer is a deterministic function of the prompt. A
+    packed prompt (several questions) gets one element per case, each left
+    out with probability pack_drop.
+    """
+    seed = int(hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:8], 16)
+    rng = random.Random(seed if not temperature else None)
+    if PACKED_MARKER in prompt:
+        return json.dumps({'answers': [
+            {
+                'case': int(case_number),
+                'answer': str(rng.randint(1, 5)),
+                'reason': 'Mock response: the findings are most consistent with this option.',
+            }
+            for case_number in PACKED_CASE.findall(prompt) if rng.random() >= pack_drop
+        ]})
+    if IMG_ONLY_MARKER in prompt:
+        return json.dumps({
+            '1_TypeOfMedicalImaging': rng.choice(['CT', 'MR', 'X-ray', 'US', 'a.MR b.CT']),
+            '2_SpecificImagingSequence': rng.choice(['postcontrast', 'T2WI', 'gray scale']),
+            '3_UseOfContrast': rng.choice(['Yes', 'No']),
+            '4_ImagePlane': rng.choice(['axial', 'coronal', 'sagittal', 'a.axial b.coronal']),
+            '5_PartOfTheBodyImaged': rng.choice(['head', 'chest', 'abdomen', 'a.head b.neck']),
+        })
+    if '"reason"' not in prompt:
+        return json.dumps({'answer': str(rng.randint(1, 5))})
+    return json.dumps({
+        'answer': str(rng.randint(1, 5)),
+        'reason': 'Mock response: the imaging findings are most consistent with this option.',
+    })
+
+
+def malform(text, rng):
+    """
+    Damages a JSON answer the way free-text model output does.
+    """
+    defect = rng.choice(['fence', 'line_break', 'truncation'])
+    if defect == 'fence':
+        return f"```json\n{text[:-1]}, }}\n```"
+    if defect == 'line_break':
+        return "Here is my answer:\n" + text.replace(': the ', ':\nthe ')
+    return text[:-2]
+
+
+def stop_sequences(provider, body):
+    """
+    Returns the stop sequences of a request.
+    """
+    if provider == 'openai':
+        stop = body.get('stop') or []
+        return [stop] if isinstance(stop, str) else stop
+    if provider == 'anthropic':
+        return body.get('stop_sequences') or []
+    return (body.get('generationConfig') or {}).get('stopSequences') or []
+
+
+def cut_at_stop(text, stops):
+    """
+    Cuts a text before the first stop sequence it contains.
+
+    Returns:
+    tuple: (text, the stop sequence found or None)
+    """
+    found = [(text.index(stop), stop) for stop in stops if stop and stop in text]
+    if not found:
+        return text, None
+    position, stop = min(found)
+    return text[:position], stop
+
+
+def token_logprobs(text, top_logprobs, rng):
+    """
+    Builds the chat-completions logprobs of an answer text.
+    """
+    def entry(token, logprob):
+        return {'token': token, 'logprob': logprob, 'bytes': list(token.encode('utf-8'))}
+
+    content = []
+    for token in re.findall(r'\d+|\w+|\s+|[^\w\s]+', text):
+        if token.isdigit():
+            chosen = rng.uniform(0.4, 0.99)
+            others = [str(option) for option in range(1, 6) if str(option) != token]
+            weights = [rng.random() for _ in others]
+            alternatives = [(token, chosen)] + [
+                (option, (1 - chosen) * weight / sum(weights))
+                for option, weight in zip(others, weights)
+            ]
+        else:
+            alternatives = [(token, 1.0)]
+        alternatives.sort(key=lambda alternative: -alternative[1])
+        content.append({
+            **entry(token, math.log(dict(alternatives)[token])),
+            'top_logprobs': [
+                entry(option, math.log(probability))
+                for option, probability in alternatives[:top_logprobs]
+            ],
+        })
+    return {'content': content}
+
+
+def output_tokens(provider, response):
+    if provider == 'openai':
+        return response['usage']['completion_tokens']
+    if provider == 'anthropic':
+        return response['usage']['output_tokens']
+    return response['usageMetadata']['candidatesTokenCount']
+
+
+def constrained(provider, body):
+    """
+    Tells whether a request constrains its answer to a schema.
+    """
+    if provider == 'openai':
+        return (body.get('response_format') or {}).get('type') == 'json_schema'
+    if provider == 'anthropic':
+        return (body.get('tool_choice') or {}).get('type') == 'tool'
+    config = body.get('generationConfig') or body.get('generation_config') or {}
+    return bool(config.get('responseSchema') or config.get('response_schema'))
+
+
+class MockState:
+    """
+    Fault configuration and counters shared by all request threads.
+    """
+
+    def __init__(self, latency='fixed:0', fault_rates=None, rpm=0, seed=None, batch_delay=5.0,
+                 file_ttl=48 * 3600, min_cache_tokens=1024, pack_drop=0.0, malformed=0.0,
+                 token_latency=0.0):
+        self.draw_latency = parse_latency(latency)
+        self.fault_rates = fault_rates or {}
+        self.rpm = rpm
+        self.batch_delay = batch_delay
+        self.files = {}
+        self.batches = {}
+        self.message_batches = {}
+        self.file_ttl = file_ttl
+        self.gemini_files = {}
+        self.min_cache_tokens = min_cache_tokens
+        self.prompt_prefixes = set()
+        self.pack_drop = pack_drop
+        self.malformed = malformed
+        self.token_latency = token_latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.counters = Counter()
+
+    def admit(self, api_key=None):
+        """
+        Applies the requests-per-minute limit of an API key.
+
+        Returns:
+        tuple: (admitted, remaining, reset_seconds).
+        """
+        now = time.time()
+        with self.lock:
+            window = self.windows.setdefault(api_key, deque())
+            while window and now - window[0] >= 60:
+                window.popleft()
+            reset = 60 - (now - window[0]) if window else 60.0
+            if self.rpm and len(window) >= self.rpm:
+                return False, 0, reset
+            window.append(now)
+            remaining = self.rpm - len(window) if self.rpm else 1000000
+            return True, remaining, reset
+
+    def draw_fault(self):
+        with self.lock:
+            for fault, rate in self.fault_rates.items():
+                if rate and self.random.random() < rate:
+                    return fault
+        return None
+
+    def count(self, *keys):
+        with self.lock:
+            self.counters.update(keys)
+
+    def new_id(self, prefix):
+        with self.lock:
+            self.counters['ids'] += 1
+            return f"{prefix}{self.counters['ids']:06d}"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Serves the three provider request shapes.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        state = self.server.state
+        batch_match = OPENAI_BATCH_PATH.match(path)
+        file_match = OPENAI_FILE_PATH.match(path)
+        message_batch_match = ANTHROPIC_BATCH_PATH.match(path)
+        gemini_file_match = GEMINI_FILE_PATH.match(path)
+        if path == '/stats':
+            with state.lock:
+                self.send_json(200, dict(state.counters))
+        elif message_batch_match and message_batch_match.group('batch_id') in state.message_batches:
+            batch = state.message_batches[message_batch_match.group('batch_id')]
+            if not message_batch_match.group('results'):
+                self.send_json(200, self.message_batch_status(batch))
+            elif time.time() < batch['ready_at']:
+                self.send_json(400, {'type': 'error', 'error': {
+                    'type': 'invalid_request_error', 'message': 'Batch is still processing'}})
+            else:
+                content = ''.join(json.dumps(line) + '\n' for line in batch['results'])
+                self.send_bytes(200, content.encode('utf-8'), 'application/binary')
+        elif gemini_file_match and self.gemini_file(gemini_file_match.group('name')):
+            self.send_json(200, self.gemini_file(gemini_file_match.group('name')))
+        elif batch_match and batch_match.group('batch_id') in state.batches:
+            self.send_json(200, self.batch_status(state.batches[batch_match.group('batch_id')]))
+        elif file_match and file_match.group('file_id') in state.files:
+            stored = state.files[file_match.group('file_id')]
+            if file_match.group('content'):
+                self.send_bytes(200, stored['content'], 'application/jsonl')
+            else:
+                self.send_json(200, stored['object'])
+        else:
+            self.send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        gemini_match = GEMINI_PATH.match(path)
+        if path == '/v1/files':
+            self.create_file()
+            return
+        if path == '/v1/batches':
+            self.create_batch()
+            return
+        if path == '/v1/messages/batches':
+            self.create_message_batch()
+            return
+        if path == '/upload/v1beta/files':
+            self.upload_gemini_file()
+            return
+        if path == '/v1/chat/completions':
+            provider = 'openai'
+        elif path == '/v1/messages':
+            provider = 'anthropic'
+        elif gemini_match:
+            provider = 'gemini'
+        else:
+            self.send_json(404, {'error': {'message': f'Unknown endpoint {path}'}})
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        state = self.server.state
+        state.count('requests', f'{provider}_requests')
+        with state.lock:
+            state.counters[f'{provider}_request_bytes'] += length
+        if provider == 'gemini':
+            missing = self.count_gemini_images(body)
+            if missing:
+                self.send_json(400, {'error': {
+                    'code': 400, 'status': 'INVALID_ARGUMENT',
+                    'message': f'File {missing} does not exist or has expired.',
+                }})
+                return
+
+        time.sleep(max(0.0, state.draw_latency()))
+
+        api_key = self.api_key()
+        if api_key:
+            state.count(f'key_...{api_key[-4:]}')
+        admitted, remaining, reset = state.admit(api_key)
+        headers = self.rate_limit_headers(provider, remaining, reset)
+        fault = None if admitted else 'rate_limit'
+        fault = fault or state.draw_fault()
+        if fault and fault != 'refusal':
+            state.count(f'fault_{fault}')
+            # Only a full rpm window has to be waited out; injected faults clear
+            # at once, except an exhausted quota, which gives no reset time.
+            if fault != 'quota':
+                headers['Retry-After'] = str(max(1, int(reset))) if not admitted else '1'
+            self.send_error_body(provider, fault, headers)
+            return
+
+        model = gemini_match.group('model') if gemini_match else body.get('model', 'mock')
+        response = self.answer_body(provider, model, body, fault)
+        if state.token_latency:
+            time.sleep(state.token_latency * output_tokens(provider, response))
+        self.send_json(200, response, headers)
+
+    def answer_body(self, provider, model, body, fault=None):
+        """
+        Builds the successful response to a request body (a refusal when the
+        drawn fault is 'refusal').
+        """
+        state = self.server.state
+        prompt = request_text(provider, body)
+        if fault == 'refusal':
+            state.count('fault_refusal')
+            text = REFUSAL_TEXT
+        else:
+            temperature = body.get('temperature',
+                                   body.get('generationConfig', {}).get('temperature', 0))
+            text = canned_answer(prompt, temperature, state.pack_drop)
+            if constrained(provider, body):
+                state.count(f'structured_{provider}')
+            elif state.malformed and state.random.random() < state.malformed:
+                state.count('malformed')
+                text = malform(text, state.random)
+        text, stop = cut_at_stop(text, stop_sequences(provider, body))
+        response = self.success_body(provider, model, prompt, text)
+        if stop is not None and provider == 'anthropic':
+            response.update(stop_reason='stop_sequence', stop_sequence=stop)
+        if provider == 'openai' and body.get('logprobs') and fault != 'refusal':
+            response['choices'][0]['logprobs'] = token_logprobs(
+                text, body.get('top_logprobs') or 0, state.random
+            )
+        if provider == 'anthropic' and constrained(provider, body) and fault != 'refusal':
+            response['content'] = [{
+                'type': 'tool_use',
+                'id': f"toolu_mock{int(time.time() * 1000)}",
+                'name': body['tool_choice']['name'],
+                'input': json.loads(text),
+            }]
+            response['stop_reason'] = 'tool_use'
+        cache_read, cache_write = self.prompt_cache(provider, model, body)
+        if provider == 'openai':
+            response['usage']['prompt_tokens_details'] = {'cached_tokens': cache_read}
+        elif provider == 'anthropic':
+            response['usage'].update(
+                input_tokens=max(1, response['usage']['input_tokens'] - cache_read - cache_write),
+                cache_read_input_tokens=cache_read, cache_creation_input_tokens=cache_write,
+            )
+        return response
+
+    def prompt_cache(self, provider, model, body):
+        """
+        Looks up the cacheable prompt prefix of a request, remembering it for
+        the next requests.
+
+        Returns:
+        tuple: (cache_read_tokens, cache_write_tokens).
+        """
+        state = self.server.state
+        messages = body.get('messages') or [{}]
+        content = messages[0].get('content')
+        if provider not in ('openai', 'anthropic') or not isinstance(content, list):
+            return 0, 0
+        prefix = ''
+        if provider == 'openai':
+            if content and content[0].get('type') == 'text':
+                prefix = content[0]['text']
+        else:
+            texts = []
+            for part in content:
+                texts.append(part.get('text', ''))
+                if 'cache_control' in part:
+                    prefix = ''.join(texts)
+        tokens = len(prefix) // 4
+        if not prefix or tokens < state.min_cache_tokens:
+            return 0, 0
+        if provider == 'openai':
+            # OpenAI caches in increments of 128 tokens.
+            tokens -= tokens % 128
+        key = (provider, model, hashlib.sha256(prefix.encode('utf-8')).hexdigest())
+        with state.lock:
+            hit = key in state.prompt_prefixes
+            state.prompt_prefixes.add(key)
+        state.count('prompt_cache_hits' if hit else 'prompt_cache_misses')
+        if hit:
+            return tokens, 0
+        return 0, tokens if provider == 'anthropic' else 0
+
+    def create_file(self):
+        """
+        POST /v1/files: stores an uploaded (multipart) file.
+        """
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length)
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode('utf-8') + raw
+        )
+        fields = {}
+        for part in message.walk():
+            name = part.get_param('name', header='content-disposition')
+            if name:
+                fields[name] = (part.get_filename(), part.get_payload(decode=True))
+        filename, content = fields.get('file', ('upload.jsonl', b''))
+        purpose = (fields.get('purpose', (None, b'batch'))[1] or b'').decode('utf-8')
+        file_object = self.store_file(content, filename, purpose)
+        self.server.state.count('openai_files')
+        self.send_json(200, file_object)
+
+    def store_file(self, content, filename, purpose):
+        state = self.server.state
+        file_object = {
+            'id': state.new_id('file-mock'),
+            'object': 'file',
+            'bytes': len(content),
+            'created_at': int(time.time()),
+            'filename': filename,
+            'purpose': purpose,
+            'status': 'processed',
+        }
+        state.files[file_object['id']] = {'object': file_object, 'content': content}
+        return file_object
+
+    def create_batch(self):
+        """
+        POST /v1/batches: answers every line of the input file at once; the
+        batch reports completed after the batch delay.
+        """
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        state = self.server.state
+        stored = state.files.get(body.get('input_file_id'))
+        if stored is None:
+            self.send_json(404, {'error': {'message': 'No such file', 'type': 'invalid_request_error'}})
+            return
+        outputs, errors = [], []
+        for line in stored['content'].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            fault = state.draw_fault()
+            if fault and fault != 'refusal':
+                state.count(f'fault_{fault}')
+                status, error = self.error_body('openai', fault)
+                errors.append({
+                    'id': state.new_id('batch_req_mock'), 'custom_id': request['custom_id'],
+                    'response': {'status_code': status, 'body': error}, 'error': None,
+                })
+                continue
+            request_body = request.get('body', {})
+            outputs.append({
+                'id': state.new_id('batch_req_mock'), 'custom_id': request['custom_id'],
+                'response': {
+                    'status_code': 200, 'request_id': state.new_id('req_mock'),
+                    'body': self.answer_body('openai', request_body.get('model', 'mock'),
+                                             request_body, fault),
+                },
+                'error': None,
+            })
+        state.count('openai_batches')
+        now = int(time.time())
+        batch = {
+            'id': state.new_id('batch_mock'),
+            'object': 'batch',
+            'endpoint': body.get('endpoint'),
+            'errors': None,
+            'input_file_id': body['input_file_id'],
+            'completion_window': body.get('completion_window', '24h'),
+            'created_at': now,
+            'in_progress_at': now,
+            'metadata': body.get('metadata'),
+            'request_counts': {'total': len(outputs) + len(errors),
+                               'completed': len(outputs), 'failed': len(errors)},
+            'ready_at': time.time() + state.batch_delay,
+        }
+        for name, lines in (('output_file_id', outputs), ('error_file_id', errors)):
+            content = ''.join(json.dumps(line) + '\n' for line in lines).encode('utf-8')
+            batch[name] = self.store_file(content, f"{batch['id']}_{name}.jsonl",
+                                          'batch_output')['id'] if lines else None
+        state.batches[batch['id']] = batch
+        self.send_json(200, self.batch_status(batch))
+
+    def batch_status(self, batch):
+        """
+        Returns the public view of a batch: in progress until its ready time.
+        """
+        public = {name: value for name, value in batch.items() if name != 'ready_at'}
+        if time.time() < batch['ready_at']:
+            public.update(status='in_progress', output_file_id=None, error_file_id=None,
+                          request_counts={'total': batch['request_counts']['total'],
+                                          'completed': 0, 'failed': 0})
+        else:
+            public.update(status='completed', completed_at=int(batch['ready_at']))
+        return public
+
+    def create_message_batch(self):
+        """
+        POST /v1/messages/batches: answers every request at once; the batch
+        reports ended after the batch delay.
+        """
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        state = self.server.state
+        results = []
+        for request in body.get('requests', []):
+            fault = state.draw_fault()
+            if fault and fault != 'refusal':
+                state.count(f'fault_{fault}')
+                result = {'type': 'errored', 'error': self.error_body('anthropic', fault)[1]}
+            else:
+                params = request.get('params', {})
+                result = {'type': 'succeeded', 'message': self.answer_body(
+                    'anthropic', params.get('model', 'mock'), params, fault
+                )}
+            results.append({'custom_id': request['custom_id'], 'result': result})
+        state.count('anthropic_batches')
+        batch_id = state.new_id('msgbatch_mock')
+        batch = {
+            'id': batch_id,
+            'type': 'message_batch',
+            'created_at': datetime.now(timezone.utc),
+            'ready_at': time.time() + state.batch_delay,
+            'results_url': f"http://{self.headers.get('Host')}/v1/messages/batches/{batch_id}/results",
+            'results': results,
+        }
+        state.message_batches[batch_id] = batch
+        self.send_json(200, self.message_batch_status(batch))
+
+    def message_batch_status(self, batch):
+        """
+        Returns the public view of a Message Batch: in progress until its
+        ready time.
+        """
+        created_at = batch['created_at']
+        ended = time.time() >= batch['ready_at']
+        ended_at = created_at + timedelta(seconds=self.server.state.batch_delay)
+        counts = Counter(result['result']['type'] for result in batch['results'])
+        return {
+            'id': batch['id'],
+            'type': batch['type'],
+            'processing_status': 'ended' if ended else 'in_progress',
+            'request_counts': {
+                'processing': 0 if ended else len(batch['results']),
+                'succeeded': counts['succeeded'] if ended else 0,
+                'errored': counts['errored'] if ended else 0,
+                'canceled': 0,
+                'expired': 0,
+            },
+            'created_at': created_at.isoformat(),
+            'ended_at': ended_at.isoformat() if ended else None,
+            'expires_at': (created_at + timedelta(days=1)).isoformat(),
+            'archived_at': None,
+            'cancel_initiated_at': None,
+            'results_url': batch['results_url'] if ended else None,
+        }
+
+    def upload_gemini_file(self):
+        """
+        POST /upload/v1beta/files: stores an uploaded Gemini file (the media
+        bytes are not kept).
+        """
+        length = int(self.headers.get('Content-Length') or 0)
+        content = self.rfile.read(length)
+        state = self.server.state
+        name = f"files/{state.new_id('mock')}"
+        created_at = datetime.now(timezone.utc)
+        host = self.headers.get('Host')
+        state.gemini_files[name] = {
+            'name': name,
+            'mimeType': self.headers.get('Content-Type') or 'application/octet-stream',
+            'sizeBytes': str(len(content)),
+            'createTime': created_at.isoformat().replace('+00:00', 'Z'),
+            'expirationTime': (created_at + timedelta(seconds=state.file_ttl))
+            .isoformat().replace('+00:00', 'Z'),
+            'sha256Hash': base64.b64encode(hashlib.sha256(content).digest()).decode('ascii'),
+            'uri': f"http://{host}/v1beta/{name}",
+            'state': 'ACTIVE',
+            'expires': time.time() + state.file_ttl,
+        }
+        state.count('gemini_uploads')
+        self.send_json(200, {'file': self.gemini_file(name)})
+
+    def gemini_file(self, name):
+        """
+        Returns the public view of a live uploaded file, or None.
+        """
+        file = self.server.state.gemini_files.get(name)
+        if file is None or time.time() >= file['expires']:
+            return None
+        return {field: value for field, value in file.items() if field != 'expires'}
+
+    def count_gemini_images(self, body):
+        """
+        Counts the inline and file-referenced images of a Gemini request.
+
+        Returns:
+        str: URI of a referenced file that does not exist, or None.
+        """
+        state = self.server.state
+        for content in body.get('contents', []):
+            for part in content.get('parts', []):
+                if 'inlineData' in part or 'inline_data' in part:
+                    state.count('gemini_inline_images')
+                file_data = part.get('fileData') or part.get('file_data')
+                if file_data:
+                    state.count('gemini_file_images')
+                    uri = file_data.get('fileUri') or file_data.get('file_uri') or ''
+                    if not self.gemini_file(uri[uri.find('files/'):]):
+                        return uri
+        return None
+
+    def api_key(self):
+        """
+        Returns the API key of the request; the rpm limit applies per key.
+        """
+        authorization = self.headers.get('Authorization') or ''
+        if authorization.startswith('Bearer '):
+            return authorization[len('Bearer '):]
+        key = self.headers.get('x-api-key') or self.headers.get('x-goog-api-key')
+        if key:
+            return key
+        match = re.search(r'[?&]key=([^&]+)', self.path)
+        return match.group(1) if match else None
+
+    def rate_limit_headers(self, provider, remaining, reset):
+        limit = self.server.state.rpm or 1000000
+        if provider == 'openai':
+            return {
+                'x-ratelimit-limit-requests': str(limit),
+                'x-ratelimit-remaining-requests': str(remaining),
+                'x-ratelimit-reset-requests': f'{reset:.3f}s',
+            }
+        if provider == 'anthropic':
+            reset_at = datetime.now(timezone.utc) + timedelta(seconds=reset)
+            return {
+                'anthropic-ratelimit-requests-limit': str(limit),
+                'anthropic-ratelimit-requests-remaining': str(remaining),
+                'anthropic-ratelimit-requests-reset': reset_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            }
+        return {}
+
+    def success_body(self, provider, model, prompt, text):
+        input_tokens = max(1, len(prompt) // 4)
+        output_tokens = max(1, len(text) // 4)
+        if provider == 'openai':
+            return {
+                'id': f'chatcmpl-mock{int(time.time() * 1000)}',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': text},
+                    'finish_reason': 'stop',
+                    'logprobs': None,
+                }],
+                'usage': {
+                    'prompt_tokens': input_tokens,
+                    'completion_tokens': output_tokens,
+                    'total_tokens': input_tokens + output_tokens,
+                },
+            }
+        if provider == 'anthropic':
+            return {
+                'id': f'msg_mock{int(time.time() * 1000)}',
+                'type': 'message',
+                'role': 'assistant',
+                'model': model,
+                'content': [{'type': 'text', 'text': text}],
+                'stop_reason': 'end_turn',
+                'stop_sequence': None,
+                'usage': {'input_tokens': input_tokens, 'output_tokens': output_tokens},
+            }
+        return {
+            'candidates': [{
+                'content': {'role': 'model', 'parts': [{'text': text}]},
+                'finishReason': 'STOP',
+                'index': 0,
+            }],
+            'usageMetadata': {
+                'promptTokenCount': input_tokens,
+                'candidatesTokenCount': output_tokens,
+                'totalTokenCount': input_tokens + output_tokens,
+            },
+        }
+
+    def send_error_body(self, provider, fault, headers):
+        self.send_json(*self.error_body(provider, fault), headers)
+
+    def error_body(self, provider, fault):
+        """
+        Returns the (status, body) of an injected fault.
+        """
+        status, openai_code, anthropic_type, gemini_status, message = FAULTS[fault]
+        if provider == 'openai':
+            error_type = 'insufficient_quota' if fault == 'quota' else (
+                'invalid_request_error' if status == 400 else 'server_error'
+                if status >= 500 else 'requests'
+            )
+            body = {'error': {'message': message, 'type': error_type,
+                              'param': None, 'code': openai_code}}
+        elif provider == 'anthropic':
+            if fault == 'quota':
+                message = 'Your organization has exceeded its monthly usage limit.'
+            body = {'type': 'error', 'error': {'type': anthropic_type, 'message': message}}
+        else:
+            body = {'error': {'code': status, 'message': message, 'status': gemini_status}}
+        return status, body
+
+    def send_json(self, status, body, headers=None):
+        self.send_bytes(status, json.dumps(body).encode('utf-8'), 'application/json', headers)
+
+    def send_bytes(self, status, payload, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def create_server(host='127.0.0.1', port=DEFAULT_PORT, **state_options):
+    """
+    Creates the stand-in server without starting it.
+
+    Parameters:
+    host (str): Interface to bind.
+    port (int): Port to bind; 0 picks a free port.
+    state_options: Keyword arguments of MockState.
+
+    Returns:
+    ThreadingHTTPServer: Call serve_forever() (e.g. in a thread) to start it.
+    """
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(**state_options)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', default='fixed:0',
+                        help="fixed:S, uniform:A,B, lognormal:MEDIAN,SIGMA or exponential:MEAN")
+    parser.add_argument('--rpm', type=int, default=0,
+                        help='Requests per minute per API key before answering 429 (0 = unlimited)')
+    for fault in (*FAULTS, 'refusal'):
+        parser.add_argument(f"--{fault.replace('_', '-')}", type=float, default=0.0,
+                            metavar='RATE', help=f'Probability of a {fault} response')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--batch-delay', type=float, default=5.0,
+                        help='Seconds until a submitted batch reports completed or ended')
+    parser.add_argument('--file-ttl', type=float, default=48 * 3600,
+                        help='Seconds until an uploaded Gemini file expires')
+    parser.add_argument('--min-cache-tokens', type=int, default=1024,
+                        help='Shortest prompt prefix, in tokens, served from the prompt cache')
+    parser.add_argument('--pack-drop', type=float, default=0.0, metavar='RATE',
+                        help='Probability of leaving a case out of a packed answer')
+    parser.add_argument('--malformed', type=float, default=0.0, metavar='RATE',
+                        help='Probability of a malformed JSON answer to an unconstrained request')
+    parser.add_argument('--token-latency', type=float, default=0.0, metavar='SECONDS',
+                        help='Extra latency per output token of an answer')
+    args = parser.parse_args()
+
+    fault_rates = {fault: getattr(args, fault) for fault in (*FAULTS, 'refusal')}
+    server = create_server(args.host, args.port, latency=args.latency,
+                           fault_rates=fault_rates, rpm=args.rpm, seed=args.seed,
+                           batch_delay=args.batch_delay, file_ttl=args.file_ttl,
+                           min_cache_tokens=args.min_cache_tokens, pack_drop=args.pack_drop,
+                           malformed=args.malformed, token_latency=args.token_latency)
+    print(f"Mock provider server listening on http://{args.host}:{server.server_port}")
+    print(f"Point the runners at it with VLM_BASE_URL=http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Request counters: {dict(server.state.counters)}")
+
+
+if __name__ == "__main__":
+    main()
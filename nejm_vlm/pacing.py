@@ -0,0 +1,256 @@
+"""
+Adaptive request pacing driven by the providers' rate-limit headers.
+
+One Pacer is kept per (provider, model) and combines two controls:
+
+    pacing       when the remaining requests (or tokens) of the current window
+                 run low, the rest of the window is spread over them, so the
+                 model stays just under its live limit
+    concurrency  an AIMD limit on requests in flight: raised by 1/limit per
+                 success while the headers show headroom, halved on every
+                 rate-limit or overload error
+
+The OpenAI and Anthropic clients report their response headers through an
+httpx event hook (see providers.py). Gemini returns no such headers and is
+paced by its 429s alone. VLM_MAX_CONCURRENCY caps the concurrency limit
+(default 8).
+"""
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULT_MAX_CONCURRENCY = 8
+
+# Below this fraction of the window limit the remaining budget is spread out.
+LOW_HEADROOM = 0.1
+# Above this fraction successes may raise the concurrency limit.
+HIGH_HEADROOM = 0.5
+
+# Header name templates per provider; {kind} is requests, tokens, ...
+HEADER_TEMPLATES = {
+    'openai': {
+        'limit': 'x-ratelimit-limit-{kind}',
+        'remaining': 'x-ratelimit-remaining-{kind}',
+        'reset': 'x-ratelimit-reset-{kind}',
+    },
+    'anthropic': {
+        'limit': 'anthropic-ratelimit-{kind}-limit',
+        'remaining': 'anthropic-ratelimit-{kind}-remaining',
+        'reset': 'anthropic-ratelimit-{kind}-reset',
+    },
+}
+LIMIT_KINDS = ('requests', 'tokens', 'input-tokens', 'output-tokens')
+
+DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+metrics = Counter()
+_pacers = {}
+_lock = threading.Lock()
+_current = threading.local()
+
+
+def parse_reset(value):
+    """
+    Converts a reset header into seconds from now.
+
+    OpenAI sends durations such as "1s", "6m0s" or "20ms"; Anthropic sends
+    RFC 3339 timestamps.
+    """
+    value = value.strip()
+    if 'T' in value:
+        reset_at = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return max(0.0, reset_at.timestamp() - time.time())
+    parts = DURATION_PATTERN.findall(value)
+    if not parts:
+        return float(value)
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def parse_headers(provider, headers):
+    """
+    Reads the rate-limit headers of a response.
+
+    Returns:
+    dict: kind -> (limit, remaining, reset_seconds) for every limit the
+    response reports.
+    """
+    templates = HEADER_TEMPLATES.get(provider)
+    if templates is None:
+        return {}
+    limits = {}
+    for kind in LIMIT_KINDS:
+        values = {field: headers.get(name.format(kind=kind))
+                  for field, name in templates.items()}
+        if values['limit'] is None or values['remaining'] is None:
+            continue
+        try:
+            reset = parse_reset(values['reset']) if values['reset'] else 0.0
+            limits[kind] = (float(values['limit']), float(values['remaining']), reset)
+        except ValueError:
+            continue
+    return limits
+
+
+class Pacer:
+    """
+    Paces and bounds the concurrent requests to one model.
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.limit = 1.0
+        self.in_flight = 0
+        self.interval = 0.0
+        self.next_send = 0.0
+        self.headroom = None
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Waits for a concurrency slot and for the paced send time.
+
+        Returns:
+        float: Seconds spent waiting for the send time.
+        """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            now = time.time()
+            send_at = max(now, self.next_send)
+            self.next_send = send_at + self.interval
+        delay = send_at - now
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def observe(self, limits):
+        """
+        Updates the pacing from the parsed rate-limit headers of a response.
+        """
+        if not limits:
+            return
+        now = time.time()
+        interval = 0.0
+        resume_at = 0.0
+        headroom = 1.0
+        for kind, (limit, remaining, reset) in limits.items():
+            fraction = remaining / limit if limit > 0 else 1.0
+            headroom = min(headroom, fraction)
+            if fraction >= LOW_HEADROOM:
+                continue
+            if kind == 'requests':
+                if remaining < 1:
+                    resume_at = max(resume_at, now + reset)
+                else:
+                    interval = max(interval, reset / remaining)
+            else:
+                # Token use per request is unknown, so the closer the
+                # remaining tokens are to zero, the more of the window is waited out.
+                resume_at = max(resume_at, now + reset * (1 - fraction / LOW_HEADROOM))
+        with self.condition:
+            self.interval = interval
+            self.next_send = max(self.next_send, resume_at)
+            self.headroom = headroom
+
+    def on_success(self):
+        """
+        Additive increase while the last headers showed headroom.
+        """
+        with self.condition:
+            if self.headroom is None or self.headroom > HIGH_HEADROOM:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                self.condition.notify_all()
+
+    def on_rate_limit(self, delay=None):
+        """
+        Multiplicative decrease; holds all sends for the server-requested delay.
+        """
+        with self.condition:
+            self.limit = max(1.0, self.limit / 2)
+            if delay:
+                self.next_send = max(self.next_send, time.time() + delay)
+
+
+def max_concurrency():
+    return int(os.getenv('VLM_MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY))
+
+
+def get_pacer(provider, model):
+    """
+    Returns the shared Pacer of a model, creating it on first use.
+    """
+    with _lock:
+        pacer = _pacers.get((provider, model))
+        if pacer is None:
+            pacer = _pacers[(provider, model)] = Pacer(max_concurrency())
+        return pacer
+
+
+@contextmanager
+def slot(provider, model):
+    """
+    Holds a paced concurrency slot of a model around one request.
+    """
+    pacer = get_pacer(provider, model)
+    waited = pacer.acquire()
+    if waited > 0:
+        metrics[(provider, model, 'pacing_seconds')] += waited
+    try:
+        yield pacer
+    finally:
+        pacer.release()
+
+
+def attributed(provider, model, function, *args):
+    """
+    Calls a function, attributing the responses the client hooks see on this
+    thread to the model.
+    """
+    _current.key = (provider, model)
+    try:
+        return function(*args)
+    finally:
+        _current.key = None
+
+
+def observe_response(provider, response):
+    """
+    httpx response hook: feeds the rate-limit headers to the active pacer.
+    """
+    key = getattr(_current, 'key', None)
+    if key is None or key[0] != provider:
+        return
+    get_pacer(*key).observe(parse_headers(provider, response.headers))
+
+
+def response_hooks(provider):
+    """
+    Returns the httpx event hooks that report a provider's responses.
+    """
+    return {'response': [lambda response: observe_response(provider, response)]}
+
+
+def report():
+    """
+    Prints the concurrency limit and pacing delay of every model.
+    """
+    with _lock:
+        pacers = sorted(_pacers.items())
+    if not pacers:
+        return
+    print("Pacing:")
+    for (provider, model), pacer in pacers:
+        waited = metrics[(provider, model, 'pacing_seconds')]
+        print(f"  {provider} {model}: concurrency limit {pacer.limit:.1f}, "
+              f"paced {waited:.1f} seconds")
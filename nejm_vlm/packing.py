@@ -0,0 +1,70 @@
+"""
+Multi-question packing for the no-img task: K questions per request.
+
+The no-img prompts are text only and a few hundred tokens long, so one
+request per case spends most of its time on the per-request overhead and the
+round trip. With `python -m nejm_vlm.runner --tasks no-img --pack K`, the
+pending cases of a run are sent K at a time (nejm_vlm.prompts.render_packed).
+The response is a JSON object whose "answers" list has one element per case:
+
+    {"answers": [{"case": 12, "answer": "3", "reason": "..."}, ...]}
+
+Every element is validated (a case of the pack with an option number as
+answer; only the first element of a case counts) and saved as that case's
+result file, in the same {"answer", "reason"} form as an unpacked response,
+so the results sheets and analyses read packed runs like any other. The
+cases missing from a response, or with an invalid element, are sent again
+one by one.
+"""
+import json
+
+from nejm_vlm import results
+
+# Output tokens per packed question, and the output limit of a packed request.
+TOKENS_PER_QUESTION = 512
+MAX_PACKED_TOKENS = 4096
+
+
+def chunks(items, size):
+    """
+    Splits a list into consecutive packs of at most size items.
+    """
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def max_tokens(pack_size):
+    return min(MAX_PACKED_TOKENS, TOKENS_PER_QUESTION * pack_size)
+
+
+def parse_answers(text, case_numbers):
+    """
+    Splits a packed response into the result texts of its cases.
+
+    Parameters:
+    text (str): Raw response text.
+    case_numbers (list): Case numbers of the pack.
+
+    Returns:
+    dict: Case number -> result text ({"answer", "reason"} JSON) for every
+    valid element; cases without one are left out.
+    """
+    data = results.extract_json_fields(text or '')
+    elements = data.get('answers') if data else None
+    if not isinstance(elements, list):
+        return {}
+    expected = {int(case_number) for case_number in case_numbers}
+    answers = {}
+    for element in elements:
+        if not isinstance(element, dict):
+            continue
+        case_number = results.parse_option_number(element.get('case'))
+        answer = element.get('answer')
+        if case_number not in expected or case_number in answers:
+            continue
+        if not results.parse_option_number(answer):
+            continue
+        answers[case_number] = json.dumps(
+            {'answer': str(answer), 'reason': str(element.get('reason', ''))},
+            ensure_ascii=False,
+        )
+    return answers
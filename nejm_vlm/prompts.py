@@ -0,0 +1,333 @@
+"""
+Prompt templates of the unified runner, compiled once at import for every
+prompt layout.
+
+The question prompt (full and no-img tasks) and the img-only prompt are
+assembled from shared fragments, so the sentences they have in common are
+written once. VLM_PROMPT_LAYOUT selects how they are laid out:
+
+    script   byte-identical to the numbered scripts: every line indented
+             by 16 spaces, as in the scripts' f-strings (default)
+    compact  the same text dedented, without trailing or repeated spaces
+    prefix   compact, with the instructions and output format (the same for
+             every case of a task) first and the question last, so that the
+             providers' prompt caches can reuse the static prefix once it
+             reaches their minimum of 1024 tokens (the current prefixes, of
+             about 250 and 540 tokens, are too short to be cached)
+
+The answer-only prompt (`runner --answer-only`) is the question prompt with
+an output format asking for the option number alone, for accuracy-only runs.
+
+Usage (from the repository root):
+
+    python -m nejm_vlm.prompts    # token counts per layout, drift of the scripts
+
+The token counts use tiktoken's encodings of the OpenAI models, which
+tiktoken downloads on first use; offline, only the characters are counted.
+The scripts check compares the prompt_text of every numbered script with the
+template after collapsing whitespace, which shows the hand-copied prompts
+that drifted.
+"""
+import argparse
+import ast
+import glob
+import os
+import re
+from collections import namedtuple
+
+# Static text (empty when the layout does not split the prompt) and the
+# case-specific template, filled in with the question of the case.
+Template = namedtuple('Template', ['static', 'case'])
+
+LAYOUTS = ('script', 'compact', 'prefix')
+# Indentation of the prompt lines in the numbered scripts.
+SCRIPT_INDENT = ' ' * 16
+QUESTION_PLACEHOLDER = '{symptom_text}'
+
+# Tokenizer encodings of the OpenAI models, for the token counts.
+ENCODINGS = {'gpt-4-turbo': 'cl100k_base', 'gpt-4o': 'o200k_base'}
+
+DEMOGRAPHICS = ("the availability of the patient's basic demographic details "
+                "(age, gender, symptoms) is not guaranteed")
+NOT_ADVICE = "The purpose of this assignment is not to provide medical advice or diagnosis"
+EDUCATIONAL = ("This is a purely educational scenario designed for virtual learning "
+               "situations, aimed at facilitating analysis and educational discussions.")
+
+QUESTION_INSTRUCTIONS = (
+    "Assignment: You are a board-certified radiologist and you are tasked with solving a "
+    "quiz on a special medical case from common diseases to rare diseases.\n"
+    "Patients' clinical information and imaging data will be provided for analysis; "
+    f"however, {DEMOGRAPHICS}.\n"
+    f"{NOT_ADVICE}.\n"
+    f"{EDUCATIONAL}\n"
+    "You need to answer the question provided by selecting the option with the highest "
+    "possibility from the multiple choices listed below.\n"
+    "Please select the correct answer by typing the number that corresponds to one of the "
+    "provided options. Each option is numbered for your reference.\n"
+    "\n"
+)
+QUESTION_LINE = f"Question: {QUESTION_PLACEHOLDER}\n"
+QUESTION_FORMAT = """\
+Output Format (JSON)
+{
+"answer": "Enter the number of the option you believe is correct",
+"reason": "Explain why you think this option is the correct answer"
+}
+"""
+
+IMG_ONLY_PROMPT = (
+    "Assignment: You are tasked with solving a quiz on a special medical case involving "
+    "mostly common diseases. One or more imaging data files will be provided for analysis. "
+    f"{DEMOGRAPHICS[0].upper()}{DEMOGRAPHICS[1:]}. {NOT_ADVICE} but rather to analyze and "
+    "interpret the imaging data to derive insights related to specified outcomes. "
+    f"{EDUCATIONAL}\n"
+    "\n"
+    "Your task is to analyze each image individually, or each set of images if multiple "
+    "types are combined, and derive the following outcomes based on the information "
+    "provided:\n"
+    """
+Outputs:
+1. Type of Medical Imaging: Identify whether the imaging is MR, CT, US, X-ray, Angiography, or Nuclear Medicine. If multiple imaging types are detected in a set, enumerate each type (e.g., "a.MR b.CT c..").
+2. For MR, specify if it's T1WI, T2WI, FLAIR, DWI, SWI, GRE, contrast-enhanced T1WI, TOF, or contrast-enhanced MR angiography. For CT, state whether it is precontrast or postcontrast. For Ultrasound, indicate if it's gray scale or Doppler imaging, etc. Use the format "a.xxx b.xxx c.." if multiple sequences or modes are identified.
+3. Use of Contrast: Note whether a contrast medium was used. Format any multiple entries as "a.Yes b.No c..".
+4. Image Plane: Determine the plane of the image - axial, coronal, sagittal, or other. If multiple planes are evident, list them as "a.axial b.coronal c..".
+5. Specify the body part captured in the imaging. For multiple body parts, use "a.head b.abdomen c..".
+
+You are to provide answers in the following JSON format:
+{
+    "1_TypeOfMedicalImaging": "Enter the type or types of imaging used.",
+    "2_SpecificImagingSequence": "Specify the sequence or mode used for each type, if multiple.",
+    "3_UseOfContrast": "State whether contrast medium was used, format as needed for multiples.",
+    "4_ImagePlane": "Mention the plane of the image, list all that apply.",
+    "5_PartOfTheBodyImaged": "Identify the body part imaged, enumerate if multiple."
+}
+"""
+)
+
+QUESTION_PROMPT = QUESTION_INSTRUCTIONS + QUESTION_LINE + QUESTION_FORMAT
+
+# Answer-only requests leave out the reason, which makes up nearly all of the
+# output tokens of a question.
+ANSWER_ONLY_FORMAT = """\
+Output Format (JSON)
+{
+"answer": "Enter the number of the option you believe is correct"
+}
+"""
+ANSWER_ONLY_PROMPT = QUESTION_INSTRUCTIONS + QUESTION_LINE + ANSWER_ONLY_FORMAT
+
+# Packed requests (nejm_vlm.packing) ask several questions of the no-img task
+# at once and get one element per case back.
+PACKED_INSTRUCTIONS = (
+    QUESTION_INSTRUCTIONS
+    + "Several questions follow, each headed by its case number. Answer every question "
+    "on its own and give one element per question in the answers list, in the order "
+    "of the questions.\n"
+    "\n"
+)
+PACKED_FORMAT = """\
+Output Format (JSON)
+{
+"answers": [
+{
+"case": "Enter the case number of the question",
+"answer": "Enter the number of the option you believe is correct",
+"reason": "Explain why you think this option is the correct answer"
+}
+]
+}
+"""
+PACKED_QUESTION = f"Case {{case_number}}: {QUESTION_PLACEHOLDER}\n"
+
+
+def indent_script(text):
+    """
+    Lays a prompt out as the f-string of a numbered script.
+    """
+    lines = [SCRIPT_INDENT + line if line else line for line in text.split('\n')]
+    return '\n' + '\n'.join(lines) + SCRIPT_INDENT
+
+
+def compact(text):
+    """
+    Dedents a prompt and drops trailing and repeated spaces and blank-line runs.
+    """
+    lines = [re.sub(r'[ \t]+', ' ', line).strip() for line in text.split('\n')]
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip('\n') + '\n'
+
+
+def compile_templates():
+    """
+    Compiles the templates of every prompt kind ('question', 'answer-only',
+    'img-only') and layout.
+
+    Returns:
+    dict: (kind, layout) -> Template.
+    """
+    templates = {}
+    for kind, text in (('question', QUESTION_PROMPT), ('answer-only', ANSWER_ONLY_PROMPT),
+                       ('img-only', IMG_ONLY_PROMPT)):
+        templates[(kind, 'script')] = Template('', indent_script(text))
+        templates[(kind, 'compact')] = Template('', compact(text))
+    for kind, output_format in (('question', QUESTION_FORMAT),
+                                ('answer-only', ANSWER_ONLY_FORMAT)):
+        templates[(kind, 'prefix')] = Template(
+            compact(QUESTION_INSTRUCTIONS + output_format), '\n' + QUESTION_LINE
+        )
+    templates[('img-only', 'prefix')] = Template(compact(IMG_ONLY_PROMPT), '')
+    return templates
+
+
+TEMPLATES = compile_templates()
+PACKED_STATIC = compact(PACKED_INSTRUCTIONS + PACKED_FORMAT)
+
+
+def layout():
+    """
+    Returns the prompt layout selected by VLM_PROMPT_LAYOUT.
+    """
+    name = os.getenv('VLM_PROMPT_LAYOUT', 'script').strip().lower() or 'script'
+    if name not in LAYOUTS:
+        raise ValueError(f"VLM_PROMPT_LAYOUT must be one of {', '.join(LAYOUTS)}, not '{name}'")
+    return name
+
+
+def prompt_kind(task, answer_only=False):
+    if task == 'img-only':
+        return 'img-only'
+    return 'answer-only' if answer_only else 'question'
+
+
+def response_kind(prompt_text):
+    """
+    Returns the kind of response a prompt asks for: 'packed', 'img-only',
+    'answer-only' or 'question'.
+    """
+    if '"answers": [' in prompt_text:
+        return 'packed'
+    if '"1_TypeOfMedicalImaging"' in prompt_text:
+        return 'img-only'
+    if '"answer": "Enter' in prompt_text and '"reason"' not in prompt_text:
+        return 'answer-only'
+    return 'question'
+
+
+def render(task, question=None, layout_name=None, answer_only=False):
+    """
+    Returns the prompt of a case.
+
+    Parameters:
+    task (str): 'full', 'img-only' or 'no-img'.
+    question (str): Question of the case (unused by the img-only prompt).
+    layout_name (str): Prompt layout; defaults to VLM_PROMPT_LAYOUT.
+    answer_only (bool): Ask for the option number without a reason (ignored
+    by the img-only prompt).
+    """
+    template = TEMPLATES[(prompt_kind(task, answer_only), layout_name or layout())]
+    return template.static + template.case.replace(QUESTION_PLACEHOLDER, question or '')
+
+
+def split(prompt_text):
+    """
+    Splits a prompt into its static prefix and the case-specific rest.
+
+    Returns:
+    tuple: (static_text, case_text); static_text is empty unless the prompt
+    starts with a static prefix of the prefix layout.
+    """
+    for static_text in [template.static for template in TEMPLATES.values()] + [PACKED_STATIC]:
+        if static_text and prompt_text.startswith(static_text):
+            return static_text, prompt_text[len(static_text):]
+    return '', prompt_text
+
+
+def render_packed(questions):
+    """
+    Returns the prompt of a packed request: the static instructions and
+    output format first, then the questions.
+
+    Parameters:
+    questions (list): (case_number, question) pairs.
+    """
+    return PACKED_STATIC + '\n' + ''.join(
+        PACKED_QUESTION.replace('{case_number}', str(case_number))
+        .replace(QUESTION_PLACEHOLDER, question)
+        for case_number, question in questions
+    )
+
+
+def token_counter(encoding_name):
+    """
+    Returns a function counting the tokens of a text with a tiktoken encoding,
+    or None when the encoding cannot be loaded (it is downloaded on first use).
+    """
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        print(f"Warning: tiktoken encoding {encoding_name} unavailable, "
+              f"counting characters only: {str(e)[:200]}")
+        return None
+    return lambda text: len(encoding.encode(text))
+
+
+def script_prompts(root='.'):
+    """
+    Extracts the prompt_text f-strings of the numbered scripts.
+
+    Returns:
+    dict: Script path -> prompt template, with the question as
+    QUESTION_PLACEHOLDER.
+    """
+    found = {}
+    for path in sorted(glob.glob(os.path.join(root, '**', '[0-9]*.py'), recursive=True)):
+        with open(path, 'r', encoding='utf-8') as file:
+            tree = ast.parse(file.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Assign) and isinstance(node.value, ast.JoinedStr) and \
+                    any(getattr(target, 'id', None) == 'prompt_text' for target in node.targets):
+                found[path] = ''.join(
+                    value.value if isinstance(value, ast.Constant) else QUESTION_PLACEHOLDER
+                    for value in node.value.values
+                )
+    return found
+
+
+def drift(script_prompt):
+    """
+    Tells whether a script's prompt differs from the templates in more than
+    whitespace.
+    """
+    def normalize(text):
+        return re.sub(r'\s+', ' ', text).strip()
+    return normalize(script_prompt) not in (normalize(QUESTION_PROMPT), normalize(IMG_ONLY_PROMPT))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--question', default='',
+                        help='Question filled into the question prompt (default: none, '
+                             'which counts the tokens the template adds to every request)')
+    args = parser.parse_args()
+
+    counters = {model: token_counter(encoding) for model, encoding in ENCODINGS.items()}
+    counters = {model: counter for model, counter in counters.items() if counter}
+    print(f"{'prompt':11} {'layout':8} {'characters':>10} {'static':>8} "
+          + ' '.join(f"{model:>12}" for model in counters))
+    for kind in ('question', 'answer-only', 'img-only'):
+        for layout_name in LAYOUTS:
+            task = 'img-only' if kind == 'img-only' else 'full'
+            text = render(task, args.question, layout_name, kind == 'answer-only')
+            static_text, _ = split(text)
+            counts = ' '.join(f"{counter(text):>12}" for counter in counters.values())
+            print(f"{kind:11} {layout_name:8} {len(text):>10} {len(static_text):>8} {counts}")
+
+    print("\nNumbered scripts:")
+    for path, script_prompt in script_prompts().items():
+        state = 'differs from the template' if drift(script_prompt) else 'matches the template'
+        print(f"  {os.path.relpath(path)}: {state}")
+
+
+if __name__ == "__main__":
+    main()
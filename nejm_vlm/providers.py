@@ -0,0 +1,182 @@
+"""
+Client factories for the OpenAI, Anthropic and Gemini APIs.
+
+Every client honors a base URL override, so the runners can be pointed at
+the local stand-in server (`python -m nejm_vlm.mock_server`) instead of the
+live APIs:
+
+    VLM_BASE_URL=http://127.0.0.1:8089     all providers
+    OPENAI_BASE_URL=http://.../v1          OpenAI only (read by the SDK)
+    ANTHROPIC_BASE_URL=http://...          Anthropic only (read by the SDK)
+    GEMINI_BASE_URL=http://...             Gemini only
+
+When VLM_BASE_URL is set and no API key is configured, a placeholder key is
+used so that the runners start without live credentials.
+
+With a key pool (nejm_vlm.keys), the factories return a PooledClient that
+sends every attempt with the key it was scheduled on.
+
+The OpenAI and Anthropic clients report their rate-limit headers to
+nejm_vlm.pacing. Every client times out after VLM_REQUEST_TIMEOUT seconds
+(nejm_vlm.deadlines). The SDKs' own retries are disabled (older langchain-google-genai releases
+still retry twice internally); nejm_vlm.retry handles the retries.
+"""
+import json
+import os
+
+from nejm_vlm import deadlines
+from nejm_vlm import keys
+from nejm_vlm import pacing
+
+MOCK_API_KEY = 'mock-key'
+REFUSAL_PREFIX = "I'm sorry, but"
+
+API_KEY_VARIABLES = {
+    'openai': 'OPENAI_API_KEY',
+    'anthropic': 'ANTHROPIC_API_KEY',
+    'gemini': 'GOOGLE_API_KEY',
+}
+
+
+def base_url(provider):
+    """
+    Returns the base URL override of a provider, or None for the live API.
+
+    Parameters:
+    provider (str): 'openai', 'anthropic' or 'gemini'.
+    """
+    specific = os.getenv(f"{provider.upper()}_BASE_URL")
+    if specific:
+        return specific.rstrip('/')
+    shared = os.getenv("VLM_BASE_URL")
+    if not shared:
+        return None
+    shared = shared.rstrip('/')
+    return f"{shared}/v1" if provider == 'openai' else shared
+
+
+def api_key(provider, key=None):
+    """
+    Returns the API key of a provider, falling back to a placeholder key when
+    the requests go to the stand-in server.
+    """
+    key = key or os.getenv(API_KEY_VARIABLES[provider])
+    if not key and os.getenv("VLM_BASE_URL"):
+        return MOCK_API_KEY
+    return key
+
+
+class PooledClient:
+    """
+    Stands in for the client of a provider with a key pool: every attribute
+    is looked up on the client of the key the current attempt was scheduled
+    on (see keys.using()).
+    """
+
+    def __init__(self, provider, factory):
+        self.provider = provider
+        self.clients = {
+            label: factory(keys.api_key(provider, label)) for label in keys.labels(provider)
+        }
+
+    def __getattr__(self, name):
+        return getattr(self.clients[keys.current(self.provider)], name)
+
+
+def openai_client(key=None):
+    """
+    Creates an OpenAI client.
+    """
+    import openai
+
+    if key is None and keys.pool('openai'):
+        return PooledClient('openai', openai_client)
+
+    return openai.OpenAI(
+        api_key=api_key('openai', key), base_url=base_url('openai'), max_retries=0,
+        timeout=deadlines.request_timeout(),
+        http_client=openai.DefaultHttpxClient(event_hooks=pacing.response_hooks('openai')),
+    )
+
+
+def anthropic_client(key=None):
+    """
+    Creates an Anthropic client.
+    """
+    import anthropic
+
+    if key is None and keys.pool('anthropic'):
+        return PooledClient('anthropic', anthropic_client)
+    return anthropic.Anthropic(
+        api_key=api_key('anthropic', key), base_url=base_url('anthropic'), max_retries=0,
+        timeout=deadlines.request_timeout(),
+        http_client=anthropic.DefaultHttpxClient(
+            event_hooks=pacing.response_hooks('anthropic')
+        ),
+    )
+
+
+def gemini_chat(model, temperature=0, key=None):
+    """
+    Creates a LangChain Gemini chat model.
+
+    Parameters:
+    model (str): Model name, e.g. 'models/gemini-1.5-pro-latest'.
+    temperature (float): Sampling temperature.
+    key (str): API key; defaults to the GOOGLE_API_KEYS pool or GOOGLE_API_KEY.
+    """
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    if key is None and keys.pool('gemini'):
+        return PooledClient('gemini', lambda pool_key: gemini_chat(model, temperature, pool_key))
+    options = {
+        'model': model, 'temperature': temperature, 'max_retries': 0,
+        'timeout': deadlines.request_timeout(),
+    }
+    google_api_key = api_key('gemini', key)
+    if google_api_key:
+        options['google_api_key'] = google_api_key
+
+    url = base_url('gemini')
+    if url:
+        fields = getattr(ChatGoogleGenerativeAI, 'model_fields', None) or \
+            ChatGoogleGenerativeAI.__fields__
+        if 'base_url' in fields:
+            options['base_url'] = url
+        else:
+            options['client_options'] = {'api_endpoint': url}
+            options['transport'] = 'rest'
+    return ChatGoogleGenerativeAI(**options)
+
+
+def response_text(provider, response):
+    """
+    Returns the generated text of a provider response object.
+    """
+    if provider == 'openai':
+        return response.choices[0].message.content or ''
+    if provider == 'anthropic':
+        if not response.content:
+            return ''
+        block = response.content[0]
+        if getattr(block, 'type', None) == 'tool_use':
+            # Forced tool call of VLM_STRUCTURED_OUTPUT: the input is the answer.
+            return json.dumps(block.input, ensure_ascii=False)
+        return block.text
+    return response.content if isinstance(response.content, str) else ''
+
+
+def response_problem(provider, response):
+    """
+    Tells whether a successful response still has to be retried.
+
+    Returns:
+    str: 'refusal' for "I'm sorry, but ..." answers, 'empty_response' for
+    truncated Gemini answers, or None for a usable response.
+    """
+    text = response_text(provider, response)
+    if text.startswith(REFUSAL_PREFIX):
+        return 'refusal'
+    if provider == 'gemini' and len(text) < 10:
+        return 'empty_response'
+    return None
@@ -0,0 +1,265 @@
+import os
+import re
+import glob
+import json
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from nejm_vlm import structured
+
+# Result folder prefix for each model, relative to the task directory.
+MODEL_FOLDERS = {
+    'gpt4v': 'gpt4v_result/gpt4v_result',
+    'gpt4o': 'gpt4o_result/gpt4o_result',
+    'gemini': 'gemini_result/gemini_result',
+    'gemini_flash': 'gemini_flash_result/gemini_flash_result',
+    'Claude': 'Claude_result/Claude_result',
+}
+
+# Task directories, relative to the repository root.
+TASK_FOLDERS = {
+    'full': '.',
+    'img-only': '2_img-only_task',
+    'no-img': '3_no-img_task',
+}
+
+CASE_LIST_FILE = 'NEJM_list.xlsx'
+CASE_COLUMN = 'PPT No.'
+ANSWER_COLUMN = 'Answer'
+DEFAULT_CASES = list(range(1, 273))
+
+RUN_FOLDER_PATTERN = re.compile(r'_temp_(?P<temperature>[0-9_]+)_try(?P<try>\d+)$')
+ANSWER_PATTERN = re.compile(
+    r'\{[^{}]*"answer":\s*"([^"]*)"[^{}]*"reason":\s*"([^"]*"[^{}]*)\}'
+)
+
+# Answers for every run of every model, see load_answer_tensor().
+AnswerTensor = namedtuple(
+    'AnswerTensor',
+    ['answers', 'present', 'models', 'temperatures', 'tries', 'cases'],
+)
+
+
+def parse_temperature(token):
+    """
+    Converts the temperature token of a result folder name back to a number.
+
+    Parameters:
+    token (str): Temperature as written by create_result_folder, e.g. '0_5'.
+
+    Returns:
+    float: The temperature, e.g. 0.5.
+    """
+    return float(token.replace('_', '.'))
+
+
+def find_runs(base_folder):
+    """
+    Finds the result folders written for every temperature and try.
+
+    Parameters:
+    base_folder (str): Result folder prefix, e.g. 'gpt4o_result/gpt4o_result'.
+
+    Returns:
+    list: (temperature, try_number, folder_path) tuples sorted by temperature
+    and try.
+    """
+    runs = []
+    for folder_path in glob.glob(f'{base_folder}_temp_*_try*'):
+        match = RUN_FOLDER_PATTERN.search(folder_path)
+        if match and os.path.isdir(folder_path):
+            runs.append((
+                parse_temperature(match.group('temperature')),
+                int(match.group('try')),
+                folder_path,
+            ))
+    return sorted(runs)
+
+
+def result_file_path(folder_path, case_number):
+    """
+    Returns the path of the raw model response for a case.
+    """
+    return os.path.join(folder_path, f'img_page{case_number}_0.png.txt')
+
+
+def extract_json_fields(text):
+    """
+    Extracts the JSON object from a raw model response.
+
+    Parameters:
+    text (str): Raw response text, possibly wrapped in prose or code fences.
+
+    Returns:
+    dict: The decoded object, or None if no object could be decoded, even
+    after the repairs of nejm_vlm.structured.load_json().
+    """
+    try:
+        return structured.load_json(text)
+    except json.JSONDecodeError:
+        return None
+
+
+def extract_answer_and_reason(text):
+    """
+    Extracts 'answer' and 'reason' from a raw model response.
+
+    Falls back to the regex used by 4.1.VLM-results-integration.py when the
+    response is not valid JSON.
+
+    Parameters:
+    text (str): Raw response text.
+
+    Returns:
+    dict: A dictionary containing 'answer' and 'reason'.
+    """
+    data = extract_json_fields(text)
+    if data is not None and 'answer' in data:
+        return {'answer': str(data['answer']), 'reason': str(data.get('reason', ''))}
+
+    match = ANSWER_PATTERN.search(text)
+    if match:
+        return {'answer': match.group(1), 'reason': match.group(2)}
+    return {'answer': '', 'reason': text}
+
+
+def parse_option_number(answer):
+    """
+    Parses the option number out of an answer such as '3' or 'Option 3'.
+
+    Returns:
+    int: The option number, or 0 if the answer holds no number.
+    """
+    if answer is None or (isinstance(answer, float) and np.isnan(answer)):
+        return 0
+    match = re.search(r'\d+', str(answer))
+    return int(match.group()) if match else 0
+
+
+def read_result_text(folder_path, case_number):
+    """
+    Reads the raw response for a case, or returns None if it was not saved.
+    """
+    try:
+        with open(result_file_path(folder_path, case_number), 'r', encoding='utf-8') as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def load_case_list(task_dir='.', list_file=CASE_LIST_FILE):
+    """
+    Loads the case list with the radiologists' labels.
+
+    Parameters:
+    task_dir (str): Directory holding the case list.
+    list_file (str): Name of the case list file.
+
+    Returns:
+    DataFrame: The case list, or None if the file does not exist.
+    """
+    list_path = os.path.join(task_dir, list_file)
+    if not os.path.exists(list_path):
+        return None
+    return pd.read_excel(list_path)
+
+
+def case_numbers(case_list):
+    """
+    Returns the case numbers of a case list, or cases 1-272 if it is missing.
+    """
+    if case_list is None or CASE_COLUMN not in case_list:
+        return list(DEFAULT_CASES)
+    return [int(number) for number in case_list[CASE_COLUMN]]
+
+
+def load_labels(case_list, cases, answer_column=ANSWER_COLUMN):
+    """
+    Loads the correct option number for each case.
+
+    Parameters:
+    case_list (DataFrame): Case list loaded with load_case_list().
+    cases (list): Case numbers defining the case axis.
+    answer_column (str): Column holding the correct option.
+
+    Returns:
+    ndarray: int16 array of shape (case,), 0 where the label is missing.
+    """
+    if case_list is None or answer_column not in case_list:
+        raise KeyError(f"Column '{answer_column}' not found in the case list")
+    by_case = dict(zip(case_list[CASE_COLUMN].astype(int), case_list[answer_column]))
+    return np.array(
+        [parse_option_number(by_case.get(case)) for case in cases], dtype=np.int16
+    )
+
+
+def load_strata(case_list, cases, columns):
+    """
+    Loads per-case stratum values such as section, modality or body part.
+
+    Parameters:
+    case_list (DataFrame): Case list loaded with load_case_list().
+    cases (list): Case numbers defining the case axis.
+    columns (list): Case list columns to use as strata.
+
+    Returns:
+    dict: Column name -> object array of shape (case,) with the stratum value.
+    """
+    strata = {}
+    for column in columns:
+        if case_list is None or column not in case_list:
+            print(f"Stratum column not found in the case list: {column}")
+            continue
+        by_case = dict(zip(
+            case_list[CASE_COLUMN].astype(int), case_list[column].fillna('')
+        ))
+        strata[column] = np.array(
+            [str(by_case.get(case, '')).strip() for case in cases], dtype=object
+        )
+    return strata
+
+
+def load_answer_tensor(task_dir='.', models=None, cases=None):
+    """
+    Loads every saved answer of every run into a single integer array.
+
+    Parameters:
+    task_dir (str): Task directory holding the `*_result` folders.
+    models (list): Model names from MODEL_FOLDERS; defaults to all of them.
+    cases (list): Case numbers; defaults to the case list of the task.
+
+    Returns:
+    AnswerTensor: `answers` has shape (model, temperature, try, case) and
+    holds the chosen option number (0 = no answer). `present` has shape
+    (model, temperature, try) and is False where the run folder is missing.
+    """
+    models = list(models or MODEL_FOLDERS)
+    if cases is None:
+        cases = case_numbers(load_case_list(task_dir))
+
+    runs_by_model = {
+        model: find_runs(os.path.join(task_dir, MODEL_FOLDERS[model]))
+        for model in models
+    }
+    temperatures = sorted({run[0] for runs in runs_by_model.values() for run in runs})
+    tries = sorted({run[1] for runs in runs_by_model.values() for run in runs})
+
+    answers = np.zeros(
+        (len(models), len(temperatures), len(tries), len(cases)), dtype=np.int16
+    )
+    present = np.zeros((len(models), len(temperatures), len(tries)), dtype=bool)
+
+    for m, model in enumerate(models):
+        for temperature, try_number, folder_path in runs_by_model[model]:
+            t = temperatures.index(temperature)
+            r = tries.index(try_number)
+            present[m, t, r] = True
+            for c, case_number in enumerate(cases):
+                text = read_result_text(folder_path, case_number)
+                if text is not None:
+                    answer = extract_answer_and_reason(text)['answer']
+                    answers[m, t, r, c] = parse_option_number(answer)
+
+    return AnswerTensor(answers, present, models, temperatures, tries, list(cases))
@@ -0,0 +1,487 @@
+"""
+Shared retry engine for the provider calls of the runners.
+
+Provider errors are classified, and each class gets its own action:
+
+    rate_limit         back off with jitter, honoring Retry-After
+    overloaded         back off with jitter
+    transient          back off with jitter (5xx, connection errors)
+    timeout            back off with jitter (the attempt hit VLM_REQUEST_TIMEOUT)
+    payload_too_large  downscale the images and retry (image_parse_error, 413)
+    content_policy     downscale the images more aggressively and retry
+    refusal            retry ("I'm sorry, but ..." answers)
+    empty_response     downscale the images and retry (truncated Gemini answers)
+    quota              pause the provider until the quota resets, or stop the run
+    auth               fail fast
+    invalid_request    fail fast
+    cache_miss         fail fast (replay mode without a recorded response)
+    deadline           fail fast (the run deadline VLM_RUN_DEADLINE has passed)
+    shutdown           fail fast (the runner was asked to stop, see nejm_vlm.shutdown)
+    circuit_open       fail fast (stop requested while the model's circuit was open)
+
+Every attempt holds a paced concurrency slot (nejm_vlm.pacing); rate-limit
+and overload errors halve the model's concurrency limit. Every retry is
+counted in `metrics`; report() prints the totals.
+
+Every attempt runs under the deadlines of nejm_vlm.deadlines. A timed-out
+attempt frees its concurrency slot at once, and a request that fails by
+timing out can be written to the timeout ledger (record_timeout) so that the
+case is rerun later. Outage errors feed the model's circuit breaker
+(nejm_vlm.circuit); while it is open, attempts wait instead of failing.
+
+With a key pool (nejm_vlm.keys), every attempt is scheduled on the
+least-loaded key, and pacing, circuit breakers and quota pauses are kept per
+key. A key with an exhausted quota is parked while other keys remain.
+"""
+import csv
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from functools import partial
+from email.utils import parsedate_to_datetime
+
+from nejm_vlm import circuit
+from nejm_vlm import deadlines
+from nejm_vlm import hedging
+from nejm_vlm import keys
+from nejm_vlm import pacing
+from nejm_vlm import providers
+from nejm_vlm import shutdown
+from nejm_vlm import usage
+
+MAX_ATTEMPTS = 10
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+
+BACKOFF = 'backoff'
+DOWNSCALE = 'downscale'
+RETRY = 'retry'
+PAUSE = 'pause'
+FAIL = 'fail'
+
+ACTIONS = {
+    'rate_limit': BACKOFF,
+    'overloaded': BACKOFF,
+    'transient': BACKOFF,
+    'timeout': BACKOFF,
+    'payload_too_large': DOWNSCALE,
+    'content_policy': DOWNSCALE,
+    'empty_response': DOWNSCALE,
+    'refusal': RETRY,
+    'quota': PAUSE,
+    'auth': FAIL,
+    'invalid_request': FAIL,
+    'cache_miss': FAIL,
+    'deadline': FAIL,
+    'shutdown': FAIL,
+    'circuit_open': FAIL,
+}
+TIMEOUT_CLASSES = ('timeout', 'deadline')
+# Errors raised before the request reached the provider.
+LOCAL_CLASSES = ('deadline', 'shutdown', 'circuit_open', 'cache_miss')
+
+# Timed-out requests, written to the working directory of the runner.
+TIMEOUT_LEDGER = 'timed_out_requests.csv'
+TIMEOUT_LEDGER_COLUMNS = [
+    'result_file', 'number', 'temperature', 'try', 'error_class', 'recorded_at',
+]
+
+# Resize factor applied to the images for each downscaling error class.
+DOWNSCALE_FACTORS = {
+    'payload_too_large': 0.9,
+    'empty_response': 0.9,
+    'content_policy': 0.7,
+}
+
+QUOTA_MARKERS = (
+    'insufficient_quota', 'exceeded your current quota', 'usage limit', 'credit balance',
+)
+PAYLOAD_MARKERS = (
+    'image_parse_error', 'too large', 'request_too_large', 'could not process image',
+    'payload size',
+)
+# A case whose prompt does not fit the model fails on its own.
+CONTEXT_LENGTH_MARKERS = (
+    'context_length_exceeded', 'context length', 'context window', 'prompt is too long',
+    'max_tokens',
+)
+CONTENT_POLICY_MARKERS = ('safety', 'content_policy', 'content policy', 'blocked')
+
+# Longest pause waited out when a quota error tells when the quota resets.
+MAX_QUOTA_PAUSE = 15 * 60
+
+metrics = Counter()
+_lock = threading.Lock()
+_last_failure = threading.local()
+
+
+class RequestFailed(Exception):
+    """
+    Raised when a request cannot be completed.
+
+    Attributes:
+    error_class (str): Class of the last error, see ACTIONS.
+    attempts (int): Number of attempts made.
+    """
+
+    def __init__(self, message, error_class, attempts):
+        super().__init__(message)
+        self.error_class = error_class
+        self.attempts = attempts
+
+
+class QuotaExhausted(RequestFailed):
+    """
+    Raised when the provider quota is used up and does not reset soon.
+    """
+
+
+class RequestTimedOut(RequestFailed):
+    """
+    Raised when a request fails by timing out or by reaching the run deadline.
+    """
+
+
+class StopRequested(Exception):
+    """
+    Raised instead of retrying once the runner has been asked to stop.
+    """
+
+
+class ResponseRejected(Exception):
+    """
+    Raised for a successful API response that must be retried anyway.
+    """
+
+    def __init__(self, error_class, text):
+        super().__init__(f"{error_class}: {text[:80]!r}")
+        self.error_class = error_class
+
+
+def status_code(error):
+    """
+    Returns the HTTP status code of a provider exception, if any.
+    """
+    for attribute in ('status_code', 'code', 'status'):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, 'response', None)
+    value = getattr(response, 'status_code', None)
+    return value if isinstance(value, int) else None
+
+
+def classify_error(error):
+    """
+    Maps a provider exception onto an error class.
+
+    Parameters:
+    error (Exception): Exception raised by an SDK call (or ResponseRejected).
+
+    Returns:
+    str: One of the keys of ACTIONS.
+    """
+    if isinstance(error, ResponseRejected):
+        return error.error_class
+    if type(error).__name__ == 'CacheMiss':
+        return 'cache_miss'
+    if isinstance(error, deadlines.RunDeadlineExceeded):
+        return 'deadline'
+    if isinstance(error, StopRequested):
+        return 'shutdown'
+    if isinstance(error, circuit.CircuitOpen):
+        return 'circuit_open'
+
+    message = str(error).lower()
+    status = status_code(error)
+    name = type(error).__name__.lower()
+    if 'timeout' in name or 'timed out' in message or status == 408:
+        return 'timeout'
+    rate_limited = (
+        status == 429 or 'rate limit' in message or 'rate_limit' in message
+        or 'resource_exhausted' in message or 'resource has been exhausted' in message
+        or 'ratelimit' in name
+    )
+
+    if any(marker in message for marker in PAYLOAD_MARKERS) or status == 413:
+        return 'payload_too_large'
+    if any(marker in message for marker in CONTEXT_LENGTH_MARKERS):
+        return 'invalid_request'
+    if any(marker in message for marker in QUOTA_MARKERS):
+        return 'quota'
+    if any(marker in message for marker in CONTENT_POLICY_MARKERS):
+        return 'content_policy'
+    if rate_limited:
+        return 'rate_limit'
+    if status in (503, 529) or 'overloaded' in message or 'unavailable' in message:
+        return 'overloaded'
+    if status in (401, 403) or 'authentication' in message or 'api key' in message \
+            or 'permission' in name:
+        return 'auth'
+    if status is not None and 400 <= status < 500 and status not in (408, 409):
+        return 'invalid_request'
+    return 'transient'
+
+
+def retry_after(error):
+    """
+    Returns the server-requested delay in seconds, or None.
+
+    Reads the Retry-After / retry-after-ms headers and falls back to the
+    "try again in 1.5s" hint of OpenAI rate-limit messages.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    match = re.search(r'try again in ([\d.]+)\s*(ms|s)', str(error))
+    if match:
+        seconds = float(match.group(1))
+        return seconds / 1000 if match.group(2) == 'ms' else seconds
+    return None
+
+
+def backoff_delay(attempt, base_delay=BASE_DELAY, max_delay=MAX_DELAY, server_delay=None):
+    """
+    Computes a full-jitter exponential backoff delay.
+
+    A server-requested delay is honored and a little jitter is added to it,
+    so that parallel workers do not retry in lockstep.
+    """
+    if server_delay is not None:
+        return min(max_delay, server_delay) + random.uniform(0, base_delay)
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def wait_for_pause(provider, label=None):
+    """
+    Blocks while the provider (or one of its pooled keys) is paused after a
+    quota error.
+    """
+    delay = keys.paused_until(provider, label) - time.time()
+    if delay > 0:
+        name = provider if label is None else f"{provider} {label}"
+        print(f"{name} is paused for {delay:.0f} seconds (quota)")
+        if shutdown.wait(delay):
+            raise StopRequested(f"Stop requested ({shutdown.reason()})")
+
+
+def pause_provider(provider, seconds, label=None):
+    """
+    Pauses every request to a provider (or one of its pooled keys) for the
+    given time.
+    """
+    keys.pause(provider, label, seconds)
+
+
+def check_response(provider, response):
+    """
+    Raises ResponseRejected for refusals and truncated answers.
+    """
+    problem = providers.response_problem(provider, response)
+    if problem:
+        raise ResponseRejected(problem, providers.response_text(provider, response))
+    return response
+
+
+def paced_send(provider, model, label, send, encoded_images, timeout):
+    """
+    Sends one attempt on a key while holding a paced concurrency slot of the
+    model on that key.
+
+    The slot is released as soon as the attempt times out.
+    """
+    name = keys.lane(model, label)
+    with pacing.slot(provider, name):
+        return deadlines.call_with_timeout(
+            partial(keys.using, provider, label,
+                    pacing.attributed, provider, name, send, encoded_images),
+            timeout,
+        )
+
+
+def checked_send(provider, model, label, send, encoded_images, timeout):
+    """
+    Sends one attempt with paced_send() and rejects an unusable response, so
+    that a hedged duplicate wins only with a usable answer.
+    """
+    return check_response(
+        provider, paced_send(provider, model, label, send, encoded_images, timeout)
+    )
+
+
+def failure(message, error_class, attempts, exception_class=RequestFailed):
+    """
+    Builds the exception of a failed request and remembers its error class
+    for record_timeout().
+    """
+    _last_failure.error_class = error_class
+    if error_class in TIMEOUT_CLASSES:
+        exception_class = RequestTimedOut
+    return exception_class(message, error_class, attempts)
+
+
+def call_with_retry(send, provider, model, encoded_images=None, downscale=None,
+                    max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                    hedge=False):
+    """
+    Sends a request, retrying according to the class of every error.
+
+    Parameters:
+    send (function): Called with the current list of encoded images; returns
+    the SDK response.
+    provider (str): 'openai', 'anthropic' or 'gemini'.
+    model (str): Model name, used in the metrics.
+    encoded_images (list): Base64-encoded images of the request.
+    downscale (function): Called with (encoded_images, resize_factor); returns
+    smaller images. Without it, downscaling errors are retried as they are.
+    max_attempts (int): Attempts before giving up.
+    base_delay (float): Initial backoff delay in seconds.
+    max_delay (float): Longest single backoff delay in seconds.
+    hedge (bool): Whether the request is idempotent, so that a slow attempt
+    may be duplicated (see nejm_vlm.hedging).
+
+    Returns:
+    object: The SDK response.
+
+    Raises:
+    QuotaExhausted: The quota is used up and does not reset soon; the runner
+    is asked to stop (see nejm_vlm.shutdown).
+    RequestTimedOut: The last attempt timed out, or the run deadline passed.
+    RequestFailed: All attempts failed, or the error is not retryable.
+    """
+    encoded_images = list(encoded_images or [])
+    _last_failure.error_class = None
+    error_class = None
+    attempt = 0
+    while attempt < max_attempts:
+        attempt += 1
+        probe = None
+        label = keys.choose(provider, model)
+        pacer = pacing.get_pacer(provider, keys.lane(model, label))
+        breaker = circuit.get_breaker(provider, keys.lane(model, label))
+        try:
+            wait_for_pause(provider, label)
+            if shutdown.requested() and attempt > 1:
+                raise StopRequested(f"Stop requested ({shutdown.reason()})")
+            probe = breaker.acquire()
+            timeout = deadlines.attempt_timeout()
+            response = hedging.call(
+                partial(checked_send, provider, model, label, send, encoded_images, timeout),
+                provider, model, hedge,
+            )
+            pacer.on_success()
+            breaker.record(probe)
+            metrics[(provider, model, 'success')] += 1
+            return response
+        except Exception as e:
+            error_class = classify_error(e)
+            action = ACTIONS[error_class]
+            metrics[(provider, model, error_class)] += 1
+            if probe is not None and error_class in LOCAL_CLASSES:
+                breaker.release(probe)
+            elif isinstance(e, ResponseRejected):
+                # The provider answered, only not usably.
+                pacer.on_success()
+                breaker.record(probe)
+            elif probe is not None:
+                breaker.record(probe, error_class)
+            if error_class in ('rate_limit', 'overloaded'):
+                pacer.on_rate_limit(retry_after(e))
+            print(
+                f"{provider} {model}: {error_class} ({action}), attempt "
+                f"{attempt}/{max_attempts}: {str(e)[:200]}"
+            )
+
+            if action == FAIL:
+                raise failure(str(e), error_class, attempt) from e
+            if action == PAUSE:
+                delay = retry_after(e)
+                if delay is None or delay > MAX_QUOTA_PAUSE:
+                    if shutdown.quota_mode() != 'wait' and not keys.spare(provider, label):
+                        shutdown.request(f"{provider} quota exhausted")
+                        raise failure(str(e), error_class, attempt, QuotaExhausted) from e
+                    delay = delay or shutdown.quota_recheck()
+                    # Waiting out an exhausted quota (or moving on to another
+                    # key) does not use up an attempt.
+                    attempt -= 1
+                pause_provider(provider, delay, label)
+                continue
+            if error_class in circuit.OUTAGE_CLASSES and breaker.state != circuit.CLOSED:
+                # The open circuit paces the retries, and a failed probe does
+                # not use up an attempt.
+                if probe:
+                    attempt -= 1
+                continue
+            if attempt == max_attempts:
+                break
+            metrics[(provider, model, 'retries')] += 1
+
+            if action == BACKOFF:
+                delay = backoff_delay(attempt - 1, base_delay, max_delay, retry_after(e))
+                try:
+                    deadlines.sleep(delay)
+                except deadlines.RunDeadlineExceeded as deadline_error:
+                    raise failure(str(deadline_error), 'deadline', attempt) from e
+                metrics[(provider, model, 'backoff_seconds')] += delay
+            elif action == DOWNSCALE and downscale is not None and encoded_images:
+                print(f"Resizing images and retrying. Attempt {attempt}/{max_attempts}")
+                encoded_images = downscale(encoded_images, DOWNSCALE_FACTORS[error_class])
+
+    raise failure(
+        f"{provider} {model}: giving up after {max_attempts} attempts ({error_class})",
+        error_class, max_attempts,
+    )
+
+
+def record_timeout(result_file_path, case_number, temperature, try_number):
+    """
+    Writes a case to the timeout ledger if its last request on this thread
+    failed by timing out, so that it is not silently lost.
+
+    Returns:
+    bool: Whether the case was recorded.
+    """
+    error_class = getattr(_last_failure, 'error_class', None)
+    if error_class not in TIMEOUT_CLASSES:
+        return False
+    new_file = not os.path.exists(TIMEOUT_LEDGER)
+    with _lock, open(TIMEOUT_LEDGER, 'a', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        if new_file:
+            writer.writerow(TIMEOUT_LEDGER_COLUMNS)
+        writer.writerow([
+            result_file_path, case_number, temperature, try_number, error_class,
+            time.strftime('%Y-%m-%d %H:%M:%S'),
+        ])
+    _last_failure.error_class = None
+    print(f"Case {case_number} timed out ({error_class}); recorded in {TIMEOUT_LEDGER}")
+    return True
+
+
+def report():
+    """
+    Prints the request outcome and retry counters.
+    """
+    if metrics:
+        print("Retry metrics:")
+        for (provider, model, name), value in sorted(metrics.items()):
+            value = f"{value:.1f}" if name == 'backoff_seconds' else value
+            print(f"  {provider} {model} {name}: {value}")
+    pacing.report()
+    keys.report()
+    hedging.report()
+    circuit.report()
+    usage.report()
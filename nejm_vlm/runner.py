@@ -0,0 +1,813 @@
+"""
+Unified runner for every model and task, with static sharding of the cases.
+
+    python -m nejm_vlm.runner --models gpt4o Claude --tasks full --shard 2/4
+    python -m nejm_vlm.runner --models gpt4o Claude --tasks full --merge
+
+The case manifest (NEJM_list.xlsx of the task) is partitioned by position:
+shard i of N takes every N-th case starting with the i-th, so N workers on
+different machines (or with different API keys) cover the manifest once,
+without overlap. The requests, prompts and result files are those of the
+numbered scripts, and the results go to the same `<model>_result` folders.
+
+Each shard keeps its execution times in its own file next to the model's
+store (e.g. OpenAI_gpt4o_execution_times.shard2of4.xlsx), so shards sharing a
+filesystem never overwrite each other. --merge folds the shard files into the
+store and rebuilds the results sheet of every run from its result files; run
+it once the result folders of all workers have been copied together.
+
+Unlike 2.1.2.gpt4o-img_only.py, which requests gpt-4-turbo, the gpt4o model
+always requests gpt-4o. The no-img Gemini scripts wrap their prompt over
+more lines; the text is the same, and so is its cache key.
+
+The prompts come from nejm_vlm.prompts. VLM_PROMPT_LAYOUT=compact sends them
+dedented; VLM_PROMPT_LAYOUT=prefix also reorders them for the providers'
+prompt caches: the instructions and output format, identical for every case
+of a task, come first as a separate text block (marked with cache_control
+for Anthropic), followed by the case's question and image. Anthropic and
+OpenAI only cache prefixes of 1024 tokens or more, which the current
+instructions do not reach. The default layout, 'script', sends the prompts
+of the numbered scripts unchanged.
+
+--answer-only asks for the option number alone, for accuracy-only sweeps:
+the full and no-img requests are sent with the answer-only prompt, a
+max_tokens of ANSWER_ONLY_MAX_TOKENS and the closing brace as stop sequence,
+and their results go to `<model>_result_answer_only` folders, so the
+canonical runs with reasons are left alone. The execution-time store records
+the mode and the output tokens of every request, and each run ends with the
+latency and output-token savings of the answer-only requests per model.
+
+--logprobs K asks the OpenAI models for the K most likely alternatives of
+every output token and saves the distribution over the option numbers of
+each answer next to its result file, for the calibration and consensus
+analyses of nejm_vlm.logprobs.
+"""
+import argparse
+import base64
+import glob
+import io
+import json
+import os
+import re
+import time
+from collections import namedtuple
+
+import pandas as pd
+
+from nejm_vlm import cache
+from nejm_vlm import logprobs
+from nejm_vlm import packing
+from nejm_vlm import prompts
+from nejm_vlm import providers
+from nejm_vlm import results
+from nejm_vlm import retry
+from nejm_vlm import shutdown
+from nejm_vlm import structured
+from nejm_vlm import uploads
+from nejm_vlm import usage
+
+# provider, API model name, execution-time store, per-run results sheet and
+# pause in seconds before every request.
+Model = namedtuple('Model', ['provider', 'name', 'time_file', 'results_file', 'pause'])
+
+MODELS = {
+    'gpt4v': Model('openai', 'gpt-4-turbo', 'OpenAI_execution_times.xlsx',
+                   'analysis_results.xlsx', 0),
+    'gpt4o': Model('openai', 'gpt-4o', 'OpenAI_gpt4o_execution_times.xlsx',
+                   'analysis_results.xlsx', 0),
+    'gemini': Model('gemini', 'models/gemini-1.5-pro-latest', 'Gemini_execution_times.xlsx',
+                    'gemini_results.xlsx', 15),
+    'gemini_flash': Model('gemini', 'models/gemini-1.5-flash-latest',
+                          'Gemini_flash_execution_times.xlsx', 'gemini_flash_results.xlsx', 15),
+    'Claude': Model('anthropic', 'claude-3-opus-20240229', 'Claude_execution_times.xlsx',
+                    'claude_results.xlsx', 0),
+}
+
+MAX_TOKENS = 1024
+# Output limit and stop sequence of the answer-only requests: the response is
+# cut at the brace closing {"answer": "N"} and completed by answer_only_result().
+ANSWER_ONLY_MAX_TOKENS = 16
+STOP_SEQUENCES = ['}']
+ANSWER_ONLY_SUFFIX = '_answer_only'
+REASON_MODE = 'reason'
+ANSWER_ONLY_MODE = 'answer-only'
+IMAGE_FOLDER = 'pptimages'
+MAX_IMAGE_SIZE = 20 * 1024 * 1024  # 20MB
+TIME_COLUMNS = ['number', 'temperature', 'try', 'time']
+# Columns of the runner's execution-time rows beyond TIME_COLUMNS; rows
+# without a mode are those of reason runs.
+USAGE_COLUMNS = ['mode', 'output_tokens']
+SHARD_PATTERN = re.compile(r'^(\d+)/(\d+)$')
+
+# Results sheet column -> JSON field of the response, per task.
+RESULT_FIELDS = {
+    'full': {'answer': 'answer', 'reason': 'reason'},
+    'img-only': {
+        'TypeOfMedicalImaging': '1_TypeOfMedicalImaging',
+        'SpecificImagingSequence': '2_SpecificImagingSequence',
+        'UseOfContrast': '3_UseOfContrast',
+        'ImagePlane': '4_ImagePlane',
+        'PartOfTheBodyImaged': '5_PartOfTheBodyImaged',
+    },
+    'no-img': {'answer': 'answer', 'reason': 'reason'},
+}
+
+
+def parse_shard(value):
+    """
+    Parses a shard specification such as '2/4'.
+
+    Returns:
+    tuple: (index, count) with 1 <= index <= count.
+    """
+    match = SHARD_PATTERN.match(value.strip())
+    if not match:
+        raise argparse.ArgumentTypeError(f"Shard must look like i/N, not '{value}'")
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"Shard index must be between 1 and {count}")
+    return index, count
+
+
+def parse_temperature(value):
+    """
+    Parses a temperature, keeping whole numbers as int so that the result
+    folders are named like the scripts' (temp_1, not temp_1_0).
+    """
+    temperature = float(value)
+    return int(temperature) if temperature.is_integer() else temperature
+
+
+def shard_cases(case_list, shard):
+    """
+    Selects the rows of the case manifest that belong to a shard.
+
+    Parameters:
+    case_list (DataFrame): The case manifest.
+    shard (tuple): (index, count), see parse_shard().
+
+    Returns:
+    DataFrame: Every count-th row, starting with row index (1-based).
+    """
+    index, count = shard
+    return case_list.iloc[index - 1::count]
+
+
+def shard_time_file(time_file, shard):
+    """
+    Returns the execution-time file of a shard; an unsharded run (1/1) writes
+    to the model's store itself.
+    """
+    index, count = shard
+    if count == 1:
+        return time_file
+    stem, extension = os.path.splitext(time_file)
+    return f"{stem}.shard{index}of{count}{extension}"
+
+
+def build_prompt(task, row, answer_only=False):
+    """
+    Returns the prompt of a case in the layout selected by VLM_PROMPT_LAYOUT
+    (see nejm_vlm.prompts).
+    """
+    return prompts.render(task, f"symptom: {row['Q']}", answer_only=answer_only)
+
+
+def case_inputs(task, row, answer_only=False):
+    """
+    Returns the prompt and the encoded images of a case (no images for the
+    no-img task).
+    """
+    encoded_images = []
+    if task != 'no-img':
+        case_number = row[results.CASE_COLUMN]
+        encoded_images = encode_images_from_paths([os.path.join(
+            results.TASK_FOLDERS[task], IMAGE_FOLDER, f"img_page{case_number}_0.png"
+        )])
+    return build_prompt(task, row, answer_only), encoded_images
+
+
+def process_and_encode_image(image, resize_factor=0.9):
+    """
+    Process and encode an image, resizing if necessary to keep within size limits.
+    """
+    from PIL import Image
+
+    original_width, original_height = image.size
+
+    if image.mode == 'RGBA':
+        image = image.convert('RGB')
+
+    for attempt in range(5):
+        buffered = io.BytesIO()
+        new_width = int(original_width * (resize_factor ** attempt))
+        new_height = int(original_height * (resize_factor ** attempt))
+        resized_image = image.resize((new_width, new_height), Image.LANCZOS)
+        resized_image.save(buffered, format="JPEG")
+
+        if buffered.tell() < MAX_IMAGE_SIZE:
+            return base64.b64encode(buffered.getvalue()).decode("utf-8")
+        print(
+            f"Attempt {attempt + 1}: Image size is {buffered.tell()} bytes, "
+            "too large. Resizing..."
+        )
+
+    raise ValueError("Unable to reduce image size within 5 attempts")
+
+
+def resize_encoded_images(encoded_images, resize_factor):
+    """
+    Resize already encoded images by the given factor and re-encode them.
+    """
+    from PIL import Image
+
+    return [
+        process_and_encode_image(Image.open(io.BytesIO(base64.b64decode(encoded_image))),
+                                 resize_factor)
+        for encoded_image in encoded_images
+    ]
+
+
+def encode_images_from_paths(image_paths):
+    """
+    Encode the images larger than 150x150 pixels.
+    """
+    from PIL import Image
+
+    images = []
+    for image_path in image_paths:
+        with Image.open(image_path) as img:
+            width, height = img.size
+            if width > 150 and height > 150:
+                images.append(process_and_encode_image(img))
+    return images
+
+
+def stop_sequences(prompt_text):
+    """
+    Returns the stop sequences of a request: STOP_SEQUENCES for an
+    answer-only prompt, none otherwise.
+    """
+    return STOP_SEQUENCES if prompts.response_kind(prompt_text) == 'answer-only' else []
+
+
+def openai_request(model, prompt_text, encoded_images, temperature, max_tokens=MAX_TOKENS,
+                   top_logprobs=0):
+    """
+    Returns the chat-completions arguments of a case, as sent by the OpenAI
+    scripts (also the body of a Batch API request line).
+
+    A static prefix is sent as its own leading text block, so that OpenAI's
+    automatic prefix caching can reuse it across cases once it reaches 1024
+    tokens. With
+    VLM_STRUCTURED_OUTPUT, the response is constrained to the JSON schema of
+    the prompt (nejm_vlm.structured). top_logprobs > 0 requests the log
+    probabilities of that many alternatives per token (nejm_vlm.logprobs).
+    """
+    text_contents = [
+        {"type": "text", "text": text} for text in prompts.split(prompt_text) if text
+    ]
+    image_contents = [
+        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image}"}}
+        for image in encoded_images
+    ]
+    request = {
+        'model': model.name,
+        'response_format': structured.openai_response_format(model.name, prompt_text),
+        'messages': [{
+            "role": "user",
+            "content": [*text_contents, *image_contents],
+        }],
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+    }
+    if stop_sequences(prompt_text):
+        request['stop'] = stop_sequences(prompt_text)
+    if top_logprobs:
+        request['logprobs'] = True
+        request['top_logprobs'] = top_logprobs
+    return request
+
+
+def anthropic_request(model, prompt_text, encoded_images, temperature,
+                      max_tokens=MAX_TOKENS):
+    """
+    Returns the messages arguments of a case, as sent by the Claude scripts.
+
+    A static prefix is sent as its own leading text block marked with
+    cache_control, so that Anthropic's prompt cache serves it across cases
+    once it reaches 1024 tokens.
+    With VLM_STRUCTURED_OUTPUT, the answer is forced through a tool whose
+    input schema is that of the prompt (nejm_vlm.structured).
+    """
+    static_text, case_text = prompts.split(prompt_text)
+    text_contents = []
+    if static_text:
+        text_contents.append(
+            {"type": "text", "text": static_text, "cache_control": {"type": "ephemeral"}}
+        )
+    if case_text:
+        text_contents.append({"type": "text", "text": case_text})
+    image_contents = [
+        {
+            "type": "image",
+            "source": {"type": "base64", "media_type": "image/jpeg", "data": image},
+        }
+        for image in encoded_images
+    ]
+    request = {
+        'model': model.name,
+        'messages': [{
+            "role": "user",
+            "content": [*text_contents, *image_contents],
+        }],
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+        **structured.anthropic_options(prompt_text),
+    }
+    # A forced tool returns its input as a whole, without text to stop.
+    if stop_sequences(prompt_text) and 'tool_choice' not in request:
+        request['stop_sequences'] = stop_sequences(prompt_text)
+    return request
+
+
+def request_sender(model, prompt_text, temperature, try_number, max_tokens=MAX_TOKENS,
+                   top_logprobs=0):
+    """
+    Builds the send function of a request for retry.call_with_retry().
+
+    Parameters:
+    model (Model): Model to query.
+    prompt_text (str): Prompt of the case.
+    temperature (float): Sampling temperature.
+    try_number (int): Try number (part of the cache key).
+    max_tokens (int): Output token limit (set for Gemini only with an
+    answer-only prompt).
+    top_logprobs (int): Alternatives per token with logprobs (OpenAI only).
+
+    Returns:
+    function: send(encoded_images), returning the provider response.
+    """
+    if model.provider != 'openai':
+        top_logprobs = 0
+    # Cache key fields of the options that change the response (cache.request_key()).
+    key_options = {}
+    if structured.constrains(model.provider, model.name):
+        key_options['structured'] = True
+    # The prompt hash collapses whitespace, which would merge the layouts.
+    if prompts.layout() != 'script':
+        key_options['layout'] = prompts.layout()
+    if model.provider == 'openai':
+        client = providers.openai_client()
+
+        def create(encoded_images):
+            return client.chat.completions.create(
+                **openai_request(model, prompt_text, encoded_images, temperature, max_tokens,
+                                 top_logprobs)
+            )
+    elif model.provider == 'anthropic':
+        client = providers.anthropic_client()
+
+        def create(encoded_images):
+            return client.messages.create(
+                **anthropic_request(model, prompt_text, encoded_images, temperature, max_tokens)
+            )
+    else:
+        from langchain_core.messages import HumanMessage
+
+        llm = providers.gemini_chat(model.name, temperature)
+        options = structured.gemini_options(prompt_text)
+        if stop_sequences(prompt_text):
+            options['stop'] = stop_sequences(prompt_text)
+            options.setdefault('generation_config', {})['max_output_tokens'] = max_tokens
+        else:
+            max_tokens = None
+
+        def create(encoded_images):
+            content = [
+                {"type": "text", "text": text} for text in prompts.split(prompt_text) if text
+            ]
+            content += [uploads.image_part(image) for image in encoded_images]
+            return llm.invoke([HumanMessage(content=content)], **options)
+
+    def send(encoded_images):
+        encoded_images = encoded_images or []
+        return cache.cached_call(
+            model.provider, model.name, prompt_text, encoded_images, temperature,
+            max_tokens, try_number, lambda: create(encoded_images), top_logprobs,
+            key_options,
+        )
+    return send
+
+
+def analyze_case(model, prompt_text, encoded_images, temperature, try_number,
+                 max_tokens=MAX_TOKENS, top_logprobs=0):
+    """
+    Sends one case (or a packed request, see run_pack()) through the retry
+    engine.
+
+    Returns:
+    list: [response text or None, execution time in seconds, output tokens
+    or None, answer distribution or None (see logprobs.answer_distribution();
+    only with top_logprobs)]
+    """
+    send = request_sender(model, prompt_text, temperature, try_number, max_tokens,
+                          top_logprobs)
+    start_time = time.time()
+    try:
+        response = retry.call_with_retry(
+            send, model.provider, model.name, encoded_images,
+            downscale=resize_encoded_images if encoded_images else None,
+            hedge=temperature == 0,
+        )
+    except retry.RequestFailed as e:
+        print(f"Request failed: {e}")
+        return [None, time.time() - start_time, None, None]
+    return [
+        providers.response_text(model.provider, response),
+        time.time() - start_time,
+        usage.output_tokens(model.provider, response),
+        logprobs.answer_distribution(response) if top_logprobs else None,
+    ]
+
+
+def answer_only_result(text):
+    """
+    Completes an answer-only response, cut at the stop sequence, into the
+    {"answer", "reason"} form of the result files, with an empty reason.
+    """
+    answer = results.extract_answer_and_reason(text)['answer']
+    if not answer:
+        return text
+    return json.dumps({'answer': answer, 'reason': ''}, ensure_ascii=False)
+
+
+def load_execution_times(time_file):
+    if os.path.exists(time_file):
+        return with_mode(pd.read_excel(time_file))
+    return pd.DataFrame(columns=TIME_COLUMNS + USAGE_COLUMNS)
+
+
+def with_mode(df_execution_times):
+    """
+    Marks the execution-time rows without a mode (written before the mode was
+    recorded, or by the work queue and batch mode) as reason runs.
+    """
+    df_execution_times = df_execution_times.copy()
+    if 'mode' not in df_execution_times.columns:
+        df_execution_times['mode'] = REASON_MODE
+    df_execution_times['mode'] = df_execution_times['mode'].fillna(REASON_MODE)
+    return df_execution_times
+
+
+def upsert_execution_times(df_execution_times, new_rows):
+    """
+    Adds execution times, replacing those of the same mode, case, temperature
+    and try.
+    """
+    new_rows = new_rows.dropna(how='all')
+    if new_rows.empty:
+        return df_execution_times
+    new_rows = with_mode(new_rows)
+    if df_execution_times.empty:
+        return new_rows.reset_index(drop=True)
+    combined = pd.concat([with_mode(df_execution_times.dropna(how='all')), new_rows],
+                         ignore_index=True)
+    return combined.drop_duplicates(['mode', 'number', 'temperature', 'try'], keep='last') \
+        .reset_index(drop=True)
+
+
+def report_savings(model_key, task, df_execution_times):
+    """
+    Prints the mean execution time and output tokens per request of the
+    reason and answer-only runs of a model, once the store has both.
+    """
+    if 'output_tokens' not in df_execution_times.columns:
+        return
+    df_execution_times = with_mode(df_execution_times)
+    means = df_execution_times.assign(
+        time=pd.to_numeric(df_execution_times['time'], errors='coerce'),
+        output_tokens=pd.to_numeric(df_execution_times['output_tokens'], errors='coerce'),
+    ).groupby('mode')[['time', 'output_tokens']].mean()
+    if not {REASON_MODE, ANSWER_ONLY_MODE} <= set(means.index):
+        return
+    reason, answer_only = means.loc[REASON_MODE], means.loc[ANSWER_ONLY_MODE]
+    print(f"{model_key} {task} answer-only savings per request:")
+    for column, unit in (('time', 'seconds'), ('output_tokens', 'output tokens')):
+        if pd.isna(reason[column]) or pd.isna(answer_only[column]) or not reason[column]:
+            continue
+        saving = 1 - answer_only[column] / reason[column]
+        print(f"  {unit}: {reason[column]:.2f} with reasons, {answer_only[column]:.2f} "
+              f"answer-only ({saving:.0%} saved)")
+
+
+def write_results_sheet(task, model, result_folder, case_list):
+    """
+    Rebuilds the results sheet of a run from its result files, in manifest order.
+
+    The sheet is written to a temporary file and moved into place, so shards
+    finishing at the same time never leave a half-written sheet.
+    """
+    fields = RESULT_FIELDS[task]
+    rows = []
+    for case_number in results.case_numbers(case_list):
+        text = results.read_result_text(result_folder, case_number)
+        data = results.extract_json_fields(text) if text else None
+        if data is None or not all(field in data for field in fields.values()):
+            continue
+        row = {'case_number': case_number}
+        row.update({column: data[field] for column, field in fields.items()})
+        rows.append(row)
+    results_df = pd.DataFrame(rows, columns=['case_number', *fields])
+
+    excel_path = os.path.join(result_folder, model.results_file)
+    temporary_path = f"{excel_path}.{os.getpid()}.tmp.xlsx"
+    results_df.to_excel(temporary_path, index=False, engine='openpyxl')
+    os.replace(temporary_path, excel_path)
+    print(f"Results have been saved to {excel_path}.")
+
+
+def create_result_folder(model_key, task, temperature, try_number, answer_only=False):
+    """
+    Creates the result folder of a run, named as in the numbered scripts
+    (with ANSWER_ONLY_SUFFIX after the model folder for answer-only runs).
+    """
+    base_result_folder = os.path.join(results.TASK_FOLDERS[task], results.MODEL_FOLDERS[model_key])
+    if answer_only:
+        base_result_folder += ANSWER_ONLY_SUFFIX
+    folder_name = (
+        f"{base_result_folder}_temp_{str(temperature).replace('.', '_')}_try{try_number}"
+    )
+    os.makedirs(folder_name, exist_ok=True)
+    return folder_name
+
+
+def run_case(model_key, task, row, temperature, try_number, result_folder,
+             answer_only=False, top_logprobs=0):
+    """
+    Sends one case and saves its result file.
+
+    Parameters:
+    model_key (str): Key of MODELS, e.g. 'gpt4o'.
+    task (str): 'full', 'img-only' or 'no-img'.
+    row (Series): Row of the case in the case manifest.
+    temperature (float): Sampling temperature.
+    try_number (int): Try number.
+    result_folder (str): Result folder of the run.
+    answer_only (bool): Ask for the option number alone (full and no-img).
+    top_logprobs (int): Save the answer distribution from that many
+    alternatives per token (OpenAI models; 0 = none).
+
+    Returns:
+    tuple: (saved, execution_time, output_tokens)
+    """
+    model = MODELS[model_key]
+    case_number = row[results.CASE_COLUMN]
+    if model.pause:
+        time.sleep(model.pause)
+    prompt_text, encoded_images = case_inputs(task, row, answer_only)
+
+    result, execution_time, output_tokens, distribution = analyze_case(
+        model, prompt_text, encoded_images, temperature, try_number,
+        ANSWER_ONLY_MAX_TOKENS if answer_only else MAX_TOKENS, top_logprobs,
+    )
+    result_file_path = results.result_file_path(result_folder, case_number)
+    if not result:
+        retry.record_timeout(result_file_path, case_number, temperature, try_number)
+        print(f"{model_key} {task} case {case_number} (Temperature: {temperature}, "
+              f"Try: {try_number}): No result found.")
+        return False, execution_time, output_tokens
+    if answer_only:
+        result = answer_only_result(result)
+
+    with open(result_file_path, "w", encoding='utf-8') as result_file:
+        result_file.write(result)
+    if distribution is not None:
+        logprobs.save_distribution(result_folder, case_number, distribution)
+    elif top_logprobs:
+        print(f"{model_key} {task} case {case_number}: no answer token with logprobs "
+              "matching the answer")
+    print(f"{model_key} {task} case {case_number} (Temperature: {temperature}, "
+          f"Try: {try_number}): Result saved.")
+    return True, execution_time, output_tokens
+
+
+def run_pack(model_key, rows, temperature, try_number, result_folder):
+    """
+    Sends the questions of several no-img cases in one request and saves
+    their result files; the cases missing from the response are sent again
+    one by one (see nejm_vlm.packing).
+
+    Parameters:
+    model_key (str): Key of MODELS, e.g. 'gpt4o'.
+    rows (list): Rows of the cases in the case manifest.
+    temperature (float): Sampling temperature.
+    try_number (int): Try number.
+    result_folder (str): Result folder of the run.
+
+    Returns:
+    list: (case_number, saved, execution_time, output_tokens) per case; a
+    packed case is given its share of the request time and output tokens.
+    """
+    model = MODELS[model_key]
+    case_numbers = [row[results.CASE_COLUMN] for row in rows]
+    if model.pause:
+        time.sleep(model.pause)
+    prompt_text = prompts.render_packed(
+        [(row[results.CASE_COLUMN], f"symptom: {row['Q']}") for row in rows]
+    )
+    result, execution_time, output_tokens, _ = analyze_case(
+        model, prompt_text, [], temperature, try_number, packing.max_tokens(len(rows))
+    )
+    answers = packing.parse_answers(result, case_numbers)
+    print(f"{model_key} no-img cases {', '.join(str(number) for number in case_numbers)} "
+          f"(Temperature: {temperature}, Try: {try_number}): {len(answers)} of "
+          f"{len(rows)} answers in the packed response")
+
+    outcomes = []
+    for row, case_number in zip(rows, case_numbers):
+        if case_number in answers:
+            with open(results.result_file_path(result_folder, case_number), "w",
+                      encoding='utf-8') as result_file:
+                result_file.write(answers[case_number])
+            outcomes.append((case_number, True, execution_time / len(rows),
+                             output_tokens / len(rows) if output_tokens else None))
+        elif not shutdown.requested():
+            outcomes.append((case_number, *run_case(
+                model_key, 'no-img', row, temperature, try_number, result_folder
+            )))
+    return outcomes
+
+
+def run_shard(model_key, task, shard, temperatures, tries, pack=1, answer_only=False,
+              top_logprobs=0):
+    """
+    Runs one shard of the cases of a task on a model.
+
+    Parameters:
+    model_key (str): Key of MODELS, e.g. 'gpt4o'.
+    task (str): 'full', 'img-only' or 'no-img'.
+    shard (tuple): (index, count), see parse_shard().
+    temperatures (list): Temperatures to run.
+    tries (int): Number of tries per temperature.
+    pack (int): Questions per request of the no-img task (see run_pack()).
+    answer_only (bool): Ask for the option number alone; the img-only task
+    has none and is run as usual.
+    top_logprobs (int): Save answer distributions (see run_case()); ignored
+    for the img-only task and the models of other providers.
+    """
+    model = MODELS[model_key]
+    task_dir = results.TASK_FOLDERS[task]
+    case_list = results.load_case_list(task_dir)
+    if case_list is None:
+        print(f"No {results.CASE_LIST_FILE} in {task_dir}, skipping {model_key} {task}")
+        return
+    cases = shard_cases(case_list, shard)
+    answer_only = answer_only and task != 'img-only'
+    if top_logprobs and (model.provider != 'openai' or task == 'img-only'):
+        print(f"No answer logprobs for {model_key} {task}: only the OpenAI models "
+              f"answering option numbers have them")
+        top_logprobs = 0
+    mode = ANSWER_ONLY_MODE if answer_only else REASON_MODE
+    print(f"{model_key} {task}: shard {shard[0]}/{shard[1]}, "
+          f"{len(cases)} of {len(case_list)} cases ({mode})")
+
+    time_file = os.path.join(task_dir, shard_time_file(model.time_file, shard))
+    df_execution_times = load_execution_times(time_file)
+
+    for temperature in temperatures:
+        for try_number in range(1, tries + 1):
+            if shutdown.requested():
+                break
+            result_folder = create_result_folder(
+                model_key, task, temperature, try_number, answer_only
+            )
+            new_times = []
+            pending = []
+
+            for index, row in cases.iterrows():
+                case_number = row[results.CASE_COLUMN]
+                if os.path.exists(results.result_file_path(result_folder, case_number)):
+                    print(f"Case {case_number} (Temperature: {temperature}, "
+                          f"Try: {try_number}): skip")
+                    continue
+                pending.append(row)
+
+            if task == 'no-img' and pack > 1:
+                for rows in packing.chunks(pending, pack):
+                    if shutdown.requested():
+                        break
+                    for case_number, saved, execution_time, output_tokens in run_pack(
+                        model_key, rows, temperature, try_number, result_folder
+                    ):
+                        new_times.append({
+                            'number': case_number,
+                            'temperature': temperature,
+                            'try': try_number,
+                            'time': execution_time,
+                            'mode': mode,
+                            'output_tokens': output_tokens,
+                        })
+                pending = []
+
+            for row in pending:
+                if shutdown.requested():
+                    break
+                case_number = row[results.CASE_COLUMN]
+                saved, execution_time, output_tokens = run_case(
+                    model_key, task, row, temperature, try_number, result_folder, answer_only,
+                    top_logprobs,
+                )
+                new_times.append({
+                    'number': case_number,
+                    'temperature': temperature,
+                    'try': try_number,
+                    'time': execution_time,
+                    'mode': mode,
+                    'output_tokens': output_tokens,
+                })
+
+            df_execution_times = upsert_execution_times(
+                df_execution_times, pd.DataFrame(new_times, columns=TIME_COLUMNS + USAGE_COLUMNS)
+            )
+            write_results_sheet(task, model, result_folder, case_list)
+
+    df_execution_times.to_excel(time_file, index=False, engine='openpyxl')
+    print(f"Execution times saved to {time_file}")
+    report_savings(model_key, task, df_execution_times)
+
+
+def merge_shards(model_key, task):
+    """
+    Folds the shard execution-time files of a model into its store and
+    rebuilds the results sheet of every run.
+    """
+    model = MODELS[model_key]
+    task_dir = results.TASK_FOLDERS[task]
+    time_file = os.path.join(task_dir, model.time_file)
+    stem, extension = os.path.splitext(time_file)
+    shard_files = sorted(glob.glob(f"{glob.escape(stem)}.shard*of*{extension}"))
+
+    df_execution_times = load_execution_times(time_file)
+    for shard_file in shard_files:
+        df_execution_times = upsert_execution_times(df_execution_times, pd.read_excel(shard_file))
+    if shard_files:
+        df_execution_times = df_execution_times.sort_values(
+            ['mode', 'temperature', 'try', 'number']
+        )
+        df_execution_times.to_excel(time_file, index=False, engine='openpyxl')
+        print(f"{len(shard_files)} shard files merged into {time_file}")
+        report_savings(model_key, task, df_execution_times)
+
+    case_list = results.load_case_list(task_dir)
+    base_result_folder = os.path.join(task_dir, results.MODEL_FOLDERS[model_key])
+    for suffix in ('', ANSWER_ONLY_SUFFIX):
+        for temperature, try_number, folder_path in results.find_runs(base_result_folder + suffix):
+            write_results_sheet(task, model, folder_path, case_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--models', nargs='*', default=list(MODELS), choices=list(MODELS))
+    parser.add_argument('--tasks', nargs='*', default=list(results.TASK_FOLDERS),
+                        choices=list(results.TASK_FOLDERS))
+    parser.add_argument('--shard', type=parse_shard, default=(1, 1),
+                        help='Run shard i of N of the case manifest, e.g. 2/4')
+    parser.add_argument('--temperatures', nargs='*', type=parse_temperature, default=[1])
+    parser.add_argument('--tries', type=int, default=1, help='Tries per temperature')
+    parser.add_argument('--merge', action='store_true',
+                        help='Merge the shard outputs instead of running')
+    parser.add_argument('--pack', type=int, default=1,
+                        help='Questions per request of the no-img task (default 1: no packing)')
+    parser.add_argument('--answer-only', action='store_true',
+                        help='Ask for the option number without a reason, with a small max_tokens '
+                             'and a stop sequence (full and no-img tasks)')
+    parser.add_argument('--logprobs', type=int, default=0, metavar='K',
+                        help='Save the distribution over the option numbers from the K most '
+                             'likely answer tokens (OpenAI models, K <= 20; default 0: off)')
+    args = parser.parse_args()
+    if args.answer_only and args.pack > 1:
+        parser.error('--answer-only cannot be combined with --pack')
+    if not 0 <= args.logprobs <= logprobs.MAX_TOP_LOGPROBS:
+        parser.error(f'--logprobs must be between 0 and {logprobs.MAX_TOP_LOGPROBS}')
+    if args.logprobs and args.pack > 1:
+        parser.error('--logprobs cannot be combined with --pack')
+
+    if args.merge:
+        for task in args.tasks:
+            for model_key in args.models:
+                merge_shards(model_key, task)
+        return
+
+    shutdown.install()
+    for task in args.tasks:
+        for model_key in args.models:
+            if shutdown.requested():
+                break
+            run_shard(model_key, task, args.shard, args.temperatures, args.tries, args.pack,
+                      args.answer_only, args.logprobs)
+    retry.report()
+
+
+if __name__ == "__main__":
+    main()
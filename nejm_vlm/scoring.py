@@ -0,0 +1,206 @@
+"""
+Scores the saved answers against the radiologists' labels.
+
+Usage (from the repository root):
+
+    python -m nejm_vlm.scoring --strata Section Modality "Body part"
+    python -m nejm_vlm.scoring --task-dir 3_no-img_task
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from nejm_vlm import results
+
+SUMMARY_FILE = 'scoring_summary.xlsx'
+
+
+def correctness(answers, labels):
+    """
+    Compares every answer with the label of its case.
+
+    Parameters:
+    answers (ndarray): Option numbers of shape (..., case), 0 = no answer.
+    labels (ndarray): Correct option numbers of shape (case,).
+
+    Returns:
+    ndarray: Boolean array with the shape of `answers`.
+    """
+    return (answers == labels) & (answers > 0)
+
+
+def accuracy(correct, present=None, case_mask=None):
+    """
+    Computes the fraction of correct cases along the last axis.
+
+    Parameters:
+    correct (ndarray): Boolean array of shape (..., case).
+    present (ndarray): Boolean array of shape (...); runs that were never
+    executed get NaN instead of 0.
+    case_mask (ndarray): Boolean array of shape (case,) selecting a stratum.
+
+    Returns:
+    ndarray: Accuracy of shape (...).
+    """
+    if case_mask is not None:
+        correct = correct[..., case_mask]
+    n_cases = correct.shape[-1]
+    if n_cases == 0:
+        return np.full(correct.shape[:-1], np.nan)
+    acc = correct.sum(axis=-1) / n_cases
+    if present is not None:
+        acc = np.where(present, acc, np.nan)
+    return acc
+
+
+def bootstrap_weights(n_cases, n_resamples=2000, seed=0):
+    """
+    Draws case-resampling weights for the bootstrap.
+
+    Each row counts how often every case was drawn in one resample, so a
+    resampled mean of any per-case statistic is a single matrix product.
+
+    Returns:
+    ndarray: float32 array of shape (resample, case).
+    """
+    rng = np.random.default_rng(seed)
+    pvals = np.full(n_cases, 1.0 / n_cases)
+    return rng.multinomial(n_cases, pvals, size=n_resamples).astype(np.float32)
+
+
+def bootstrap_accuracy(correct, present=None, case_mask=None, n_resamples=2000,
+                       confidence=0.95, seed=0):
+    """
+    Computes percentile bootstrap confidence intervals of the accuracy.
+
+    All runs share the same resamples, and every run is resampled at once.
+
+    Parameters:
+    correct (ndarray): Boolean array of shape (..., case).
+    present (ndarray): Boolean array of shape (...).
+    case_mask (ndarray): Boolean array of shape (case,) selecting a stratum.
+    n_resamples (int): Number of bootstrap resamples.
+    confidence (float): Confidence level of the interval.
+    seed (int): Seed of the random generator.
+
+    Returns:
+    tuple: (low, high) arrays of shape (...).
+    """
+    if case_mask is not None:
+        correct = correct[..., case_mask]
+    run_shape = correct.shape[:-1]
+    n_cases = correct.shape[-1]
+    if n_cases == 0:
+        empty = np.full(run_shape, np.nan)
+        return empty, empty.copy()
+
+    weights = bootstrap_weights(n_cases, n_resamples, seed)
+    flat = correct.reshape(-1, n_cases).astype(np.float32)
+    resampled = flat @ weights.T / n_cases
+
+    alpha = 1.0 - confidence
+    low, high = np.quantile(resampled, [alpha / 2, 1 - alpha / 2], axis=1)
+    low, high = low.reshape(run_shape), high.reshape(run_shape)
+    if present is not None:
+        low = np.where(present, low, np.nan)
+        high = np.where(present, high, np.nan)
+    return low, high
+
+
+def stratum_masks(strata):
+    """
+    Builds the case masks of the overall score and of every stratum value.
+
+    Parameters:
+    strata (dict): Column name -> per-case values, see results.load_strata().
+
+    Returns:
+    list: (stratum, value, mask) tuples; the first one covers all cases.
+    """
+    masks = [('all', 'all', None)]
+    for column, values in strata.items():
+        for value in sorted(set(values)):
+            if value:
+                masks.append((column, value, values == value))
+    return masks
+
+
+def summary_table(tensor, labels, strata=None, n_resamples=2000,
+                  confidence=0.95, seed=0):
+    """
+    Builds the accuracy table of every run, overall and per stratum.
+
+    Parameters:
+    tensor (AnswerTensor): Answers loaded with results.load_answer_tensor().
+    labels (ndarray): Correct option numbers of shape (case,).
+    strata (dict): Column name -> per-case values.
+    n_resamples (int): Number of bootstrap resamples.
+    confidence (float): Confidence level of the interval.
+    seed (int): Seed of the random generator.
+
+    Returns:
+    DataFrame: One row per model, temperature, try and stratum value.
+    """
+    correct = correctness(tensor.answers, labels)
+    rows = []
+    for stratum, value, mask in stratum_masks(strata or {}):
+        n_cases = int(mask.sum()) if mask is not None else correct.shape[-1]
+        n_correct = (correct[..., mask] if mask is not None else correct).sum(axis=-1)
+        acc = accuracy(correct, tensor.present, mask)
+        low, high = bootstrap_accuracy(
+            correct, tensor.present, mask, n_resamples, confidence, seed
+        )
+        for m, t, r in zip(*np.nonzero(tensor.present)):
+            rows.append({
+                'model': tensor.models[m],
+                'temperature': tensor.temperatures[t],
+                'try': tensor.tries[r],
+                'stratum': stratum,
+                'value': value,
+                'n_cases': n_cases,
+                'n_correct': int(n_correct[m, t, r]),
+                'accuracy': acc[m, t, r],
+                'ci_low': low[m, t, r],
+                'ci_high': high[m, t, r],
+            })
+    return pd.DataFrame(rows, columns=[
+        'model', 'temperature', 'try', 'stratum', 'value', 'n_cases',
+        'n_correct', 'accuracy', 'ci_low', 'ci_high',
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--task-dir', default='.',
+                        help='Folder holding NEJM_list.xlsx and the *_result folders')
+    parser.add_argument('--models', nargs='*', default=list(results.MODEL_FOLDERS))
+    parser.add_argument('--answer-column', default=results.ANSWER_COLUMN)
+    parser.add_argument('--strata', nargs='*', default=[],
+                        help='Case list columns to break the accuracy down by')
+    parser.add_argument('--resamples', type=int, default=2000)
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=SUMMARY_FILE)
+    args = parser.parse_args()
+
+    case_list = results.load_case_list(args.task_dir)
+    cases = results.case_numbers(case_list)
+    labels = results.load_labels(case_list, cases, args.answer_column)
+    strata = results.load_strata(case_list, cases, args.strata)
+    tensor = results.load_answer_tensor(args.task_dir, args.models, cases)
+    print(f"Loaded answers of shape {tensor.answers.shape} (model x temperature x try x case)")
+
+    start_time = time.time()
+    summary = summary_table(
+        tensor, labels, strata, args.resamples, args.confidence, args.seed
+    )
+    print(f"Scored {len(summary)} rows in {time.time() - start_time:.2f} seconds")
+
+    summary.to_excel(args.output, index=False)
+    print(f"Scoring summary saved: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
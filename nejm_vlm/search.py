@@ -0,0 +1,262 @@
+"""
+Builds a BM25 search index over the model explanations in the `*_result`
+folders and queries it.
+
+Usage (from the repository root):
+
+    python -m nejm_vlm.search index
+    python -m nejm_vlm.search query "pneumatosis intestinalis" --model gpt4o --correct no
+"""
+import argparse
+import math
+import os
+import re
+import sqlite3
+import time
+from collections import Counter, defaultdict
+
+from nejm_vlm import categories
+from nejm_vlm import results
+
+INDEX_FILE = 'reason_index.sqlite'
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset(
+    'a an and are as at be by for from has have in is it its of on or that the '
+    'this to was were which with'.split()
+)
+
+SCHEMA = """
+CREATE TABLE docs (
+    doc_id INTEGER PRIMARY KEY,
+    task TEXT, model TEXT, temperature REAL, try INTEGER, case_number INTEGER,
+    answer INTEGER, correct INTEGER, length INTEGER, text TEXT
+);
+CREATE TABLE terms (term TEXT PRIMARY KEY, df INTEGER) WITHOUT ROWID;
+CREATE TABLE postings (
+    term TEXT, doc_id INTEGER, tf INTEGER, PRIMARY KEY (term, doc_id)
+) WITHOUT ROWID;
+CREATE TABLE stats (key TEXT PRIMARY KEY, value REAL);
+"""
+
+
+def tokenize(text):
+    """
+    Splits a text into lowercase word tokens without stopwords.
+    """
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def explanation_text(task, raw_text):
+    """
+    Returns the answer and the searchable explanation of a raw response.
+
+    For the image-only task the five structured fields are indexed instead.
+
+    Returns:
+    tuple: (option number, text); the option number is 0 for the image-only
+    task or when no answer could be parsed.
+    """
+    if task == 'img-only':
+        fields = categories.extract_img_only_fields(raw_text)
+        return 0, ' '.join(value for value in fields.values() if value) or raw_text
+    extracted = results.extract_answer_and_reason(raw_text)
+    return results.parse_option_number(extracted['answer']), extracted['reason']
+
+
+def iter_documents(root='.', answer_column=results.ANSWER_COLUMN):
+    """
+    Yields one document per saved response of every task, model and run.
+
+    Yields:
+    dict: Document metadata and text.
+    """
+    for task, task_folder in results.TASK_FOLDERS.items():
+        task_dir = os.path.join(root, task_folder)
+        if not os.path.isdir(task_dir):
+            continue
+        case_list = results.load_case_list(task_dir)
+        cases = results.case_numbers(case_list)
+        try:
+            labels = dict(zip(cases, results.load_labels(case_list, cases, answer_column)))
+        except KeyError:
+            labels = {}
+
+        for model, model_folder in results.MODEL_FOLDERS.items():
+            runs = results.find_runs(os.path.join(task_dir, model_folder))
+            for temperature, try_number, folder_path in runs:
+                for case_number in cases:
+                    raw_text = results.read_result_text(folder_path, case_number)
+                    if raw_text is None:
+                        continue
+                    answer, text = explanation_text(task, raw_text)
+                    label = labels.get(case_number, 0)
+                    yield {
+                        'task': task,
+                        'model': model,
+                        'temperature': temperature,
+                        'try': try_number,
+                        'case_number': case_number,
+                        'answer': answer,
+                        'correct': int(answer == label) if label and task != 'img-only' else None,
+                        'text': text,
+                    }
+
+
+def build_index(index_path=INDEX_FILE, root='.', answer_column=results.ANSWER_COLUMN):
+    """
+    Indexes every saved explanation into an SQLite file, replacing it.
+
+    Parameters:
+    index_path (str): Path of the index file.
+    root (str): Repository root holding the task folders.
+    answer_column (str): Case list column with the correct option.
+
+    Returns:
+    int: Number of indexed documents.
+    """
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    connection = sqlite3.connect(index_path)
+    connection.executescript(SCHEMA)
+
+    doc_rows = []
+    posting_rows = []
+    document_frequency = Counter()
+    total_length = 0
+    for doc_id, doc in enumerate(iter_documents(root, answer_column)):
+        term_counts = Counter(tokenize(doc['text']))
+        length = sum(term_counts.values())
+        total_length += length
+        doc_rows.append((
+            doc_id, doc['task'], doc['model'], doc['temperature'], doc['try'],
+            doc['case_number'], doc['answer'], doc['correct'], length, doc['text'],
+        ))
+        posting_rows.extend((term, doc_id, tf) for term, tf in term_counts.items())
+        document_frequency.update(term_counts.keys())
+
+    with connection:
+        connection.executemany('INSERT INTO docs VALUES (?,?,?,?,?,?,?,?,?,?)', doc_rows)
+        connection.executemany('INSERT INTO postings VALUES (?,?,?)', posting_rows)
+        connection.executemany('INSERT INTO terms VALUES (?,?)', document_frequency.items())
+        connection.executemany('INSERT INTO stats VALUES (?,?)', [
+            ('n_docs', len(doc_rows)),
+            ('avg_length', total_length / len(doc_rows) if doc_rows else 0.0),
+        ])
+        for column in ('task', 'model', 'case_number', 'correct'):
+            connection.execute(f'CREATE INDEX docs_{column} ON docs ({column})')
+    connection.close()
+    return len(doc_rows)
+
+
+def search(connection, query, task=None, model=None, correct=None, case_number=None,
+           temperature=None, try_number=None, limit=10):
+    """
+    Ranks the indexed explanations against a query with BM25.
+
+    Parameters:
+    connection (Connection): Open connection to the index file.
+    query (str): Free-text query.
+    task, model, correct, case_number, temperature, try_number: Optional
+    filters on the document metadata; `correct` is True or False.
+    limit (int): Number of results.
+
+    Returns:
+    list: (score, document) tuples, best first.
+    """
+    terms = sorted(set(tokenize(query)))
+    if not terms:
+        return []
+    stats = dict(connection.execute('SELECT key, value FROM stats'))
+    n_docs, avg_length = stats.get('n_docs', 0), stats.get('avg_length', 0) or 1.0
+
+    filters = []
+    params = list(terms)
+    for column, value in (('task', task), ('model', model), ('case_number', case_number),
+                          ('temperature', temperature), ('try', try_number)):
+        if value is not None:
+            filters.append(f'd.{column} = ?')
+            params.append(value)
+    if correct is not None:
+        filters.append('d.correct = ?')
+        params.append(int(bool(correct)))
+
+    sql = (
+        'SELECT p.doc_id, p.tf, t.df, d.length FROM postings p '
+        'JOIN terms t ON t.term = p.term JOIN docs d ON d.doc_id = p.doc_id '
+        f'WHERE p.term IN ({",".join("?" * len(terms))})'
+    )
+    if filters:
+        sql += ' AND ' + ' AND '.join(filters)
+
+    scores = defaultdict(float)
+    for doc_id, tf, df, length in connection.execute(sql, params):
+        idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+        norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+        scores[doc_id] += idf * tf * (BM25_K1 + 1) / norm
+
+    best = sorted(scores.items(), key=lambda item: -item[1])[:limit]
+    if not best:
+        return []
+    columns = ['doc_id', 'task', 'model', 'temperature', 'try', 'case_number',
+               'answer', 'correct', 'length', 'text']
+    rows = connection.execute(
+        f'SELECT {", ".join(columns)} FROM docs WHERE doc_id IN ({",".join("?" * len(best))})',
+        [doc_id for doc_id, _ in best],
+    )
+    docs = {row[0]: dict(zip(columns, row)) for row in rows}
+    return [(score, docs[doc_id]) for doc_id, score in best]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--index', default=INDEX_FILE)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index', help='Rebuild the index')
+    index_parser.add_argument('--root', default='.')
+    index_parser.add_argument('--answer-column', default=results.ANSWER_COLUMN)
+
+    query_parser = subparsers.add_parser('query', help='Search the index')
+    query_parser.add_argument('query')
+    query_parser.add_argument('--task', choices=list(results.TASK_FOLDERS))
+    query_parser.add_argument('--model', choices=list(results.MODEL_FOLDERS))
+    query_parser.add_argument('--correct', choices=['yes', 'no'])
+    query_parser.add_argument('--case', dest='case_number', type=int)
+    query_parser.add_argument('--temperature', type=float)
+    query_parser.add_argument('--try', dest='try_number', type=int)
+    query_parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == 'index':
+        start_time = time.time()
+        n_docs = build_index(args.index, args.root, args.answer_column)
+        print(f"Indexed {n_docs} explanations in {time.time() - start_time:.2f} seconds: {args.index}")
+        return
+
+    if not os.path.exists(args.index):
+        print(f"Index not found: {args.index}. Run 'python -m nejm_vlm.search index' first.")
+        return
+    connection = sqlite3.connect(args.index)
+    start_time = time.time()
+    hits = search(
+        connection, args.query, args.task, args.model,
+        None if args.correct is None else args.correct == 'yes',
+        args.case_number, args.temperature, args.try_number, args.limit,
+    )
+    elapsed = (time.time() - start_time) * 1000
+    for score, doc in hits:
+        print(
+            f"{score:6.2f}  {doc['task']}/{doc['model']} temp {doc['temperature']:g} "
+            f"try {doc['try']} case {doc['case_number']} answer {doc['answer']} "
+            f"correct {doc['correct']}"
+        )
+        print(f"        {doc['text'][:200]}")
+    print(f"{len(hits)} results in {elapsed:.1f} ms")
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
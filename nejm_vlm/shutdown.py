@@ -0,0 +1,80 @@
+"""
+Graceful shutdown of the runners.
+
+The first SIGINT (Ctrl-C) or SIGTERM asks the runner to stop: the case in
+flight is finished, the results and execution times are saved as usual, and
+the runner exits. Rerunning it continues from the first case without a
+result file. A second signal stops the runner at once.
+
+An exhausted quota stops the runner the same way, unless VLM_QUOTA_MODE is
+'wait': then the provider is paused until the quota resets (or for
+VLM_QUOTA_RECHECK seconds, default 1800, when the reset time is unknown) and
+the run continues by itself.
+"""
+import os
+import signal
+import threading
+
+QUOTA_MODES = ('exit', 'wait')
+DEFAULT_QUOTA_RECHECK = 1800.0
+
+_stop = threading.Event()
+_reason = []
+
+
+def request(reason):
+    """
+    Asks the runner to stop after the case in flight.
+    """
+    if not _stop.is_set():
+        _reason.append(reason)
+        print(f"Stopping after the current case ({reason}); results will be saved. "
+              "Rerun the script to continue.")
+    _stop.set()
+
+
+def requested():
+    return _stop.is_set()
+
+
+def reason():
+    return _reason[0] if _reason else None
+
+
+def wait(seconds):
+    """
+    Sleeps for the given time, waking early when a stop is requested.
+
+    Returns:
+    bool: Whether a stop was requested.
+    """
+    return _stop.wait(seconds)
+
+
+def quota_mode():
+    mode = os.getenv('VLM_QUOTA_MODE', 'exit').strip().lower() or 'exit'
+    if mode not in QUOTA_MODES:
+        raise ValueError(f"VLM_QUOTA_MODE must be one of {', '.join(QUOTA_MODES)}, not '{mode}'")
+    return mode
+
+
+def quota_recheck():
+    return float(os.getenv('VLM_QUOTA_RECHECK', DEFAULT_QUOTA_RECHECK))
+
+
+def _handle_signal(signum, frame):
+    if _stop.is_set():
+        signal.signal(signum, signal.SIG_DFL)
+        raise KeyboardInterrupt
+    request(f"signal {signal.Signals(signum).name}; press Ctrl-C again to exit at once")
+
+
+def install():
+    """
+    Installs the SIGINT and SIGTERM handlers (main thread only).
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for name in ('SIGINT', 'SIGTERM', 'SIGBREAK'):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), _handle_signal)
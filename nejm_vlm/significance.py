@@ -0,0 +1,259 @@
+"""
+Paired significance tests between models and tasks over the same cases.
+
+Usage (from the repository root):
+
+    python -m nejm_vlm.significance --tasks full no-img --temperature 1 --try 1
+
+The img-only task has no option answer to score (see nejm_vlm.categories),
+so only the full and no-img tasks can be compared.
+"""
+import argparse
+import os
+import time
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from nejm_vlm import results
+from nejm_vlm import scoring
+
+SIGNIFICANCE_FILE = 'significance_tests.xlsx'
+CORRECTION_METHODS = ('holm', 'bh', 'bonferroni', 'none')
+# Tasks whose runs answer the questions.
+ANSWER_TASKS = [task for task in results.TASK_FOLDERS if task != 'img-only']
+
+
+def condition_matrix(tensors, labels):
+    """
+    Flattens the answers of several tasks into one correctness matrix.
+
+    Parameters:
+    tensors (dict): Task name -> AnswerTensor; all tensors share the case axis.
+    labels (ndarray): Correct option numbers of shape (case,).
+
+    Returns:
+    tuple: (names, correct) with one 'task/model/temperature/try' name per
+    executed run and a boolean matrix of shape (run, case).
+    """
+    names = []
+    rows = []
+    for task, tensor in tensors.items():
+        correct = scoring.correctness(tensor.answers, labels)
+        for m, t, r in zip(*np.nonzero(tensor.present)):
+            names.append(
+                f"{task}/{tensor.models[m]}/temp_{tensor.temperatures[t]:g}"
+                f"/try{tensor.tries[r]}"
+            )
+            rows.append(correct[m, t, r])
+    if not rows:
+        return names, np.zeros((0, len(labels)), dtype=bool)
+    return names, np.stack(rows)
+
+
+def _log_factorials(n):
+    return np.concatenate([[0.0], np.cumsum(np.log(np.arange(1, n + 1)))])
+
+
+def mcnemar_exact(b, c):
+    """
+    Computes exact two-sided McNemar p-values for many pairs at once.
+
+    Parameters:
+    b (ndarray): Cases only the first condition got right.
+    c (ndarray): Cases only the second condition got right.
+
+    Returns:
+    ndarray: p-values with the shape of `b`.
+    """
+    b = np.asarray(b, dtype=np.int64)
+    c = np.asarray(c, dtype=np.int64)
+    n = b + c
+    k = np.minimum(b, c)
+    max_n = int(n.max()) if n.size else 0
+    log_fact = _log_factorials(max_n)
+
+    # Binomial(n, 0.5) lower tail up to k, evaluated on a shared grid.
+    grid = np.arange(max_n + 1)
+    n_col = n.reshape(-1, 1)
+    valid = grid <= k.reshape(-1, 1)
+    log_pmf = (
+        log_fact[n_col] - log_fact[np.minimum(grid, n_col)]
+        - log_fact[np.maximum(n_col - grid, 0)] - n_col * np.log(2.0)
+    )
+    tail = np.where(valid, np.exp(log_pmf), 0.0).sum(axis=1)
+    p_values = np.minimum(1.0, 2.0 * tail)
+    p_values[n.reshape(-1) == 0] = 1.0
+    return p_values.reshape(b.shape)
+
+
+def adjust_p_values(p_values, method='holm'):
+    """
+    Corrects p-values for multiple comparisons.
+
+    Parameters:
+    p_values (ndarray): Raw p-values of one family of tests.
+    method (str): 'holm', 'bh' (Benjamini-Hochberg), 'bonferroni' or 'none'.
+
+    Returns:
+    ndarray: Adjusted p-values in the original order.
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    m = p_values.size
+    if m == 0 or method == 'none':
+        return p_values.copy()
+    if method == 'bonferroni':
+        return np.minimum(1.0, p_values * m)
+
+    order = np.argsort(p_values)
+    ranked = p_values[order]
+    if method == 'holm':
+        adjusted = np.maximum.accumulate((m - np.arange(m)) * ranked)
+    elif method == 'bh':
+        adjusted = np.minimum.accumulate((m / np.arange(m, 0, -1)) * ranked[::-1])[::-1]
+    else:
+        raise ValueError(f"Unknown correction method: {method}")
+
+    result = np.empty(m)
+    result[order] = np.minimum(1.0, adjusted)
+    return result
+
+
+def pairwise_tests(names, correct, strata=None, n_resamples=10000,
+                   confidence=0.95, correction='holm', seed=0):
+    """
+    Runs McNemar, paired bootstrap and sign-flip permutation tests for every
+    pair of conditions, overall and within every stratum.
+
+    Parameters:
+    names (list): Condition names, see condition_matrix().
+    correct (ndarray): Boolean matrix of shape (condition, case).
+    strata (dict): Column name -> per-case values.
+    n_resamples (int): Resamples of the bootstrap and the permutation test.
+    confidence (float): Confidence level of the accuracy difference interval.
+    correction (str): Multiple-comparison correction applied across all rows.
+    seed (int): Seed of the random generator.
+
+    Returns:
+    DataFrame: One row per pair of conditions and stratum value.
+    """
+    pairs = np.array(list(combinations(range(len(names)), 2)), dtype=np.int64)
+    columns = [
+        'stratum', 'value', 'condition_a', 'condition_b', 'n_cases',
+        'accuracy_a', 'accuracy_b', 'difference', 'ci_low', 'ci_high',
+        'only_a_correct', 'only_b_correct', 'p_mcnemar', 'p_bootstrap',
+        'p_permutation',
+    ]
+    if len(pairs) == 0:
+        return pd.DataFrame(columns=columns)
+
+    first, second = pairs[:, 0], pairs[:, 1]
+    alpha = 1.0 - confidence
+    rng = np.random.default_rng(seed)
+    frames = []
+
+    for stratum, value, mask in scoring.stratum_masks(strata or {}):
+        sub = correct if mask is None else correct[:, mask]
+        n_cases = sub.shape[1]
+        if n_cases == 0:
+            continue
+        sub = sub.astype(np.float32)
+
+        acc = sub.mean(axis=1)
+        only_a = (sub[first] * (1 - sub[second])).sum(axis=1)
+        only_b = ((1 - sub[first]) * sub[second]).sum(axis=1)
+
+        # Paired bootstrap: every condition is resampled on the same cases.
+        weights = scoring.bootstrap_weights(n_cases, n_resamples, rng.integers(2**32))
+        resampled = sub @ weights.T / n_cases
+        boot_diff = resampled[first] - resampled[second]
+        low, high = np.quantile(boot_diff, [alpha / 2, 1 - alpha / 2], axis=1)
+        p_boot = np.minimum(1.0, 2.0 * np.minimum(
+            (boot_diff <= 0).mean(axis=1), (boot_diff >= 0).mean(axis=1)
+        ))
+
+        # Sign-flip permutation of the per-case differences.
+        case_diff = sub[first] - sub[second]
+        observed = np.abs(case_diff.mean(axis=1))
+        signs = rng.choice(np.array([-1.0, 1.0], dtype=np.float32),
+                           size=(n_resamples, n_cases))
+        null = np.abs(case_diff @ signs.T / n_cases)
+        p_perm = (1 + (null >= observed[:, None] - 1e-12).sum(axis=1)) / (n_resamples + 1)
+
+        frames.append(pd.DataFrame({
+            'stratum': stratum,
+            'value': value,
+            'condition_a': [names[i] for i in first],
+            'condition_b': [names[j] for j in second],
+            'n_cases': n_cases,
+            'accuracy_a': acc[first],
+            'accuracy_b': acc[second],
+            'difference': acc[first] - acc[second],
+            'ci_low': low,
+            'ci_high': high,
+            'only_a_correct': only_a.astype(int),
+            'only_b_correct': only_b.astype(int),
+            'p_mcnemar': mcnemar_exact(only_a.astype(int), only_b.astype(int)),
+            'p_bootstrap': p_boot,
+            'p_permutation': p_perm,
+        }))
+
+    table = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    for column in ('p_mcnemar', 'p_bootstrap', 'p_permutation'):
+        table[f'{column}_adj'] = adjust_p_values(table[column].to_numpy(), correction)
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tasks', nargs='*', default=ANSWER_TASKS, choices=ANSWER_TASKS)
+    parser.add_argument('--models', nargs='*', default=list(results.MODEL_FOLDERS))
+    parser.add_argument('--temperature', type=float, default=None,
+                        help='Only compare runs at this temperature')
+    parser.add_argument('--try', dest='try_number', type=int, default=None,
+                        help='Only compare runs of this try')
+    parser.add_argument('--answer-column', default=results.ANSWER_COLUMN)
+    parser.add_argument('--strata', nargs='*', default=[])
+    parser.add_argument('--resamples', type=int, default=10000)
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--correction', default='holm', choices=CORRECTION_METHODS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=SIGNIFICANCE_FILE)
+    args = parser.parse_args()
+
+    case_list = results.load_case_list('.')
+    cases = results.case_numbers(case_list)
+    labels = results.load_labels(case_list, cases, args.answer_column)
+    strata = results.load_strata(case_list, cases, args.strata)
+
+    tensors = {}
+    for task in args.tasks:
+        task_dir = results.TASK_FOLDERS[task]
+        if not os.path.isdir(task_dir):
+            print(f"Task folder not found: {task_dir}")
+            continue
+        tensor = results.load_answer_tensor(task_dir, args.models, cases)
+        present = tensor.present.copy()
+        if args.temperature is not None:
+            present &= np.isclose(tensor.temperatures, args.temperature)[None, :, None]
+        if args.try_number is not None:
+            present &= (np.array(tensor.tries) == args.try_number)[None, None, :]
+        tensors[task] = tensor._replace(present=present)
+
+    names, correct = condition_matrix(tensors, labels)
+    print(f"Comparing {len(names)} conditions ({len(names) * (len(names) - 1) // 2} pairs)")
+
+    start_time = time.time()
+    table = pairwise_tests(
+        names, correct, strata, args.resamples, args.confidence,
+        args.correction, args.seed
+    )
+    print(f"Ran {len(table)} paired comparisons in {time.time() - start_time:.2f} seconds")
+
+    table.to_excel(args.output, index=False)
+    print(f"Significance tests saved: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Schema-constrained output for the answer formats, and a local repair pass for
+the responses that still are not valid JSON.
+
+VLM_STRUCTURED_OUTPUT=1 makes the unified runner (and the work queue and
+batch mode, which share its requests) constrain every response to the schema
+of its prompt with the strictest mechanism of the provider:
+
+    openai     response_format json_schema with strict=True (gpt-4-turbo has
+               no json_schema support and keeps json_object)
+    anthropic  a single tool whose input_schema is the answer schema, forced
+               with tool_choice; the tool input is the answer
+    gemini     response_mime_type application/json with a response_schema
+
+The schemas are those of the prompts: answer/reason for the question prompt,
+the answer alone for the answer-only prompt, the five fields of the img-only
+prompt and the answers list of a packed request (nejm_vlm.packing).
+
+Whatever the mode, load_json() repairs the usual defects of free-text JSON
+before giving up: code fences and prose around the object, typographic
+quotes used as delimiters (those inside strings are kept), trailing commas,
+raw line breaks inside strings, and a response cut off before its closing
+quotes and brackets. results.extract_json_fields()
+uses it, so a malformed response still fills its row of the results sheet
+instead of costing another request.
+"""
+import json
+import os
+import re
+
+from nejm_vlm import prompts
+
+TOOL_NAME = 'record_answer'
+
+ANSWER_PROPERTIES = {
+    'answer': {'type': 'string', 'description': 'Number of the option you believe is correct'},
+    'reason': {'type': 'string', 'description': 'Why you think this option is correct'},
+}
+
+
+def object_schema(properties):
+    return {
+        'type': 'object',
+        'properties': properties,
+        'required': list(properties),
+        'additionalProperties': False,
+    }
+
+
+SCHEMAS = {
+    'question': object_schema(ANSWER_PROPERTIES),
+    'answer-only': object_schema({'answer': ANSWER_PROPERTIES['answer']}),
+    'img-only': object_schema({
+        field: {'type': 'string'}
+        for field in ('1_TypeOfMedicalImaging', '2_SpecificImagingSequence', '3_UseOfContrast',
+                      '4_ImagePlane', '5_PartOfTheBodyImaged')
+    }),
+    'packed': object_schema({
+        'answers': {
+            'type': 'array',
+            'items': object_schema({
+                'case': {'type': 'integer', 'description': 'Case number of the question'},
+                **ANSWER_PROPERTIES,
+            }),
+        },
+    }),
+}
+
+# OpenAI models without json_schema support.
+JSON_OBJECT_MODELS = ('gpt-4-turbo', 'gpt-4-vision-preview')
+
+# JSON schema type -> Gemini Schema type.
+GEMINI_TYPES = {'object': 'OBJECT', 'array': 'ARRAY', 'string': 'STRING', 'integer': 'INTEGER'}
+
+TYPOGRAPHIC_QUOTES = '“”'
+TRAILING_COMMA = re.compile(r',\s*([}\]])')
+
+
+def enabled():
+    """
+    Tells whether the requests constrain the responses to a schema.
+    """
+    return os.getenv('VLM_STRUCTURED_OUTPUT', '0').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def constrains(provider, model_name):
+    """
+    Tells whether the requests of a model are constrained to a schema.
+    """
+    if not enabled():
+        return False
+    return provider != 'openai' or not model_name.startswith(JSON_OBJECT_MODELS)
+
+
+def openai_response_format(model_name, prompt_text):
+    """
+    Returns the response_format of an OpenAI request.
+    """
+    if not constrains('openai', model_name):
+        return {"type": "json_object"}
+    kind = prompts.response_kind(prompt_text)
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": kind.replace('-', '_'), "strict": True, "schema": SCHEMAS[kind]},
+    }
+
+
+def anthropic_options(prompt_text):
+    """
+    Returns the tool arguments that force a Claude answer into the schema
+    (none without VLM_STRUCTURED_OUTPUT).
+    """
+    if not enabled():
+        return {}
+    return {
+        'tools': [{
+            'name': TOOL_NAME,
+            'description': 'Records the answer in the requested output format.',
+            'input_schema': SCHEMAS[prompts.response_kind(prompt_text)],
+        }],
+        'tool_choice': {'type': 'tool', 'name': TOOL_NAME},
+    }
+
+
+def gemini_schema(schema):
+    """
+    Converts a JSON schema into the Schema of the Gemini API.
+    """
+    converted = {'type_': GEMINI_TYPES[schema['type']]}
+    if 'properties' in schema:
+        converted['properties'] = {
+            name: gemini_schema(value) for name, value in schema['properties'].items()
+        }
+        converted['required'] = schema.get('required', [])
+    if 'items' in schema:
+        converted['items'] = gemini_schema(schema['items'])
+    return converted
+
+
+def gemini_options(prompt_text):
+    """
+    Returns the invoke() arguments of a Gemini request (none without
+    VLM_STRUCTURED_OUTPUT).
+    """
+    if not enabled():
+        return {}
+    return {'generation_config': {
+        'response_mime_type': 'application/json',
+        'response_schema': gemini_schema(SCHEMAS[prompts.response_kind(prompt_text)]),
+    }}
+
+
+def close_json(text):
+    """
+    Escapes raw line breaks inside strings and closes the strings and
+    brackets left open by a truncated response.
+    """
+    repaired = []
+    closers = []
+    in_string = escaped = False
+    for character in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif character == '\\':
+                escaped = True
+            elif character == '"':
+                in_string = False
+            elif character in '\r\n':
+                character = '\\n' if character == '\n' else ''
+        elif character == '"':
+            in_string = True
+        elif character in '{[':
+            closers.append('}' if character == '{' else ']')
+        elif character in '}]' and closers:
+            closers.pop()
+        repaired.append(character)
+    if escaped:
+        repaired.pop()
+    if in_string:
+        repaired.append('"')
+    tail = ''.join(repaired).rstrip().rstrip(',:')
+    return tail + ''.join(reversed(closers))
+
+
+def straighten_quotes(text):
+    """
+    Replaces the typographic quotes that delimit keys and strings with
+    straight quotes, keeping those inside straight-quoted strings.
+    """
+    straightened = []
+    opener = None
+    escaped = False
+    for character in text:
+        if opener == '"':
+            if escaped:
+                escaped = False
+            elif character == '\\':
+                escaped = True
+            elif character == '"':
+                opener = None
+        elif character in TYPOGRAPHIC_QUOTES:
+            opener = None if opener else character
+            character = '"'
+        elif character == '"' and opener is None:
+            opener = '"'
+        straightened.append(character)
+    return ''.join(straightened)
+
+
+def repair_attempts(text):
+    """
+    Returns the text from its first brace on, then with each repair added.
+    """
+    end = text.rfind('}') + 1
+    return [
+        text[:end],
+        TRAILING_COMMA.sub(r'\1', text[:end]),
+        TRAILING_COMMA.sub(r'\1', close_json(text[:end] or text)),
+        TRAILING_COMMA.sub(r'\1', close_json(text)),
+    ]
+
+
+def load_json(text):
+    """
+    Decodes the JSON object of a response, repairing it if needed.
+
+    Returns:
+    dict: The decoded object.
+
+    Raises:
+    json.JSONDecodeError: No object could be decoded, even after repair.
+    """
+    start = (text or '').find('{')
+    if start < 0:
+        raise json.JSONDecodeError('No JSON object in the response', text or '', 0)
+    text = text[start:]
+    attempts = repair_attempts(text)
+    # Typographic quotes inside strings are valid JSON, so they are only
+    # straightened once the text as written has failed.
+    if any(quote in text for quote in TYPOGRAPHIC_QUOTES):
+        attempts += repair_attempts(straighten_quotes(text))
+    error = None
+    for attempt in attempts:
+        try:
+            data = json.loads(attempt)
+        except json.JSONDecodeError as e:
+            error = error or e
+            continue
+        if isinstance(data, dict):
+            return data
+    raise error or json.JSONDecodeError('The response is not a JSON object', text, 0)
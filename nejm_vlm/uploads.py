@@ -0,0 +1,167 @@
+"""
+Upload-once image references for the Gemini requests.
+
+With VLM_GEMINI_UPLOADS=1, instead of inlining the base64 image into every
+request, every unique image is uploaded once to the Gemini File API and the
+requests reference it by its file URI, so the repeated temperatures and tries
+of a case send only the prompt and a short URI.
+
+The uploads are recorded in VLM_UPLOAD_CACHE (default `.vlm_uploads.json`),
+keyed by the API key and the SHA-256 of the image bytes, with the URI and the
+expiry time returned by the API (files are kept for 48 hours). An image is
+uploaded again once its file expires within EXPIRY_MARGIN seconds, or when
+the File API no longer has it (checked once per run). Uploaded files belong
+to the project of the key that uploaded them, so every key of a pool
+(nejm_vlm.keys) uploads its own copy. The file references need
+langchain-google-genai 1.0.10 or later.
+"""
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from nejm_vlm import deadlines
+from nejm_vlm import keys
+from nejm_vlm import providers
+
+DEFAULT_UPLOAD_CACHE = '.vlm_uploads.json'
+LIVE_ROOT = 'https://generativelanguage.googleapis.com'
+MIME_TYPE = 'image/jpeg'
+# Files expiring sooner than this are uploaded again.
+EXPIRY_MARGIN = 60 * 60
+
+_lock = threading.Lock()
+_uploads = None
+# Cache keys whose file was uploaded or checked by this process.
+_verified = set()
+
+
+def enabled():
+    """
+    Tells whether the Gemini images are sent as uploaded files.
+    """
+    return os.getenv('VLM_GEMINI_UPLOADS', '0').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def cache_file():
+    return os.getenv('VLM_UPLOAD_CACHE', DEFAULT_UPLOAD_CACHE)
+
+
+def load_uploads():
+    """
+    Returns the recorded uploads, reading the cache file on first use.
+    """
+    global _uploads
+    if _uploads is None:
+        _uploads = {}
+        if os.path.exists(cache_file()):
+            with open(cache_file(), 'r', encoding='utf-8') as file:
+                _uploads = json.load(file)
+    return _uploads
+
+
+def save_uploads(uploads):
+    temp_file = f"{cache_file()}.tmp{os.getpid()}"
+    with open(temp_file, 'w', encoding='utf-8') as file:
+        json.dump(uploads, file, indent=2)
+    os.replace(temp_file, cache_file())
+
+
+def parse_time(value):
+    """
+    Converts an RFC 3339 timestamp of the API (e.g. 2024-05-01T10:00:00.123456Z)
+    to seconds since the epoch.
+    """
+    value = value.replace('Z', '+00:00')
+    if '.' in value:
+        # fromisoformat() takes at most six fractional digits.
+        head, _, tail = value.partition('.')
+        digits = len(tail) - len(tail.lstrip('0123456789'))
+        value = f"{head}.{tail[:min(digits, 6)]}{tail[digits:]}"
+    return datetime.fromisoformat(value).timestamp()
+
+
+def upload(api_key, image_bytes):
+    """
+    Uploads an image to the Gemini File API.
+
+    Returns:
+    dict: The cache entry of the file (name, uri, mime_type, expires_at).
+    """
+    import httpx
+
+    root = providers.base_url('gemini') or LIVE_ROOT
+    response = httpx.post(
+        f"{root}/upload/v1beta/files",
+        params={'uploadType': 'media', 'key': api_key},
+        content=image_bytes,
+        headers={'Content-Type': MIME_TYPE},
+        timeout=deadlines.request_timeout(),
+    )
+    response.raise_for_status()
+    file = response.json()['file']
+    return {
+        'name': file['name'],
+        'uri': file['uri'],
+        'mime_type': file.get('mimeType', MIME_TYPE),
+        'expires_at': parse_time(file['expirationTime']),
+    }
+
+
+def exists(api_key, entry):
+    """
+    Tells whether a recorded upload is still stored by the File API.
+    """
+    import httpx
+
+    root = providers.base_url('gemini') or LIVE_ROOT
+    response = httpx.get(f"{root}/v1beta/{entry['name']}", params={'key': api_key},
+                         timeout=deadlines.request_timeout())
+    if response.status_code in (403, 404):
+        return False
+    response.raise_for_status()
+    return True
+
+
+def file_part(encoded_image):
+    """
+    Returns the LangChain message part referencing an image by its file URI,
+    uploading the image first if it has no live upload.
+
+    Must be called on the thread of the attempt, so that a pooled key is the
+    one the attempt was scheduled on.
+    """
+    api_key = providers.api_key('gemini', keys.api_key('gemini', keys.current('gemini')))
+    image_bytes = base64.b64decode(encoded_image)
+    key_id = hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:12]
+    cache_key = f"{key_id}:{hashlib.sha256(image_bytes).hexdigest()}"
+
+    with _lock:
+        entry = load_uploads().get(cache_key)
+        verified = cache_key in _verified
+    if entry is not None and not verified:
+        # An upload recorded by an earlier run may have been deleted.
+        entry = entry if exists(api_key, entry) else None
+    if entry is None or entry['expires_at'] - time.time() < EXPIRY_MARGIN:
+        entry = upload(api_key, image_bytes)
+        print(f"Uploaded image {cache_key.split(':')[1][:12]} as {entry['name']}")
+        with _lock:
+            uploads = load_uploads()
+            uploads[cache_key] = entry
+            save_uploads(uploads)
+    with _lock:
+        _verified.add(cache_key)
+    return {"type": "media", "file_uri": entry['uri'], "mime_type": entry['mime_type']}
+
+
+def image_part(encoded_image):
+    """
+    Returns the LangChain message part of an image: a file reference, or the
+    inline data URL without VLM_GEMINI_UPLOADS.
+    """
+    if enabled():
+        return file_part(encoded_image)
+    return {"type": "image_url", "image_url": f"data:image/jpeg;base64,{encoded_image}"}
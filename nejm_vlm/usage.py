@@ -0,0 +1,114 @@
+"""
+Token usage of the provider responses, with the prompt tokens served from the
+providers' prompt caches, so that the effect of a static prompt prefix
+(VLM_PROMPT_LAYOUT=prefix, see nejm_vlm.prompts) can be measured.
+
+    openai     usage.prompt_tokens_details.cached_tokens (automatic prefix
+               caching, prompts of 1024 tokens or more)
+    anthropic  usage.cache_read_input_tokens and cache_creation_input_tokens
+               (cache_control blocks)
+    gemini     usage_metadata of the LangChain message, where reported
+
+Only responses that come from the API are counted, not cache replays.
+"""
+import threading
+from collections import Counter
+
+metrics = Counter()
+_lock = threading.Lock()
+
+
+def token_counts(provider, response):
+    """
+    Returns the token counts of a response.
+
+    Returns:
+    dict: 'input' (all prompt tokens, cached ones included), 'cache_read',
+    'cache_write' and 'output'; empty when the response reports no usage.
+    """
+    if provider == 'openai':
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return {}
+        details = getattr(usage, 'prompt_tokens_details', None)
+        if isinstance(details, dict):
+            cached = details.get('cached_tokens')
+        else:
+            cached = getattr(details, 'cached_tokens', None)
+        return {
+            'input': usage.prompt_tokens or 0,
+            'cache_read': cached or 0,
+            'cache_write': 0,
+            'output': usage.completion_tokens or 0,
+        }
+    if provider == 'anthropic':
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return {}
+        cache_read = getattr(usage, 'cache_read_input_tokens', None) or 0
+        cache_write = getattr(usage, 'cache_creation_input_tokens', None) or 0
+        return {
+            # input_tokens counts only the tokens after the last cache breakpoint.
+            'input': (usage.input_tokens or 0) + cache_read + cache_write,
+            'cache_read': cache_read,
+            'cache_write': cache_write,
+            'output': usage.output_tokens or 0,
+        }
+    usage = getattr(response, 'usage_metadata', None)
+    if not usage:
+        return {}
+    details = usage.get('input_token_details') or {}
+    return {
+        'input': usage.get('input_tokens', 0),
+        'cache_read': details.get('cache_read', 0),
+        'cache_write': 0,
+        'output': usage.get('output_tokens', 0),
+    }
+
+
+def output_tokens(provider, response):
+    """
+    Returns the output tokens of a response, also of one rebuilt from the
+    request cache, or None when the response reports no usage.
+    """
+    if provider == 'gemini':
+        return (getattr(response, 'usage_metadata', None) or {}).get('output_tokens')
+    usage = getattr(response, 'usage', None)
+    name = 'completion_tokens' if provider == 'openai' else 'output_tokens'
+    if isinstance(usage, dict):
+        return usage.get(name)
+    return getattr(usage, name, None)
+
+
+def record(provider, model, response):
+    """
+    Adds the token counts of a response to the metrics.
+    """
+    counts = token_counts(provider, response)
+    if not counts:
+        return
+    with _lock:
+        metrics[(provider, model, 'responses')] += 1
+        for name, value in counts.items():
+            metrics[(provider, model, name)] += value
+
+
+def report():
+    """
+    Prints the token counts per model, with the prompt-cache hit rate of the
+    models whose responses reported prompt-cache tokens.
+    """
+    models = sorted({(provider, model) for provider, model, _ in metrics})
+    if not models:
+        return
+    print("Token usage:")
+    for provider, model in models:
+        counts = {name: metrics[(provider, model, name)]
+                  for name in ('responses', 'input', 'cache_read', 'cache_write', 'output')}
+        cached = ''
+        if counts['cache_read'] or counts['cache_write']:
+            hit_rate = counts['cache_read'] / counts['input'] if counts['input'] else 0.0
+            cached = (f" ({counts['cache_read']} from the prompt cache, {hit_rate:.0%}; "
+                      f"{counts['cache_write']} written to it)")
+        print(f"  {provider} {model}: {counts['responses']} responses, {counts['input']} input "
+              f"tokens{cached}, {counts['output']} output tokens")
@@ -0,0 +1,384 @@
+"""
+Work-queue mode of the unified runner: workers lease jobs from a shared
+SQLite file instead of running a fixed shard.
+
+Usage (from the repository root):
+
+    python -m nejm_vlm.workqueue init --models gpt4o Claude --tasks full --tries 3
+    python -m nejm_vlm.workqueue work --threads 4        # on every worker host
+    python -m nejm_vlm.workqueue status
+    python -m nejm_vlm.workqueue collect
+
+A job is one (model, task, case, temperature, try). A worker leases a job
+for VLM_QUEUE_LEASE seconds (default 600) and renews the lease every third of
+that while the request runs. A lease that is not renewed (the worker crashed
+or lost its host) expires and the job is leased again by the next free
+worker, so no worker waits on a straggler's cases. Result files are written
+to the standard `*_result` folders as soon as a job finishes; the execution
+times are committed to the queue, and `collect` folds them into the standard
+execution-time store and rebuilds the results sheets.
+
+Workers on several hosts need the queue file and the result folders on a
+shared filesystem with working file locks. A failed job goes back to the
+queue; after MAX_JOB_ATTEMPTS failures it is marked failed.
+
+The jobs are leased case by case, with the models of a case next to each
+other, so the threads of a worker spread over the models. The workers do not
+wait for an open circuit (nejm_vlm.circuit): a job failing on it goes back to
+the queue without counting as an attempt, and the jobs of that model are not
+leased until its circuit lets requests through again, while the other models
+keep going.
+"""
+import argparse
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from nejm_vlm import circuit
+from nejm_vlm import keys
+from nejm_vlm import results
+from nejm_vlm import retry
+from nejm_vlm import runner
+from nejm_vlm import shutdown
+
+QUEUE_FILE = 'vlm_queue.sqlite'
+DEFAULT_LEASE = 600.0
+MAX_JOB_ATTEMPTS = 3
+# Seconds an idle worker waits before looking for expired leases again.
+IDLE_POLL = 5.0
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    model TEXT, task TEXT, case_number INTEGER, temperature REAL, try INTEGER,
+    state TEXT, worker TEXT, lease_until REAL, attempts INTEGER, time REAL,
+    PRIMARY KEY (model, task, case_number, temperature, try)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until);
+"""
+
+
+def lease_seconds():
+    return float(os.getenv('VLM_QUEUE_LEASE', DEFAULT_LEASE))
+
+
+def connect(queue_file):
+    """
+    Opens the queue; every connection waits up to a minute for a lock.
+    """
+    connection = sqlite3.connect(queue_file, timeout=60, isolation_level=None)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def enqueue(connection, models, tasks, temperatures, tries):
+    """
+    Adds a job for every case, temperature and try without a result file.
+    Jobs already in the queue are kept as they are.
+
+    Returns:
+    int: Number of jobs added.
+    """
+    added = 0
+    connection.execute('BEGIN IMMEDIATE')
+    for task in tasks:
+        case_list = results.load_case_list(results.TASK_FOLDERS[task])
+        if case_list is None:
+            print(f"No {results.CASE_LIST_FILE} in {results.TASK_FOLDERS[task]}, skipping {task}")
+            continue
+        cases = results.case_numbers(case_list)
+        for model_key in models:
+            for temperature in temperatures:
+                for try_number in range(1, tries + 1):
+                    result_folder = runner.create_result_folder(
+                        model_key, task, temperature, try_number
+                    )
+                    for case_number in cases:
+                        if os.path.exists(results.result_file_path(result_folder, case_number)):
+                            continue
+                        cursor = connection.execute(
+                            'INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?, ?, ?, NULL, 0, 0, NULL)',
+                            (model_key, task, case_number, temperature, try_number, PENDING),
+                        )
+                        added += cursor.rowcount
+    connection.execute('COMMIT')
+    return added
+
+
+def lease(connection, worker, seconds, skip_models=()):
+    """
+    Leases the next pending job, or a job whose lease has expired.
+
+    Parameters:
+    skip_models (list): Models whose jobs are not leased (open circuits).
+
+    Returns:
+    tuple: (model, task, case_number, temperature, try), or None if every
+    job is done, failed, leased or skipped.
+    """
+    now = time.time()
+    skip = ''
+    if skip_models:
+        skip = f" AND model NOT IN ({', '.join('?' * len(skip_models))})"
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        # Expired leases ('leased') sort before pending jobs, so stragglers
+        # are picked up first; the models of a case come next to each other.
+        job = connection.execute(
+            'SELECT model, task, case_number, temperature, try, state FROM jobs '
+            f'WHERE (state = ? OR (state = ? AND lease_until < ?)){skip} '
+            'ORDER BY state, task, temperature, try, case_number, model LIMIT 1',
+            (PENDING, LEASED, now, *skip_models),
+        ).fetchone()
+        if job is None:
+            return None
+        if job[5] == LEASED:
+            print(f"Reclaiming expired lease: {job[0]} {job[1]} case {job[2]}")
+        connection.execute(
+            'UPDATE jobs SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1 '
+            'WHERE model = ? AND task = ? AND case_number = ? AND temperature = ? AND try = ?',
+            (LEASED, worker, now + seconds, *job[:5]),
+        )
+        return job[:5]
+    finally:
+        connection.execute('COMMIT')
+
+
+def renew(connection, worker, job, seconds):
+    """
+    Extends the lease of a job.
+
+    Returns:
+    bool: Whether the worker still holds the lease.
+    """
+    cursor = connection.execute(
+        'UPDATE jobs SET lease_until = ? WHERE state = ? AND worker = ? AND '
+        'model = ? AND task = ? AND case_number = ? AND temperature = ? AND try = ?',
+        (time.time() + seconds, LEASED, worker, *job),
+    )
+    return cursor.rowcount == 1
+
+
+def finish(connection, job, worker, saved, execution_time, counted=True):
+    """
+    Commits the outcome of a leased job. A failed job is queued again until
+    it has failed MAX_JOB_ATTEMPTS times; a job given up because of a stop
+    request, or not counted (an open circuit), is queued again without
+    counting the attempt.
+
+    Only the worker holding the lease commits: a job whose lease expired and
+    was taken over by another worker is left to that worker.
+
+    Returns:
+    bool: Whether the outcome was committed.
+    """
+    key = 'model = ? AND task = ? AND case_number = ? AND temperature = ? AND try = ?'
+    attempts_change = -1 if not saved and (not counted or shutdown.requested()) else 0
+    if saved:
+        state, params = '?', (DONE,)
+    else:
+        state, params = 'CASE WHEN attempts + ? >= ? THEN ? ELSE ? END', \
+            (attempts_change, MAX_JOB_ATTEMPTS, FAILED, PENDING)
+    cursor = connection.execute(
+        f'UPDATE jobs SET state = {state}, attempts = attempts + ?, worker = NULL, '
+        f'lease_until = 0, time = ? WHERE {key} AND worker = ? AND state = ?',
+        (*params, attempts_change, execution_time, *job, worker, LEASED),
+    )
+    return cursor.rowcount == 1
+
+
+def open_circuits():
+    """
+    Returns the models whose circuits hold back their requests.
+    """
+    now = time.time()
+    return [
+        model_key for model_key, model in runner.MODELS.items()
+        if keys.ready_at(model.provider, model.name) > now
+    ]
+
+
+def heartbeat(queue_file, worker, job, seconds, stop, lost):
+    """
+    Renews the lease of a job every third of the lease time until stop is set,
+    and sets lost if the lease was taken over.
+    """
+    connection = connect(queue_file)
+    try:
+        while not stop.wait(seconds / 3):
+            if not renew(connection, worker, job, seconds):
+                print(f"Worker {worker} lost its lease on {job[0]} {job[1]} case {job[2]}")
+                lost.set()
+                return
+    finally:
+        connection.close()
+
+
+def work(queue_file, worker, seconds):
+    """
+    Leases and runs jobs until the queue is drained or a stop is requested.
+
+    Returns:
+    int: Number of jobs run.
+    """
+    connection = connect(queue_file)
+    circuit.set_waiting(False)
+    case_lists = {}
+    jobs_run = 0
+    while not shutdown.requested():
+        job = lease(connection, worker, seconds, open_circuits())
+        if job is None:
+            left = connection.execute(
+                'SELECT COUNT(*) FROM jobs WHERE state IN (?, ?)', (LEASED, PENDING)
+            ).fetchone()[0]
+            if not left:
+                break
+            # Other workers still hold leases, or the jobs left wait for an
+            # open circuit; wait in case a lease expires or a circuit closes.
+            shutdown.wait(IDLE_POLL)
+            continue
+
+        model_key, task, case_number, temperature, try_number = job
+        temperature = runner.parse_temperature(temperature)
+        if task not in case_lists:
+            case_lists[task] = results.load_case_list(results.TASK_FOLDERS[task])
+        case_list = case_lists[task]
+        row = case_list[case_list[results.CASE_COLUMN] == case_number].iloc[0]
+        result_folder = runner.create_result_folder(model_key, task, temperature, try_number)
+
+        stop = threading.Event()
+        lost = threading.Event()
+        threading.Thread(
+            target=heartbeat, args=(queue_file, worker, job, seconds, stop, lost), daemon=True
+        ).start()
+        try:
+            if os.path.exists(results.result_file_path(result_folder, case_number)):
+                saved, execution_time = True, None
+            else:
+                saved, execution_time, _ = runner.run_case(
+                    model_key, task, row, temperature, try_number, result_folder
+                )
+        finally:
+            stop.set()
+        # A job failing on an open circuit is not the case's fault.
+        model = runner.MODELS[model_key]
+        counted = saved or keys.ready_at(model.provider, model.name) <= time.time()
+        if not counted:
+            print(f"{model_key} {task} case {case_number}: circuit open, back to the queue")
+        if lost.is_set() or not finish(connection, job, worker, saved, execution_time, counted):
+            print(f"Worker {worker} no longer holds {model_key} {task} case {case_number}; "
+                  f"its outcome is left to the current holder")
+        jobs_run += 1
+    connection.close()
+    return jobs_run
+
+
+def status(connection):
+    """
+    Returns the job counts per model, task and state.
+    """
+    return pd.read_sql_query(
+        'SELECT model, task, state, COUNT(*) AS jobs FROM jobs '
+        'GROUP BY model, task, state ORDER BY task, model, state',
+        connection,
+    )
+
+
+def collect(connection):
+    """
+    Folds the execution times of the finished jobs into the execution-time
+    stores and rebuilds the results sheets of every run in the queue.
+    """
+    done = pd.read_sql_query(
+        'SELECT model, task, case_number AS number, temperature, try, time FROM jobs '
+        'WHERE state = ? AND time IS NOT NULL',
+        connection, params=(DONE,),
+    )
+    runs = connection.execute('SELECT DISTINCT model, task, temperature, try FROM jobs').fetchall()
+    for (model_key, task), times in done.groupby(['model', 'task']):
+        model = runner.MODELS[model_key]
+        time_file = os.path.join(results.TASK_FOLDERS[task], model.time_file)
+        times = times[runner.TIME_COLUMNS].copy()
+        times['temperature'] = times['temperature'].map(runner.parse_temperature)
+        df_execution_times = runner.upsert_execution_times(
+            runner.load_execution_times(time_file), times
+        )
+        df_execution_times.to_excel(time_file, index=False, engine='openpyxl')
+        print(f"{len(times)} execution times saved to {time_file}")
+    for model_key, task, temperature, try_number in runs:
+        result_folder = runner.create_result_folder(
+            model_key, task, runner.parse_temperature(temperature), try_number
+        )
+        runner.write_results_sheet(
+            task, runner.MODELS[model_key], result_folder,
+            results.load_case_list(results.TASK_FOLDERS[task]),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--queue', default=QUEUE_FILE)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    init_parser = subparsers.add_parser('init', help='Queue the cases without a result')
+    init_parser.add_argument('--models', nargs='*', default=list(runner.MODELS),
+                             choices=list(runner.MODELS))
+    init_parser.add_argument('--tasks', nargs='*', default=list(results.TASK_FOLDERS),
+                             choices=list(results.TASK_FOLDERS))
+    init_parser.add_argument('--temperatures', nargs='*', type=runner.parse_temperature,
+                             default=[1])
+    init_parser.add_argument('--tries', type=int, default=1, help='Tries per temperature')
+
+    work_parser = subparsers.add_parser('work', help='Lease and run jobs until none are left')
+    work_parser.add_argument('--threads', type=int, default=1,
+                             help='Jobs run at the same time by this worker')
+    work_parser.add_argument('--worker', default=f"{socket.gethostname()}:{os.getpid()}")
+
+    subparsers.add_parser('status', help='Print the job counts')
+    subparsers.add_parser('collect', help='Save the execution times and results sheets')
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        connection = connect(args.queue)
+        added = enqueue(connection, args.models, args.tasks, args.temperatures, args.tries)
+        print(f"{added} jobs added to {args.queue}")
+        connection.close()
+    elif args.command == 'work':
+        shutdown.install()
+        seconds = lease_seconds()
+        counts = []
+
+        def worker_loop(name):
+            counts.append(work(args.queue, name, seconds))
+
+        threads = [
+            threading.Thread(target=worker_loop, args=(f"{args.worker}:{index}",))
+            for index in range(1, args.threads + 1)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # join() with a timeout keeps the main thread responsive to Ctrl-C.
+            while thread.is_alive():
+                thread.join(timeout=1)
+        print(f"Worker {args.worker}: {sum(counts)} jobs run")
+        retry.report()
+        return
+    connection = connect(args.queue)
+    if args.command == 'status':
+        print(status(connection).to_string(index=False))
+    elif args.command == 'collect':
+        collect(connection)
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
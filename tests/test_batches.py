@@ -0,0 +1,56 @@
+import json
+import os
+
+import pytest
+
+from nejm_vlm import batches
+from nejm_vlm import runner
+
+
+@pytest.mark.parametrize('model_key, task, case_number, temperature, try_number', [
+    ('gpt4o', 'full', 1, 1, 1),
+    ('Claude', 'no-img', 272, 0, 3),
+    ('gemini_flash', 'img-only', 12, 0.5, 2),
+    ('gpt4v', 'full', 7, 1.5, 10),
+])
+def test_custom_id_round_trip(model_key, task, case_number, temperature, try_number):
+    job_id = batches.custom_id(model_key, task, case_number, temperature, try_number)
+    assert len(job_id) <= 64
+    assert all(character.isalnum() or character in '_-' for character in job_id)
+    assert batches.parse_custom_id(job_id) == (
+        model_key, task, case_number, temperature, try_number,
+    )
+    # The temperature names the same result folder as the runner's.
+    parsed_temperature = batches.parse_custom_id(job_id)[3]
+    assert str(parsed_temperature) == str(runner.parse_temperature(temperature))
+
+
+def test_parse_custom_id_rejects_other_ids():
+    with pytest.raises(ValueError):
+        batches.parse_custom_id('request-1')
+
+
+def test_write_request_files_splits_by_count_and_size(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    lines = [{'custom_id': f'job{index}', 'body': 'x' * 50} for index in range(5)]
+    paths = batches.write_request_files(lines, 'gpt4o', 2, 10000)
+    assert [os.path.basename(path) for path in paths] == [
+        'gpt4o_part1.jsonl', 'gpt4o_part2.jsonl', 'gpt4o_part3.jsonl',
+    ]
+    assert batches.read_custom_ids(paths[2]) == {'job4'}
+
+    line_size = len(json.dumps(lines[0]).encode('utf-8')) + 1
+    paths = batches.write_request_files(lines, 'Claude', 100, 2 * line_size + 1)
+    assert len(paths) == 3
+    assert all(os.path.getsize(path) <= 2 * line_size + 1 for path in paths)
+
+
+def test_in_flight_skips_ingested_batches(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = batches.write_request_files([{'custom_id': 'a'}], 'first', 10, 10000)[0]
+    second = batches.write_request_files([{'custom_id': 'b'}], 'second', 10, 10000)[0]
+    batches.save_ledger([
+        {'input_file': first, 'state': 'submitted'},
+        {'input_file': second, 'state': 'ingested'},
+    ])
+    assert batches.in_flight(batches.load_ledger()) == {'a'}
@@ -0,0 +1,66 @@
+import pytest
+
+from nejm_vlm import cache
+from nejm_vlm import runner
+
+PROMPT = 'Answer the question.\n    symptom: cough'
+
+
+def key(prompt_text=PROMPT, images=('aW1hZ2U=',), temperature=1, try_number=1, **kwargs):
+    return cache.request_key('openai', 'gpt-4o', prompt_text, list(images), temperature,
+                             1024, try_number, **kwargs)[0]
+
+
+def test_key_ignores_whitespace_only():
+    assert key('Answer the question. symptom: cough') == key()
+    assert key('Answer the question. symptom: fever') != key()
+    assert key(images=['b3RoZXI=']) != key()
+    assert key(temperature=0.5) != key()
+    assert key(try_number=2) != key()
+
+
+def test_unset_options_keep_the_key():
+    assert key(top_logprobs=0, options={}) == key()
+    assert key(top_logprobs=5) != key()
+    assert key(options={'structured': True}) != key()
+
+
+@pytest.fixture
+def sent_options(monkeypatch):
+    """
+    Sends a Claude request through runner.request_sender() and returns the
+    cache key options it was looked up with.
+    """
+    calls = []
+    monkeypatch.setattr(runner.providers, 'anthropic_client', lambda: None)
+    monkeypatch.setattr(runner.cache, 'cached_call', lambda *args: calls.append(args))
+
+    def send():
+        runner.request_sender(runner.MODELS['Claude'], PROMPT, 1, 1)([])
+        return calls[-1][-1]
+    return send
+
+
+def test_structured_requests_have_their_own_key(sent_options, monkeypatch):
+    monkeypatch.delenv('VLM_PROMPT_LAYOUT', raising=False)
+    monkeypatch.setenv('VLM_STRUCTURED_OUTPUT', '0')
+    assert sent_options() == {}
+    monkeypatch.setenv('VLM_STRUCTURED_OUTPUT', '1')
+    assert sent_options() == {'structured': True}
+
+
+def test_replay_miss_raises(tmp_path, monkeypatch):
+    monkeypatch.setenv('VLM_CACHE_MODE', 'replay')
+    monkeypatch.setenv('VLM_CACHE_DIR', str(tmp_path))
+    with pytest.raises(cache.CacheMiss):
+        cache.cached_call('openai', 'gpt-4o', PROMPT, [], 1, 1024, 1,
+                          lambda: pytest.fail('The API was called in replay mode'))
+
+
+def test_prompt_layouts_have_their_own_keys(sent_options, monkeypatch):
+    monkeypatch.setenv('VLM_STRUCTURED_OUTPUT', '0')
+    monkeypatch.setenv('VLM_PROMPT_LAYOUT', 'script')
+    assert sent_options() == {}
+    for layout in ('compact', 'prefix'):
+        monkeypatch.setenv('VLM_PROMPT_LAYOUT', layout)
+        assert sent_options() == {'layout': layout}
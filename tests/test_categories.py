@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from nejm_vlm import categories
+
+MODALITIES = list(categories.MODALITY_VOCABULARY)
+PLANES = list(categories.PLANE_VOCABULARY)
+BODY_PARTS = list(categories.BODY_PART_VOCABULARY)
+
+
+def codes(labels, vocabulary_labels):
+    return sum(1 << vocabulary_labels.index(label) for label in labels)
+
+
+def modality(text):
+    return categories.normalize(text, categories.MATCHERS['1_TypeOfMedicalImaging'],
+                                categories.MODALITY_VOCABULARY)
+
+
+def body_part(text):
+    return categories.normalize(text, categories.MATCHERS['5_PartOfTheBodyImaged'],
+                                categories.BODY_PART_VOCABULARY)
+
+
+@pytest.mark.parametrize('text, labels', [
+    ('MRI', ['MR']),
+    ('Contrast-enhanced CT', ['CT']),
+    ('a.MR b.CT', ['MR', 'CT']),
+    ('a) Chest radiograph, b) CT', ['X-ray', 'CT']),
+    ('Ultrasound and Doppler', ['US']),
+    ('Photograph', [categories.OTHER]),
+    ('', []),
+    (float('nan'), []),
+])
+def test_modality(text, labels):
+    assert modality(text) == codes(labels, MODALITIES)
+
+
+def test_whole_words_only():
+    # 'us' inside 'thalamus' or 'pet' inside 'petrous' are not modalities.
+    assert modality('thalamus') == codes([categories.OTHER], MODALITIES)
+    assert modality('petrous bone') == codes([categories.OTHER], MODALITIES)
+
+
+def test_match_inside_a_longer_match_is_ignored():
+    assert body_part('cervical spine') == codes(['spine'], BODY_PARTS)
+    assert body_part('cervical lymph nodes') == codes(['neck'], BODY_PARTS)
+
+
+def test_plane():
+    plane = categories.normalize('Axial and coronal', categories.MATCHERS['4_ImagePlane'],
+                                 categories.PLANE_VOCABULARY)
+    assert plane == codes(['axial', 'coronal'], PLANES)
+
+
+def test_split_enumeration():
+    assert categories.split_enumeration('a.MR b.CT') == ['MR', 'CT']
+    assert categories.split_enumeration('CT; MR / US') == ['CT', 'MR', 'US']
+
+
+def test_confusion_matrix_and_scores():
+    n_labels = 3
+    true_masks = np.array([0b001, 0b010, 0b011, 0b000], dtype=np.uint32)
+    pred_masks = np.array([0b001, 0b100, 0b001, 0b001], dtype=np.uint32)
+    matrix = categories.confusion_matrix(true_masks, pred_masks, n_labels)
+    # The unlabeled fourth case is left out.
+    assert matrix.tolist() == [[2, 0, 0], [1, 0, 1], [0, 0, 0]]
+
+    scores = categories.label_scores(true_masks, pred_masks, n_labels)
+    assert scores['n_cases'] == 3
+    assert scores['exact_match'] == pytest.approx(1 / 3)
+    assert scores['tp'].tolist() == [2, 0, 0]
+    assert scores['fp'].tolist() == [0, 0, 1]
+    assert scores['fn'].tolist() == [0, 2, 0]
+    assert scores['precision'] == pytest.approx(2 / 3)
+    assert scores['recall'] == pytest.approx(2 / 4)
+
+
+def test_extract_img_only_fields():
+    text = ('{"1_TypeOfMedicalImaging": "CT", "2_SpecificImagingSequence": "none", '
+            '"3_UseOfContrast": "yes", "4_ImagePlane": "axial", '
+            '"5_PartOfTheBodyImaged": "chest"}')
+    fields = categories.extract_img_only_fields(text)
+    assert fields['1_TypeOfMedicalImaging'] == 'CT'
+    assert fields['5_PartOfTheBodyImaged'] == 'chest'
+    assert categories.extract_img_only_fields(None) == {
+        field: '' for field in categories.IMG_ONLY_FIELDS
+    }
@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from nejm_vlm import circuit
+
+
+def test_opens_after_the_threshold():
+    breaker = circuit.CircuitBreaker('test', threshold=2, cooldown=60)
+    breaker.record(False, 'overloaded')
+    assert breaker.state == circuit.CLOSED
+    breaker.record(False, 'timeout')
+    assert breaker.state == circuit.OPEN
+    assert breaker.ready_at() > time.time()
+
+
+def test_other_errors_close_the_circuit():
+    breaker = circuit.CircuitBreaker('test', threshold=2, cooldown=60)
+    breaker.record(False, 'overloaded')
+    breaker.record(False, 'invalid_request')
+    breaker.record(False, 'overloaded')
+    assert breaker.state == circuit.CLOSED
+
+
+def test_open_circuit_fails_at_once_without_waiting():
+    breaker = circuit.CircuitBreaker('test', threshold=1, cooldown=60)
+    breaker.record(False, 'transient')
+    start_time = time.time()
+    with pytest.raises(circuit.CircuitOpen):
+        breaker.acquire(block=False)
+    assert time.time() - start_time < 1
+
+
+def test_thread_setting_selects_waiting():
+    breaker = circuit.CircuitBreaker('test', threshold=1, cooldown=60)
+    breaker.record(False, 'transient')
+    circuit.set_waiting(False)
+    try:
+        with pytest.raises(circuit.CircuitOpen):
+            breaker.acquire()
+    finally:
+        circuit.set_waiting(True)
+    assert circuit.waits()
+
+
+def test_half_open_probe():
+    breaker = circuit.CircuitBreaker('test', threshold=1, cooldown=0.05)
+    breaker.record(False, 'overloaded')
+    time.sleep(0.1)
+    assert breaker.acquire(block=False) is True
+    # A single probe at a time.
+    with pytest.raises(circuit.CircuitOpen):
+        breaker.acquire(block=False)
+    breaker.record(True, 'overloaded')
+    assert breaker.state == circuit.OPEN
+    assert breaker.cooldown == pytest.approx(0.1)
+    time.sleep(0.15)
+    assert breaker.acquire(block=False) is True
+    breaker.record(True)
+    assert breaker.state == circuit.CLOSED
+    assert breaker.acquire(block=False) is False
@@ -0,0 +1,86 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from nejm_vlm import hedging
+from nejm_vlm import pacing
+from nejm_vlm import retry
+
+GOOD = '{"answer": "2", "reason": "target sign"}'
+REFUSAL = "I'm sorry, but I can't help with that."
+
+
+def response(text):
+    return SimpleNamespace(choices=[SimpleNamespace(
+        message=SimpleNamespace(content=text), finish_reason='stop',
+    )])
+
+
+@pytest.fixture
+def hedged_model(monkeypatch):
+    """
+    A model with enough fast latencies recorded to be hedged after ~10 ms.
+    """
+    monkeypatch.setenv('VLM_HEDGE_BUDGET', '100')
+    monkeypatch.setattr(hedging, 'metrics', hedging.Counter())
+    monkeypatch.setattr(hedging, '_recorders', {})
+    model = 'test-hedged'
+    recorder = hedging.get_recorder('openai', model)
+    for _ in range(hedging.MIN_SAMPLES):
+        recorder.record(0.01)
+    hedging.metrics[('openai', model, 'calls')] = 100
+    # A fresh pacer allows one request in flight; let the hedge run beside
+    # the primary.
+    monkeypatch.setattr(pacing, '_pacers', {})
+    pacing.get_pacer('openai', model).limit = 2.0
+    return model
+
+
+def sender(first_text, first_delay, second_text):
+    """
+    Returns a send function answering slowly on its first call and at once
+    on the second.
+    """
+    calls = []
+    lock = threading.Lock()
+
+    def send(encoded_images):
+        with lock:
+            calls.append(1)
+            number = len(calls)
+        if number == 1:
+            time.sleep(first_delay)
+            return response(first_text)
+        return response(second_text)
+    return send, calls
+
+
+def test_fast_refusal_does_not_beat_a_good_primary(hedged_model):
+    send, calls = sender(GOOD, 0.3, REFUSAL)
+    result = retry.call_with_retry(send, 'openai', hedged_model, hedge=True)
+    assert result.choices[0].message.content == GOOD
+    assert len(calls) == 2
+    assert hedging.metrics[('openai', hedged_model, 'hedge_wins')] == 0
+
+
+def test_usable_hedge_wins(hedged_model):
+    send, calls = sender(GOOD, 0.3, '{"answer": "3", "reason": "hedge"}')
+    result = retry.call_with_retry(send, 'openai', hedged_model, hedge=True)
+    assert '"3"' in result.choices[0].message.content
+    assert hedging.metrics[('openai', hedged_model, 'hedge_wins')] == 1
+
+
+def test_no_hedge_without_budget(hedged_model, monkeypatch):
+    monkeypatch.setenv('VLM_HEDGE_BUDGET', '0')
+    send, calls = sender(GOOD, 0.05, REFUSAL)
+    retry.call_with_retry(send, 'openai', hedged_model, hedge=True)
+    assert len(calls) == 1
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert hedging.percentile(values, 50) == 50
+    assert hedging.percentile(values, 95) == 95
+    assert hedging.percentile([3.0], 99) == 3.0
@@ -0,0 +1,81 @@
+import math
+
+import numpy as np
+import pytest
+
+from nejm_vlm import logprobs
+
+
+def response(tokens):
+    """
+    Builds an OpenAI-shaped response from (token, [(alternative, probability)]) pairs.
+    """
+    return {'choices': [{'logprobs': {'content': [
+        {
+            'token': token,
+            'logprob': math.log(alternatives[0][1]) if alternatives else 0.0,
+            'top_logprobs': [
+                {'token': alternative, 'logprob': math.log(probability)}
+                for alternative, probability in alternatives
+            ],
+        }
+        for token, alternatives in tokens
+    ]}}]}
+
+
+def test_distribution_of_the_answer_token():
+    distribution = logprobs.answer_distribution(response([
+        ('{"', []), ('answer', []), ('":"', []),
+        ('3', [('3', 0.6), ('1', 0.2), ('x', 0.1), (' 4', 0.1)]),
+        ('","', []), ('reason', []), ('":"', []), ('target sign', []), ('"}', []),
+    ]))
+    assert distribution['answer'] == 3
+    assert distribution['coverage'] == pytest.approx(0.9)
+    assert list(distribution['distribution']) == ['3', '1', '4']
+    assert distribution['distribution']['3'] == pytest.approx(0.6 / 0.9)
+
+
+def test_number_inside_the_answer_text():
+    distribution = logprobs.answer_distribution(response([
+        ('{"answer": "', []), ('Option ', []), ('2', [('2', 0.7), ('5', 0.3)]),
+        ('", "reason": "', []), ('x', []), ('"}', []),
+    ]))
+    assert distribution['answer'] == 2
+    assert distribution['distribution'] == pytest.approx({'2': 0.7, '5': 0.3})
+
+
+def test_number_before_the_answer_is_not_taken():
+    # Free text before the object holds another number after an "answer" key.
+    distribution = logprobs.answer_distribution(response([
+        ('The "answer": ', []), ('4', [('4', 0.9), ('2', 0.1)]), (' is tempting, but\n', []),
+        ('{"answer": "', []), ('2', [('2', 0.8), ('4', 0.2)]), ('", "reason": "x"}', []),
+    ]))
+    assert distribution['answer'] == 2
+    assert distribution['distribution'] == pytest.approx({'2': 0.8, '4': 0.2})
+
+
+def test_no_token_holding_the_answer():
+    distribution = logprobs.answer_distribution(response([
+        ('The "answer": ', []), ('4', [('4', 0.9), ('2', 0.1)]),
+        (' is wrong. {"answer": "two", "reason": "x"}', []),
+    ]))
+    assert distribution is None
+
+
+def test_response_without_logprobs():
+    assert logprobs.answer_distribution({'choices': [{'logprobs': None}]}) is None
+    assert logprobs.answer_distribution({'choices': []}) is None
+
+
+def test_expected_calibration_error():
+    confidence = np.array([0.9, 0.9, 0.6, 0.6])
+    correct = np.array([True, False, True, True])
+    # Bin 0.9: |0.9 - 0.5| = 0.4; bin 0.6: |0.6 - 1| = 0.4.
+    assert logprobs.expected_calibration_error(confidence, correct) == pytest.approx(0.4)
+
+
+def test_load_distributions(tmp_path):
+    logprobs.save_distribution(str(tmp_path), 2, {'answer': 1, 'distribution': {'1': 0.75, '3': 0.25}})
+    probabilities = logprobs.load_distributions(str(tmp_path), [1, 2], 4)
+    assert np.isnan(probabilities[0]).all()
+    assert probabilities[1] == pytest.approx([0.75, 0, 0.25, 0])
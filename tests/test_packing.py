@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from nejm_vlm import packing
+from nejm_vlm import results
+from nejm_vlm import runner
+
+
+def test_parse_answers():
+    text = json.dumps({'answers': [
+        {'case': 12, 'answer': '3', 'reason': 'first'},
+        {'case': '13', 'answer': 'Option 1', 'reason': 'second'},
+        {'case': 12, 'answer': '4', 'reason': 'duplicate'},
+        {'case': 99, 'answer': '2', 'reason': 'not in the pack'},
+        {'case': 14, 'answer': 'none of them', 'reason': 'no option'},
+        'not an object',
+    ]})
+    answers = packing.parse_answers(text, [12, 13, 14])
+    assert sorted(answers) == [12, 13]
+    assert json.loads(answers[12]) == {'answer': '3', 'reason': 'first'}
+    assert json.loads(answers[13]) == {'answer': 'Option 1', 'reason': 'second'}
+    # The saved result reads like an unpacked response.
+    assert results.extract_answer_and_reason(answers[13])['answer'] == 'Option 1'
+
+
+def test_parse_answers_of_a_truncated_response():
+    text = '{"answers": [{"case": 1, "answer": "2", "reason": "x"}, {"case": 2, "answ'
+    assert sorted(packing.parse_answers(text, [1, 2])) == [1]
+
+
+@pytest.mark.parametrize('text', [None, '', 'no JSON', '{"answer": "2"}', '{"answers": "2"}'])
+def test_parse_answers_without_a_list(text):
+    assert packing.parse_answers(text, [1, 2]) == {}
+
+
+def test_chunks_and_output_limit():
+    assert packing.chunks([1, 2, 3, 4, 5], 2) == [[1, 2], [3, 4], [5]]
+    assert packing.max_tokens(2) == 2 * packing.TOKENS_PER_QUESTION
+    assert packing.max_tokens(100) == packing.MAX_PACKED_TOKENS
+
+
+def test_missing_cases_are_sent_again_one_by_one(tmp_path, monkeypatch):
+    response = json.dumps({'answers': [{'case': 1, 'answer': '2', 'reason': 'x'}]})
+    monkeypatch.setattr(runner, 'analyze_case', lambda *args, **kwargs: [response, 4.0, 100, None])
+    single = []
+
+    def run_case(model_key, task, row, temperature, try_number, result_folder):
+        single.append(row[results.CASE_COLUMN])
+        return True, 1.0, 10
+
+    monkeypatch.setattr(runner, 'run_case', run_case)
+    rows = [{results.CASE_COLUMN: number, 'Q': f'question {number}'} for number in (1, 2)]
+    outcomes = runner.run_pack('gpt4o', rows, 1, 1, str(tmp_path))
+
+    assert single == [2]
+    assert outcomes == [(1, True, 2.0, 50.0), (2, True, 1.0, 10)]
+    assert results.extract_answer_and_reason(
+        results.read_result_text(str(tmp_path), 1)
+    )['answer'] == '2'
+    assert results.read_result_text(str(tmp_path), 2) is None
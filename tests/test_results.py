@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from nejm_vlm import results
+
+
+@pytest.mark.parametrize('text, answer', [
+    ('{"answer": "3", "reason": "x"}', '3'),
+    ('```json\n{"answer": 2, "reason": "x"}\n```', '2'),
+    ('{"answer": "4", "reason": "unterminated "quote" inside"}', '4'),
+    ('no JSON at all', ''),
+])
+def test_extract_answer_and_reason(text, answer):
+    assert results.extract_answer_and_reason(text)['answer'] == answer
+
+
+@pytest.mark.parametrize('answer, number', [
+    ('3', 3), ('Option 2', 2), ('', 0), (None, 0), (float('nan'), 0), (5, 5),
+])
+def test_parse_option_number(answer, number):
+    assert results.parse_option_number(answer) == number
+
+
+def write_result(folder, case_number, text):
+    os.makedirs(folder, exist_ok=True)
+    with open(results.result_file_path(folder, case_number), 'w', encoding='utf-8') as file:
+        file.write(text)
+
+
+def test_load_answer_tensor(tmp_path):
+    base = str(tmp_path / results.MODEL_FOLDERS['gpt4o'])
+    write_result(f'{base}_temp_0_5_try1', 1, '{"answer": "2", "reason": "x"}')
+    write_result(f'{base}_temp_0_5_try1', 3, '{"answer": "Option 4", "reason": "x"}')
+    write_result(f'{base}_temp_1_try2', 2, '{"answer": "1", "reason": "x"}')
+
+    tensor = results.load_answer_tensor(str(tmp_path), ['gpt4o', 'Claude'], [1, 2, 3])
+    assert tensor.answers.shape == (2, 2, 2, 3)
+    assert tensor.temperatures == [0.5, 1.0]
+    assert tensor.tries == [1, 2]
+    assert tensor.answers[0, 0, 0].tolist() == [2, 0, 4]
+    assert tensor.answers[0, 1, 1].tolist() == [0, 1, 0]
+    assert tensor.present.tolist() == [[[True, False], [False, True]],
+                                       [[False, False], [False, False]]]
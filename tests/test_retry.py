@@ -0,0 +1,89 @@
+import pytest
+
+from nejm_vlm import retry
+from nejm_vlm import shutdown
+
+
+@pytest.fixture(autouse=True)
+def no_stop():
+    yield
+    shutdown._stop.clear()
+    shutdown._reason.clear()
+
+
+class StatusError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@pytest.mark.parametrize('error, error_class', [
+    (Exception("This model's maximum context length is 128000 tokens"), 'invalid_request'),
+    (Exception('context_length_exceeded'), 'invalid_request'),
+    (Exception('max_tokens exceeded'), 'invalid_request'),
+    (Exception('Request payload size exceeded the limit'), 'payload_too_large'),
+    (StatusError('Request Entity Too Large', 413), 'payload_too_large'),
+    (StatusError('You exceeded your current quota, please check your plan', 429), 'quota'),
+    (Exception('Your organization has exceeded its monthly usage limit.'), 'quota'),
+    (StatusError('Rate limit reached for gpt-4o', 429), 'rate_limit'),
+    (StatusError('429 Quota exceeded for quota metric (RESOURCE_EXHAUSTED)', 429), 'rate_limit'),
+    (StatusError('Overloaded', 529), 'overloaded'),
+    (StatusError('invalid x-api-key', 401), 'auth'),
+    (StatusError('Invalid value for temperature', 400), 'invalid_request'),
+    (Exception('Request timed out.'), 'timeout'),
+    (Exception('Connection reset by peer'), 'transient'),
+    (retry.ResponseRejected('refusal', "I'm sorry, but I can't"), 'refusal'),
+])
+def test_classify_error(error, error_class):
+    assert retry.classify_error(error) == error_class
+
+
+def test_context_length_error_fails_the_case_without_stopping():
+    attempts = []
+
+    def send(encoded_images):
+        attempts.append(1)
+        raise Exception("context_length_exceeded: the prompt is too long")
+
+    with pytest.raises(retry.RequestFailed) as failed:
+        retry.call_with_retry(send, 'openai', 'test-context-length')
+    assert failed.value.error_class == 'invalid_request'
+    assert not isinstance(failed.value, retry.QuotaExhausted)
+    assert len(attempts) == 1
+    assert not shutdown.requested()
+
+
+def test_exhausted_quota_stops_the_run(monkeypatch):
+    monkeypatch.setenv('VLM_QUOTA_MODE', 'exit')
+
+    def send(encoded_images):
+        raise StatusError('insufficient_quota: You exceeded your current quota', 429)
+
+    with pytest.raises(retry.QuotaExhausted):
+        retry.call_with_retry(send, 'openai', 'test-quota')
+    assert shutdown.requested()
+
+
+def test_transient_errors_are_retried(monkeypatch):
+    monkeypatch.setattr(retry.deadlines, 'sleep', lambda seconds: None)
+    attempts = []
+
+    def send(encoded_images):
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise Exception('Connection reset by peer')
+        return 'response'
+
+    monkeypatch.setattr(retry, 'check_response', lambda provider, response: response)
+    assert retry.call_with_retry(send, 'openai', 'test-transient') == 'response'
+    assert len(attempts) == 3
+
+
+@pytest.mark.parametrize('attempt', range(6))
+def test_backoff_delay_is_capped(attempt):
+    delay = retry.backoff_delay(attempt, base_delay=1.0, max_delay=8.0)
+    assert 0 <= delay <= min(8.0, 2 ** attempt)
+
+
+def test_backoff_delay_honors_the_server_delay():
+    assert 5.0 <= retry.backoff_delay(0, base_delay=1.0, server_delay=5.0) <= 6.0
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from nejm_vlm import results
+from nejm_vlm import scoring
+
+
+def test_no_answer_is_never_correct():
+    labels = np.array([1, 0, 3])
+    answers = np.array([[1, 0, 2], [0, 0, 3]])
+    assert scoring.correctness(answers, labels).tolist() == [
+        [True, False, False], [False, False, True],
+    ]
+
+
+def test_accuracy_of_missing_runs_and_strata():
+    correct = np.array([[True, False, True, True], [False, False, False, False]])
+    present = np.array([True, False])
+    acc = scoring.accuracy(correct, present)
+    assert acc[0] == pytest.approx(0.75)
+    assert np.isnan(acc[1])
+    mask = np.array([True, True, False, False])
+    assert scoring.accuracy(correct, None, mask).tolist() == [0.5, 0.0]
+    assert np.isnan(scoring.accuracy(correct, None, np.zeros(4, dtype=bool))).all()
+
+
+def test_bootstrap_weights_resample_every_case_count():
+    weights = scoring.bootstrap_weights(5, n_resamples=100, seed=1)
+    assert weights.shape == (100, 5)
+    assert (weights.sum(axis=1) == 5).all()
+    assert (weights == scoring.bootstrap_weights(5, n_resamples=100, seed=1)).all()
+
+
+def test_bootstrap_interval():
+    rng = np.random.default_rng(0)
+    correct = np.stack([rng.random(200) < 0.7, np.ones(200, dtype=bool)])
+    low, high = scoring.bootstrap_accuracy(correct, n_resamples=2000)
+    acc = scoring.accuracy(correct)
+    assert low[0] < acc[0] < high[0]
+    # Normal approximation of the 95% interval of a proportion over 200 cases.
+    half_width = 1.96 * np.sqrt(acc[0] * (1 - acc[0]) / 200)
+    assert high[0] - low[0] == pytest.approx(2 * half_width, rel=0.2)
+    assert low[1] == high[1] == 1.0
+
+
+def test_stratum_masks_skip_empty_values():
+    masks = scoring.stratum_masks({'Section': np.array(['a', 'b', '', 'a'], dtype=object)})
+    assert [(stratum, value) for stratum, value, _ in masks] == [
+        ('all', 'all'), ('Section', 'a'), ('Section', 'b'),
+    ]
+    assert masks[1][2].tolist() == [True, False, False, True]
+
+
+def test_summary_table():
+    answers = np.zeros((2, 1, 2, 4), dtype=np.int16)
+    answers[0, 0, 0] = [1, 2, 3, 0]
+    answers[1, 0, 0] = [1, 1, 1, 1]
+    present = np.array([[[True, False]], [[True, True]]])
+    tensor = results.AnswerTensor(answers, present, ['gpt4o', 'Claude'], [1.0], [1, 2],
+                                  [1, 2, 3, 4])
+    labels = np.array([1, 2, 4, 4])
+    strata = {'Section': np.array(['a', 'a', 'b', 'b'], dtype=object)}
+    table = scoring.summary_table(tensor, labels, strata, n_resamples=200)
+
+    # Three executed runs, overall and for each of the two sections.
+    assert len(table) == 9
+    overall = table[table['stratum'] == 'all'].set_index(['model', 'try'])
+    assert overall.loc[('gpt4o', 1), 'n_correct'] == 2
+    assert overall.loc[('Claude', 1), 'accuracy'] == pytest.approx(0.25)
+    assert overall.loc[('Claude', 2), 'accuracy'] == 0
+    section_b = table[(table['value'] == 'b') & (table['model'] == 'gpt4o')]
+    assert section_b['n_cases'].item() == 2
+    assert section_b['n_correct'].item() == 0
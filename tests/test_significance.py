@@ -0,0 +1,92 @@
+from math import comb
+
+import numpy as np
+import pytest
+
+from nejm_vlm import results
+from nejm_vlm import significance
+
+
+def mcnemar_reference(b, c):
+    n, k = b + c, min(b, c)
+    if n == 0:
+        return 1.0
+    return min(1.0, 2 * sum(comb(n, i) for i in range(k + 1)) / 2 ** n)
+
+
+@pytest.mark.parametrize('b, c', [(0, 0), (0, 5), (3, 3), (2, 9), (12, 1), (40, 25)])
+def test_mcnemar_exact(b, c):
+    assert significance.mcnemar_exact(np.array([b]), np.array([c]))[0] == \
+        pytest.approx(mcnemar_reference(b, c))
+
+
+def test_mcnemar_exact_vectorized():
+    b, c = np.array([[1, 7], [0, 30]]), np.array([[6, 7], [4, 10]])
+    p_values = significance.mcnemar_exact(b, c)
+    assert p_values.shape == (2, 2)
+    for index in np.ndindex(b.shape):
+        assert p_values[index] == pytest.approx(mcnemar_reference(b[index], c[index]))
+
+
+def test_holm():
+    p_values = np.array([0.01, 0.04, 0.03, 0.005])
+    # Sorted: 0.005 * 4, 0.01 * 3, 0.03 * 2, 0.04 * 1, kept monotone.
+    assert significance.adjust_p_values(p_values, 'holm') == pytest.approx(
+        [0.03, 0.06, 0.06, 0.02]
+    )
+
+
+def test_benjamini_hochberg():
+    p_values = np.array([0.01, 0.04, 0.03, 0.005])
+    # Sorted: 0.005 * 4/1, 0.01 * 4/2, 0.03 * 4/3, 0.04 * 4/4, kept monotone.
+    assert significance.adjust_p_values(p_values, 'bh') == pytest.approx(
+        [0.02, 0.04, 0.04, 0.02]
+    )
+
+
+def test_bonferroni_and_none():
+    p_values = np.array([0.01, 0.5])
+    assert significance.adjust_p_values(p_values, 'bonferroni') == pytest.approx([0.02, 1.0])
+    assert significance.adjust_p_values(p_values, 'none') == pytest.approx(p_values)
+    with pytest.raises(ValueError):
+        significance.adjust_p_values(p_values, 'sidak')
+
+
+def test_condition_matrix_keeps_executed_runs():
+    answers = np.zeros((2, 1, 1, 3), dtype=np.int16)
+    answers[0, 0, 0] = [1, 2, 3]
+    present = np.array([[[True]], [[False]]])
+    tensor = results.AnswerTensor(answers, present, ['gpt4o', 'Claude'], [1.0], [1], [1, 2, 3])
+    names, correct = significance.condition_matrix({'full': tensor}, np.array([1, 1, 3]))
+    assert names == ['full/gpt4o/temp_1/try1']
+    assert correct.tolist() == [[True, False, True]]
+
+
+def test_pairwise_tests():
+    rng = np.random.default_rng(0)
+    strong = rng.random(150) < 0.9
+    weak = rng.random(150) < 0.4
+    names = ['strong', 'weak', 'strong_again']
+    correct = np.stack([strong, weak, strong])
+    table = significance.pairwise_tests(names, correct, n_resamples=2000)
+
+    assert len(table) == 3
+    rows = table.set_index(['condition_a', 'condition_b'])
+    different = rows.loc[('strong', 'weak')]
+    assert different['difference'] == pytest.approx(strong.mean() - weak.mean())
+    assert different['ci_low'] > 0
+    assert different['only_a_correct'] == int((strong & ~weak).sum())
+    for column in ('p_mcnemar', 'p_bootstrap', 'p_permutation'):
+        assert different[column] < 0.001
+
+    same = rows.loc[('strong', 'strong_again')]
+    assert same['difference'] == 0
+    assert same['p_mcnemar'] == 1.0
+    assert same['p_permutation'] == 1.0
+    # Holm adjusts across the whole family of rows.
+    assert (table['p_mcnemar_adj'] >= table['p_mcnemar']).all()
+
+
+def test_img_only_is_not_an_answer_task():
+    assert 'img-only' not in significance.ANSWER_TASKS
+    assert set(significance.ANSWER_TASKS) == {'full', 'no-img'}
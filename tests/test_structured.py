@@ -0,0 +1,30 @@
+import json
+
+import pytest
+
+from nejm_vlm import structured
+
+
+def test_typographic_quotes_inside_strings_are_kept():
+    text = '{"answer": "2", "reason": "the “target” sign"}'
+    assert structured.load_json(text) == json.loads(text)
+
+
+def test_typographic_quotes_as_delimiters_are_straightened():
+    text = '{“answer”: “2”, “reason”: “the target sign”}'
+    assert structured.load_json(text) == {'answer': '2', 'reason': 'the target sign'}
+
+
+@pytest.mark.parametrize('text', [
+    '```json\n{"answer": "2", "reason": "x",}\n```',
+    'Here is my answer:\n{"answer": "2", "reason": "x"}',
+    '{"answer": "2", "reason": "line\nbreak"}',
+    '{"answer": "2", "reason": "cut off',
+])
+def test_malformed_responses_are_repaired(text):
+    assert structured.load_json(text)['answer'] == '2'
+
+
+def test_no_object_raises():
+    with pytest.raises(json.JSONDecodeError):
+        structured.load_json('no JSON here')
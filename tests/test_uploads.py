@@ -0,0 +1,71 @@
+import base64
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from nejm_vlm import uploads
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2024-05-01T10:00:00Z', datetime(2024, 5, 1, 10, tzinfo=timezone.utc).timestamp()),
+    ('2024-05-01T10:00:00.5Z', datetime(2024, 5, 1, 10, 0, 0, 500000, timezone.utc).timestamp()),
+    # Nanoseconds, as returned by the File API.
+    ('2024-05-01T10:00:00.123456789Z',
+     datetime(2024, 5, 1, 10, 0, 0, 123456, timezone.utc).timestamp()),
+    ('2024-05-01T12:00:00.25+02:00',
+     datetime(2024, 5, 1, 10, 0, 0, 250000, timezone.utc).timestamp()),
+])
+def test_parse_time(value, expected):
+    assert uploads.parse_time(value) == pytest.approx(expected)
+
+
+def test_images_are_inlined_by_default(monkeypatch):
+    monkeypatch.delenv('VLM_GEMINI_UPLOADS', raising=False)
+    assert not uploads.enabled()
+    assert uploads.image_part('aW1hZ2U=') == {
+        'type': 'image_url', 'image_url': 'data:image/jpeg;base64,aW1hZ2U=',
+    }
+
+
+@pytest.fixture
+def file_api(tmp_path, monkeypatch):
+    """
+    A stand-in File API recording the uploads, with an empty upload cache.
+    """
+    monkeypatch.setenv('VLM_UPLOAD_CACHE', str(tmp_path / 'uploads.json'))
+    monkeypatch.setattr(uploads, '_uploads', None)
+    monkeypatch.setattr(uploads, '_verified', set())
+    monkeypatch.setattr(uploads.providers, 'api_key', lambda provider, key=None: 'key')
+    uploaded = []
+
+    def upload(api_key, image_bytes):
+        uploaded.append(image_bytes)
+        return {'name': f'files/{len(uploaded)}', 'uri': f'https://files/{len(uploaded)}',
+                'mime_type': 'image/jpeg', 'expires_at': time.time() + 48 * 3600}
+
+    monkeypatch.setattr(uploads, 'upload', upload)
+    monkeypatch.setattr(uploads, 'exists', lambda api_key, entry: True)
+    return uploaded
+
+
+def test_each_image_is_uploaded_once(file_api):
+    first, second = (base64.b64encode(data).decode() for data in (b'one', b'two'))
+    parts = [uploads.file_part(image) for image in (first, second, first)]
+    assert file_api == [b'one', b'two']
+    assert parts[0] == parts[2] == {
+        'type': 'media', 'file_uri': 'https://files/1', 'mime_type': 'image/jpeg',
+    }
+    # A new run reads the uploads back from the cache file.
+    uploads._uploads = None
+    uploads.file_part(second)
+    assert file_api == [b'one', b'two']
+
+
+def test_expiring_upload_is_replaced(file_api):
+    image = base64.b64encode(b'one').decode()
+    uploads.file_part(image)
+    for entry in uploads.load_uploads().values():
+        entry['expires_at'] = time.time() + uploads.EXPIRY_MARGIN / 2
+    assert uploads.file_part(image)['file_uri'] == 'https://files/2'
+    assert len(file_api) == 2
@@ -0,0 +1,129 @@
+import pandas as pd
+import pytest
+
+from nejm_vlm import circuit
+from nejm_vlm import results
+from nejm_vlm import retry
+from nejm_vlm import runner
+from nejm_vlm import shutdown
+from nejm_vlm import workqueue
+
+CASES = [1, 2, 3]
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    """
+    A queue of one try of CASES for gpt4o and Claude, in a fresh directory.
+    """
+    monkeypatch.chdir(tmp_path)
+    for variable in ('OPENAI_API_KEYS', 'ANTHROPIC_API_KEYS'):
+        monkeypatch.delenv(variable, raising=False)
+    monkeypatch.setattr(circuit, '_breakers', {})
+    pd.DataFrame({results.CASE_COLUMN: CASES}).to_excel(results.CASE_LIST_FILE, index=False)
+    connection = workqueue.connect(str(tmp_path / workqueue.QUEUE_FILE))
+    for model_key in ('gpt4o', 'Claude'):
+        for case_number in CASES:
+            connection.execute(
+                'INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, NULL, 0, 0, NULL)',
+                (model_key, 'full', case_number, 1, 1, workqueue.PENDING),
+            )
+    yield connection
+    connection.close()
+    shutdown._stop.clear()
+    shutdown._reason.clear()
+
+
+def jobs(connection):
+    return {
+        (model, case_number): (state, attempts)
+        for model, case_number, state, attempts in connection.execute(
+            'SELECT model, case_number, state, attempts FROM jobs'
+        )
+    }
+
+
+def test_open_circuit_leaves_the_other_models_going(queue, tmp_path, monkeypatch):
+    claude = runner.MODELS['Claude']
+    circuit._breakers[(claude.provider, claude.name)] = circuit.CircuitBreaker(
+        'anthropic claude', threshold=1, cooldown=3600
+    )
+    monkeypatch.setattr(retry, 'check_response', lambda provider, response: response)
+    sent = []
+
+    def run_case(model_key, task, row, temperature, try_number, result_folder):
+        model = runner.MODELS[model_key]
+
+        def send(encoded_images):
+            sent.append((model_key, row[results.CASE_COLUMN]))
+            if model_key == 'Claude':
+                raise Exception('Overloaded (529)')
+            return 'response'
+
+        try:
+            retry.call_with_retry(send, model.provider, model.name)
+        except retry.RequestFailed:
+            return False, 0.1, None
+        return True, 0.1, None
+
+    def wait(seconds):
+        # Only the jobs of the open circuit are left.
+        shutdown.request('test')
+        return True
+
+    monkeypatch.setattr(runner, 'run_case', run_case)
+    monkeypatch.setattr(workqueue.shutdown, 'wait', wait)
+    workqueue.work(str(tmp_path / workqueue.QUEUE_FILE), 'worker', 60)
+
+    # Claude's first case opened its circuit; its jobs wait without using attempts.
+    assert [job for job in sent if job[0] == 'Claude'] == [('Claude', 1)]
+    states = jobs(queue)
+    for case_number in CASES:
+        assert states[('gpt4o', case_number)] == (workqueue.DONE, 1)
+        assert states[('Claude', case_number)] == (workqueue.PENDING, 0)
+
+
+def test_lease_interleaves_the_models(queue):
+    leased = [workqueue.lease(queue, 'worker', 60)[:3] for _ in range(4)]
+    assert leased == [
+        ('Claude', 'full', 1), ('gpt4o', 'full', 1), ('Claude', 'full', 2), ('gpt4o', 'full', 2),
+    ]
+
+
+def test_lease_skips_models(queue):
+    leased = {workqueue.lease(queue, 'worker', 60, ['Claude'])[0] for _ in CASES}
+    assert leased == {'gpt4o'}
+    assert workqueue.lease(queue, 'worker', 60, ['Claude']) is None
+
+
+def test_expired_lease_is_reclaimed(queue):
+    job = workqueue.lease(queue, 'first', -1)
+    # The first worker's lease expired at once, so the job is leased again
+    # before the pending ones.
+    assert workqueue.lease(queue, 'second', 60) == job
+    assert not workqueue.renew(queue, 'first', job, 60)
+    assert workqueue.renew(queue, 'second', job, 60)
+
+
+def test_only_the_lease_holder_commits(queue):
+    job = workqueue.lease(queue, 'first', -1)
+    workqueue.lease(queue, 'second', 60)
+    assert not workqueue.finish(queue, job, 'first', True, 1.0)
+    assert jobs(queue)[(job[0], job[2])] == (workqueue.LEASED, 2)
+    assert workqueue.finish(queue, job, 'second', True, 2.0)
+    assert jobs(queue)[(job[0], job[2])] == (workqueue.DONE, 2)
+
+
+def test_failed_job_is_queued_again_until_its_attempts_run_out(queue):
+    for attempt in range(1, workqueue.MAX_JOB_ATTEMPTS + 1):
+        job = workqueue.lease(queue, 'worker', 60)
+        assert job[:3] == ('Claude', 'full', 1)
+        assert workqueue.finish(queue, job, 'worker', False, None)
+        state = workqueue.FAILED if attempt == workqueue.MAX_JOB_ATTEMPTS else workqueue.PENDING
+        assert jobs(queue)[('Claude', 1)] == (state, attempt)
+
+
+def test_uncounted_failure_keeps_its_attempts(queue):
+    job = workqueue.lease(queue, 'worker', 60)
+    assert workqueue.finish(queue, job, 'worker', False, None, counted=False)
+    assert jobs(queue)[(job[0], job[2])] == (workqueue.PENDING, 0)